@@ -0,0 +1,78 @@
+#! /usr/local/bin/python3
+
+"""Compare etag generation throughput of etag.file_etag with the original gen_etag implementation.
+
+example - python benchmarks/etag_benchmark.py --Size_MB 512
+"""
+
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from functools import reduce
+from hashlib import md5
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webinator'))
+
+from etag import file_etag  # noqa: E402
+
+CHUNK_SIZE = 8388608
+
+
+def legacy_etag(path):
+    """Generate an etag the way BucketManager.gen_etag originally did."""
+    hashes = []
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(CHUNK_SIZE)
+            if not data:
+                break
+            hashes.append(md5(data))
+
+    if not hashes:
+        return None
+    if len(hashes) == 1:
+        return hashes[0].hexdigest()
+    return f'"{md5(reduce(lambda x, y: x + y, (h.digest() for h in hashes))).hexdigest()}"-{len(hashes)}'
+
+
+def throughput(function, path, size, rounds):
+    """Return the best MB/s of function over a number of rounds."""
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return size / 1024 ** 2 / best
+
+
+def main():
+    """Run the benchmark."""
+    parser = ArgumentParser(description='Etag generation benchmark')
+    parser.add_argument('--Size_MB', type=int, default=256, help='Size of the test file in MB (default 256)')
+    parser.add_argument('--Rounds', type=int, default=3, help='Number of timed runs, the best is kept (default 3)')
+    args = parser.parse_args()
+
+    size = args.Size_MB * 1024 ** 2
+    with tempfile.NamedTemporaryFile() as file:
+        # write random data one MB at a time so the test file never has to fit in memory
+        for _ in range(args.Size_MB):
+            file.write(os.urandom(1024 ** 2))
+        file.flush()
+
+        results = {
+            'legacy gen_etag': throughput(legacy_etag, file.name, size, args.Rounds),
+            'etag.file_etag': throughput(lambda path: file_etag(path, CHUNK_SIZE, CHUNK_SIZE),
+                                         file.name, size, args.Rounds),
+        }
+
+    print(f"{args.Size_MB} MB file, best of {args.Rounds} runs")
+    for name, rate in results.items():
+        print(f"  {name:<16} {rate:10.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#! /usr/local/bin/python3
+
+"""Compare the memory used by a plain dict manifest and manifest.Manifest for synthetic buckets.
+
+Each measurement runs in a fresh python process so the peak RSS of one doesn't hide another.
+
+example - python benchmarks/manifest_benchmark.py --Keys 1000000 10000000
+"""
+
+import os
+import resource
+import subprocess
+import sys
+from argparse import SUPPRESS, ArgumentParser
+from hashlib import md5
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webinator'))
+
+from manifest import Manifest  # noqa: E402
+
+
+def synthetic_objects(count):
+    """Generate (key, etag) pairs shaped like a website bucket listing, in listing order."""
+    for index in range(count):
+        # a few thousand "directories" of files, with every 50th object uploaded in parts
+        key = f"assets/{index // 5000:05d}/{index % 5000:04d}-bundle.{('js', 'css', 'png')[index % 3]}"
+        digest = md5(key.encode()).hexdigest()
+        yield key, f'"{digest}-3"' if index % 50 == 0 else f'"{digest}"'
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure(kind, count):
+    """Build a manifest of count keys and print the bytes it took."""
+    before = peak_rss()
+    manifest = {} if kind == 'dict' else Manifest()
+    for key, etag in synthetic_objects(count):
+        manifest[key] = etag
+    print(peak_rss() - before)
+
+
+def main():
+    """Run the benchmark."""
+    parser = ArgumentParser(description='Manifest memory benchmark')
+    parser.add_argument('--Keys', type=int, nargs='+', default=[1000000, 10000000],
+                        help='Bucket sizes to measure (default 1000000 10000000)')
+    parser.add_argument('--Measure', nargs=2, help=SUPPRESS)  # used to run a single measurement in a child process
+    args = parser.parse_args()
+
+    if args.Measure:
+        measure(args.Measure[0], int(args.Measure[1]))
+        return
+
+    print(f"{'keys':>12} {'dict MB':>10} {'Manifest MB':>12} {'bytes/key':>16}")
+    for count in args.Keys:
+        used = {}
+        for kind in ('dict', 'Manifest'):
+            output = subprocess.run([sys.executable, __file__, '--Measure', kind, str(count)],
+                                    check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            used[kind] = int(output)
+
+        print(f"{count:>12} {used['dict'] / 1024 ** 2:>10.0f} {used['Manifest'] / 1024 ** 2:>12.0f} "
+              f"{used['dict'] / count:>7.0f} -> {used['Manifest'] / count:<6.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#! /usr/local/bin/python3
+
+"""Measure the startup cost (wall time and peak RSS) of each webinator.py command.
+
+Every command is run in a fresh python process against an endpoint that refuses connections,
+so the first AWS request fails straight away and what's left is the cost of starting up:
+importing modules, creating the session and loading service models.
+With --Baseline the same commands are also run on an older commit of the repo for comparison.
+
+example - python benchmarks/startup_benchmark.py --Baseline <commit> --Rounds 5
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# commands and the arguments they need, none of them get as far as changing anything
+COMMANDS = [
+    ['list_buckets'],
+    ['list_bucket_objects', '--Bucket_Name', 'bench-bucket'],
+    ['setup_bucket', '--Bucket_Name', 'bench-bucket'],
+    ['setup_domain', '--Site_DNS', 'www.example.com'],
+    ['find_cert', '--Domain', 'www.example.com'],
+    ['setup_cdn', '--Site_DNS', 'www.example.com', '--Domain', 'example.com'],
+]
+
+
+def environment(home):
+    """Return an environment with dummy credentials and every AWS endpoint pointing at a closed port."""
+    config = os.path.join(home, 'config')
+    with open(config, 'w', encoding='utf-8') as file:
+        file.write("[profile bench]\naws_access_key_id = bench\naws_secret_access_key = bench\n"
+                   "region = us-west-2\nmax_attempts = 1\n")
+
+    env = dict(os.environ, HOME=home, AWS_CONFIG_FILE=config, AWS_SHARED_CREDENTIALS_FILE=config,
+               AWS_ENDPOINT_URL='http://127.0.0.1:9', AWS_EC2_METADATA_DISABLED='true')
+    return env
+
+
+def run(script, command, env):
+    """Run one command. Return its wall time in seconds and peak RSS in bytes."""
+    args = [sys.executable, script, command[0], 'us-west-2', '--AWS_Profile', 'bench'] + command[1:]
+    start = time.perf_counter()
+    process = subprocess.Popen(args, cwd=os.path.dirname(script), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait4 gives the resource usage of this child alone, RUSAGE_CHILDREN would be the peak of all of them
+    _, _, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = 0  # already reaped by wait4
+
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return elapsed, rss
+
+
+def measure(script, env, rounds):
+    """Return {command: (median wall time, median peak RSS)} for script."""
+    results = {}
+    for command in COMMANDS:
+        samples = [run(script, command, env) for _ in range(rounds)]
+        results[command[0]] = (statistics.median(s[0] for s in samples), statistics.median(s[1] for s in samples))
+    return results
+
+
+def export(ref, target):
+    """Export the repo at git ref into target. Return the path of its webinator.py."""
+    archive = subprocess.run(['git', 'archive', ref], cwd=REPO, check=True, stdout=subprocess.PIPE).stdout
+    subprocess.run(['tar', '-x', '-C', target], input=archive, check=True)
+    return os.path.join(target, 'webinator', 'webinator.py')
+
+
+def main():
+    """Run the benchmark."""
+    parser = ArgumentParser(description='webinator.py startup benchmark')
+    parser.add_argument('--Baseline', help='git ref of an older version to compare against (eg a commit hash)')
+    parser.add_argument('--Rounds', type=int, default=5, help='Runs of each command, the median is shown (default 5)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home, tempfile.TemporaryDirectory() as baseline_tree:
+        env = environment(home)
+        current = measure(os.path.join(REPO, 'webinator', 'webinator.py'), env, args.Rounds)
+        baseline = measure(export(args.Baseline, baseline_tree), env, args.Rounds) if args.Baseline else None
+
+    if baseline:
+        print(f"{'command':<22} {'baseline s':>10} {'current s':>10} {'baseline MB':>12} {'current MB':>11}")
+        for command, (elapsed, rss) in current.items():
+            old_elapsed, old_rss = baseline[command]
+            print(f"{command:<22} {old_elapsed:>10.2f} {elapsed:>10.2f} {old_rss / 1024 ** 2:>12.1f} "
+                  f"{rss / 1024 ** 2:>11.1f}")
+    else:
+        print(f"{'command':<22} {'seconds':>10} {'MB':>8}")
+        for command, (elapsed, rss) in current.items():
+            print(f"{command:<22} {elapsed:>10.2f} {rss / 1024 ** 2:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#! /usr/local/bin/python3
+
+"""Benchmark BucketManager.sync, load_manifest and gen_etag against a local S3 stand-in.
+
+Synthetic website trees are generated for each scenario (many tiny files, some medium ones, a few very large ones)
+and synced to moto's server (pip install "moto[server]"), or to any other S3 compatible server with --Endpoint_Url.
+Each scenario runs in a fresh python process, which records:
+
+- hashing throughput of gen_etag over every file (MB/s)
+- throughput of a first sync into an empty bucket (files/s and MB/s) and its request latency percentiles
+- time taken by a second sync with nothing to do
+- listing rate of load_manifest (objects/s)
+- S3 API calls made by the first sync and the peak RSS of the process
+
+--Save_Baseline stores the results as JSON, --Baseline compares a run with stored results
+and exits with status 1 when anything got worse by more than --Tolerance, so it can gate a deploy.
+
+example - python benchmarks/sync_benchmark.py --Tiny_Files 10000 --Large_MB 256 --Save_Baseline base.json
+"""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from argparse import SUPPRESS, ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webinator'))
+
+# size of the block large files are written from, each block is stamped so no two are the same
+BLOCK_SIZE = 1024 ** 2
+
+# files per directory of a generated tree
+FILES_PER_DIR = 500
+
+# result name -> True if bigger is better, in the order they are printed
+RESULTS = [
+    ('hash_mb_s', True),
+    ('sync_files_s', True),
+    ('sync_mb_s', True),
+    ('sync_p50_ms', False),
+    ('sync_p99_ms', False),
+    ('resync_seconds', False),
+    ('list_objects_s', True),
+    ('api_calls', False),
+    ('peak_rss_mb', False),
+]
+
+
+def scenarios(args):
+    """Return {scenario name: (file count, file size in bytes)} for the scenarios args asks for."""
+    chosen = {
+        'tiny': (args.Tiny_Files, args.Tiny_KB * 1024),
+        'medium': (args.Medium_Files, args.Medium_KB * 1024),
+        'large': (args.Large_Files, args.Large_MB * 1024 ** 2),
+    }
+    return {name: shape for name, shape in chosen.items() if shape[0] and name in args.Scenarios}
+
+
+def generate_tree(root, count, size):
+    """Write count files of size bytes under root, spread over directories like a website's assets."""
+    block = os.urandom(min(size, BLOCK_SIZE))
+    for index in range(count):
+        directory = os.path.join(root, f"assets/{index // FILES_PER_DIR:04d}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file-{index:06d}.bin"), 'wb') as file:
+            # the stamp keeps every file (and every block of a large one) different, so none are deduplicated
+            for number, start in enumerate(range(0, size, BLOCK_SIZE)):
+                stamp = f"{index}:{number}:".encode()
+                chunk = block[:min(BLOCK_SIZE, size - start)]
+                file.write(stamp[:len(chunk)] + chunk[len(stamp):])
+
+
+def merged_percentiles(requests, operations, fractions):
+    """Return the latency percentiles (milliseconds) of the requests for operations, taken together."""
+    from metrics import Histogram
+
+    merged = Histogram()
+    for operation in operations:
+        histogram = requests.get(operation)
+        if histogram:
+            merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+            merged.count += histogram.count
+    return [merged.percentile(fraction) * 1000 if merged.count else 0 for fraction in fractions]
+
+
+def measure(root, workers):
+    """Run one scenario on the tree at root against the endpoint in AWS_ENDPOINT_URL and print its results."""
+    import boto3
+    from bucket import BucketManager
+
+    session = boto3.Session(region_name='us-east-1')
+    bucket_name = f"bench-{uuid.uuid4().hex[:12]}"
+    session.client('s3').create_bucket(Bucket=bucket_name)
+
+    paths = [os.path.join(directory, name) for directory, _, names in os.walk(root) for name in names]
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+
+    # hashing on its own, one file after the other like gen_etag is called for each etag cache miss
+    manager = BucketManager(session, workers=workers)
+    start = time.perf_counter()
+    for path in paths:
+        manager.gen_etag(path)
+    hash_seconds = time.perf_counter() - start
+
+    # first sync into the empty bucket, every file is hashed (the cache is empty) and uploaded
+    manager = BucketManager(session, workers=workers)
+    start = time.perf_counter()
+    errors = manager.sync(root, bucket_name)
+    sync_seconds = time.perf_counter() - start
+    report = manager.metrics.report()
+    requests = manager.metrics.latencies
+
+    # second sync, the etag cache is warm and nothing has changed
+    start = time.perf_counter()
+    BucketManager(session, workers=workers).sync(root, bucket_name)
+    resync_seconds = time.perf_counter() - start
+
+    lister = BucketManager(session, workers=workers)
+    lister.load_manifest(lister.s3.Bucket(bucket_name))
+
+    p50, p99 = merged_percentiles(requests, ('PutObject', 'UploadPart'), (0.5, 0.99))
+    print(json.dumps({
+        'files': len(paths),
+        'bytes': total_bytes,
+        'errors': len(errors),
+        'hash_mb_s': total_bytes / 1024 ** 2 / hash_seconds if hash_seconds else 0,
+        'sync_files_s': len(paths) / sync_seconds,
+        'sync_mb_s': total_bytes / 1024 ** 2 / sync_seconds,
+        'sync_p50_ms': p50,
+        'sync_p99_ms': p99,
+        'resync_seconds': resync_seconds,
+        'list_objects_s': lister.listing_rate,
+        'api_calls': sum(request['count'] for request in report['requests'].values()),
+        'calls_by_operation': {operation: request['count'] for operation, request in report['requests'].items()},
+        'phases': report['phases'],
+    }))
+
+
+def run(args, root, env):
+    """Run measure for the tree at root in a child process. Return its results with the child's peak RSS."""
+    command = [sys.executable, __file__, '--Measure', root, '--Workers', str(args.Workers)]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, universal_newlines=True)
+    output = process.stdout.read()
+    # wait4 gives the resource usage of this child alone, RUSAGE_CHILDREN would be the peak of all of them
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = 0  # already reaped by wait4
+    if status:
+        raise RuntimeError(f"benchmark of {root} failed")
+
+    results = json.loads(output)
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    results['peak_rss_mb'] = (usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024) / 1024 ** 2
+    return results
+
+
+def compare(baseline, current, tolerance):
+    """Print current against baseline. Return the (scenario, result) pairs worse by more than tolerance."""
+    regressions = []
+    print(f"{'scenario':<8} {'result':<16} {'baseline':>12} {'current':>12} {'change':>8}")
+    for scenario, results in current.items():
+        if scenario not in baseline:
+            continue
+        for name, bigger_is_better in RESULTS:
+            old, new = baseline[scenario].get(name), results[name]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = -change if bigger_is_better else change
+            flag = '  REGRESSION' if worse > tolerance else ''
+            if flag:
+                regressions.append((scenario, name))
+            print(f"{scenario:<8} {name:<16} {old:>12.2f} {new:>12.2f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    """Run the benchmark."""
+    parser = ArgumentParser(description='Sync benchmark against a local S3 server')
+    parser.add_argument('--Scenarios', nargs='+', default=['tiny', 'medium', 'large'],
+                        help='Scenarios to run (default tiny medium large)')
+    parser.add_argument('--Tiny_Files', type=int, default=100000, help='Files in the tiny scenario (default 100000)')
+    parser.add_argument('--Tiny_KB', type=int, default=1, help='Size of each tiny file (default 1)')
+    parser.add_argument('--Medium_Files', type=int, default=1000, help='Files in the medium scenario (default 1000)')
+    parser.add_argument('--Medium_KB', type=int, default=512, help='Size of each medium file (default 512)')
+    parser.add_argument('--Large_Files', type=int, default=10, help='Files in the large scenario (default 10)')
+    parser.add_argument('--Large_MB', type=int, default=2048, help='Size of each large file (default 2048)')
+    parser.add_argument('--Workers', type=int, default=10, help='Upload workers of each sync (default 10)')
+    parser.add_argument('--Endpoint_Url', help='S3 compatible server to use instead of starting moto')
+    parser.add_argument('--Work_Dir', help='Directory for the generated trees (default a temporary directory)')
+    parser.add_argument('--Save_Baseline', help='Save the results to this JSON file')
+    parser.add_argument('--Baseline', help='Compare the results with this JSON file saved by --Save_Baseline')
+    parser.add_argument('--Tolerance', type=float, default=0.1,
+                        help='Fraction a result may get worse by before it counts as a regression (default 0.1)')
+    parser.add_argument('--Measure', help=SUPPRESS)  # used to run a single scenario in a child process
+    args = parser.parse_args()
+
+    if args.Measure:
+        measure(args.Measure, args.Workers)
+        return
+
+    server = None
+    endpoint = args.Endpoint_Url
+    if not endpoint:
+        from moto.server import ThreadedMotoServer
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # a line for every request otherwise
+        server = ThreadedMotoServer(port=0, verbose=False)
+        server.start()
+        host, port = server.get_host_and_port()
+        endpoint = f"http://{host}:{port}"
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.Work_Dir) as work, tempfile.TemporaryDirectory() as home:
+        # a fresh home keeps the etag cache and journals of earlier runs out of the measurements
+        env = dict(os.environ, HOME=home, AWS_ENDPOINT_URL=endpoint, AWS_ACCESS_KEY_ID='bench',
+                   AWS_SECRET_ACCESS_KEY='bench', AWS_DEFAULT_REGION='us-east-1', AWS_EC2_METADATA_DISABLED='true')
+        try:
+            for name, (count, size) in scenarios(args).items():
+                root = os.path.join(work, name)
+                print(f"Generating {count} file(s) of {size / 1024:.0f} KB for {name}...")
+                generate_tree(root, count, size)
+                results[name] = run(args, root, env)
+        finally:
+            if server:
+                server.stop()
+
+    print(f"{'scenario':<8} " + ' '.join(f"{name:>14}" for name, _ in RESULTS))
+    for name, values in results.items():
+        print(f"{name:<8} " + ' '.join(f"{values[result]:>14.2f}" for result, _ in RESULTS))
+
+    if args.Save_Baseline:
+        with open(args.Save_Baseline, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+    if args.Baseline:
+        with open(args.Baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        print()
+        regressions = compare(baseline, results, args.Tolerance)
+        if regressions:
+            print(f"{len(regressions)} result(s) regressed by more than {args.Tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
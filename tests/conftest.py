@@ -0,0 +1,95 @@
+"""Fixtures shared by the tests, which run against moto's in-memory AWS (pip install moto pytest)."""
+
+import os
+import sys
+from urllib.request import Request, urlopen
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# the modules import each other by name, the way webinator.py is run from inside webinator/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webinator'))
+
+import cache  # noqa: E402 pylint: disable=wrong-import-position
+import compress  # noqa: E402 pylint: disable=wrong-import-position
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep the etag cache, snapshots and journals of each test in a directory of its own."""
+    directory = tmp_path / 'cache'
+    monkeypatch.setattr(cache, 'CACHE_DIR', directory)
+    monkeypatch.setattr(compress, 'CACHE_DIR', directory)
+    return directory
+
+
+@pytest.fixture
+def session(monkeypatch):
+    """Get a boto3 session whose requests all go to moto."""
+    for name in ('AWS_PROFILE', 'AWS_ENDPOINT_URL', 'AWS_CONFIG_FILE', 'AWS_MAX_ATTEMPTS', 'AWS_RETRY_MODE'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with mock_aws():
+        yield boto3.Session(region_name='us-east-1')
+
+
+@pytest.fixture
+def server_session(monkeypatch):
+    """Get a boto3 session whose requests go to a moto server, for clients mock_aws can't patch (eg aiobotocore)."""
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    for name in ('AWS_PROFILE', 'AWS_CONFIG_FILE', 'AWS_MAX_ATTEMPTS', 'AWS_RETRY_MODE'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('AWS_ENDPOINT_URL', f"http://{host}:{port}")
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    try:
+        yield boto3.Session(region_name='us-east-1')
+    finally:
+        # the server's buckets live on in the process, so they are cleared for the next test
+        urlopen(Request(f"http://{host}:{port}/moto-api/reset", method='POST'))
+        server.stop()
+
+
+@pytest.fixture
+def bucket_name(session):
+    """Create an empty bucket and get its name."""
+    session.client('s3').create_bucket(Bucket='test-bucket')
+    return 'test-bucket'
+
+
+@pytest.fixture
+def site(tmp_path):
+    """Get a function writing {key: content} as files under a website root, which it returns."""
+    root = tmp_path / 'site'
+
+    def write(files):
+        """Write each file, creating the directories its key needs."""
+        for key, content in files.items():
+            path = root.joinpath(*key.split('/'))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content if isinstance(content, bytes) else content.encode())
+        return root
+
+    root.mkdir()
+    return write
+
+
+@pytest.fixture
+def bucket_keys(session, bucket_name):
+    """Get a function returning the sorted keys of every object in the bucket."""
+    def keys():
+        """List the bucket."""
+        paginator = session.client('s3').get_paginator('list_objects_v2')
+        return sorted(obj['Key'] for page in paginator.paginate(Bucket=bucket_name)
+                      for obj in page.get('Contents', []))
+
+    return keys
@@ -0,0 +1,239 @@
+"""Tests of AsyncBucketManager.sync against a moto server."""
+
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip('aiobotocore')
+
+from async_bucket import AsyncBucketManager  # noqa: E402 pylint: disable=wrong-import-position
+from bucket import BucketManager  # noqa: E402 pylint: disable=wrong-import-position
+from cache import UploadJournal  # noqa: E402 pylint: disable=wrong-import-position
+from ratecontrol import RateControl  # noqa: E402 pylint: disable=wrong-import-position
+import util  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def async_sync(session, root, bucket_name, bandwidth_limiter=None, rate_control=None, **options):
+    """Run one AsyncBucketManager.sync. Return its errors and changed keys."""
+    async def run():
+        """Sync inside the manager's client."""
+        async with AsyncBucketManager(session, concurrency=10, endpoint_url=os.environ['AWS_ENDPOINT_URL'],
+                                      bandwidth_limiter=bandwidth_limiter, rate_control=rate_control) as manager:
+            errors = await manager.sync(root, bucket_name, **options)
+            return errors, manager.changed_keys
+
+    return asyncio.run(run())
+
+
+def test_async_sync_invalidates_an_earlier_snapshot(server_session, site):
+    """An async sync changing the bucket removes the snapshot marker of an earlier snapshot sync."""
+    server_session.client('s3').create_bucket(Bucket='test-bucket')
+    root = site({'index.html': 'A'})
+    assert BucketManager(server_session).sync(root, 'test-bucket', snapshot=True) == []
+
+    site({'index.html': 'B'})
+    assert async_sync(server_session, root, 'test-bucket') == ([], ['index.html'])
+
+    site({'index.html': 'A'})
+    manager = BucketManager(server_session)
+    assert manager.sync(root, 'test-bucket', snapshot=True) == []
+    assert manager.changed_keys == ['index.html']
+
+
+def test_async_sync_reuses_its_snapshot(server_session, site):
+    """An async snapshot sync saves a snapshot that the next one loads instead of listing the bucket."""
+    server_session.client('s3').create_bucket(Bucket='test-bucket')
+    root = site({'index.html': 'home', 'css/site.css': 'body {}'})
+
+    async def run():
+        """Sync twice with snapshot=True, the second time with nothing changed."""
+        endpoint_url = os.environ['AWS_ENDPOINT_URL']
+        async with AsyncBucketManager(server_session, concurrency=10, endpoint_url=endpoint_url) as manager:
+            assert await manager.sync(root, 'test-bucket', snapshot=True) == []
+            generation = manager.snapshot_generation
+            assert generation
+
+        async with AsyncBucketManager(server_session, concurrency=10, endpoint_url=endpoint_url) as manager:
+            assert await manager.sync(root, 'test-bucket', snapshot=True) == []
+            assert manager.snapshot_generation == generation
+            assert manager.changed_keys == []
+            assert 'objects_listed' not in manager.metrics.counters
+
+    asyncio.run(run())
+
+
+def test_async_sync_resumes_an_interrupted_upload(server_session, site):
+    """A large file with an upload in the journal only has its missing parts uploaded, completing that upload."""
+    client = server_session.client('s3')
+    client.create_bucket(Bucket='test-bucket')
+    data = bytes(range(256)) * (12 * 1024 ** 2 // 256)
+    root = site({'video.bin': data})
+
+    # an earlier sync got as far as the first part before it was interrupted
+    chunk_size = BucketManager.CHUNK_SIZE
+    etag = BucketManager(server_session).local_etag(str(root / 'video.bin'), 'video.bin')
+    upload_id = client.create_multipart_upload(Bucket='test-bucket', Key='video.bin')['UploadId']
+    part = client.upload_part(Bucket='test-bucket', Key='video.bin', UploadId=upload_id, PartNumber=1,
+                              Body=data[:chunk_size])
+    journal = UploadJournal('test-bucket')
+    journal.start('video.bin', upload_id, etag, chunk_size)
+    journal.add_part(upload_id, 1, part['ETag'])
+    journal.close()
+
+    assert async_sync(server_session, root, 'test-bucket') == ([], ['video.bin'])
+
+    assert client.head_object(Bucket='test-bucket', Key='video.bin')['ETag'] == etag
+    # the interrupted upload was completed rather than a new one started next to it
+    assert client.list_multipart_uploads(Bucket='test-bucket').get('Uploads', []) == []
+    journal = UploadJournal('test-bucket')
+    assert journal.get('video.bin') is None
+    journal.close()
+
+
+def test_async_sync_uploads_under_the_bandwidth_cap(server_session, site):
+    """Every byte the async path uploads is taken from the bandwidth limiter first."""
+    server_session.client('s3').create_bucket(Bucket='test-bucket')
+    root = site({'index.html': 'x' * 3000, 'css/site.css': 'y' * 2000})
+    reserved = []
+
+    class Limiter(util.RateLimiter):
+        """RateLimiter noting the bytes reserved."""
+
+        def reserve(self, count=1):
+            """Note count and reserve it."""
+            reserved.append(count)
+            return super().reserve(count)
+
+    assert async_sync(server_session, root, 'test-bucket', Limiter(10 ** 9))[0] == []
+
+    assert sorted(reserved) == [2000, 3000]
+
+
+def test_async_requests_go_through_rate_control(server_session, site):
+    """The async client's requests wait on the shared token buckets and limits, and give their slots back."""
+    server_session.client('s3').create_bucket(Bucket='test-bucket')
+    root = site({f"page{number}.html": str(number) for number in range(6)})
+    rate_control = RateControl(rates={'s3': 20})
+
+    assert async_sync(server_session, root, 'test-bucket', rate_control=rate_control)[0] == []
+
+    stats = rate_control.report()['s3']
+    # at least a listing and the six uploads
+    assert stats['requests'] >= 7
+    assert stats['throttled'] == 0
+    assert rate_control.limits['s3'].in_flight == 0
+
+
+def test_async_parts_of_a_large_file_are_uploaded_at_once(server_session, site, monkeypatch):
+    """The parts of one large file are in flight together, and the object still gets the file's etag."""
+    client = server_session.client('s3')
+    client.create_bucket(Bucket='test-bucket')
+    root = site({'video.bin': bytes(range(256)) * (40 * 1024 ** 2 // 256)})
+    in_flight = []
+    most = []
+    real_upload_part = AsyncBucketManager.upload_part
+
+    async def upload_part(self, *args):
+        """Note how many parts are being uploaded alongside this one."""
+        in_flight.append(1)
+        most.append(len(in_flight))
+        try:
+            return await real_upload_part(self, *args)
+        finally:
+            in_flight.pop()
+
+    monkeypatch.setattr(AsyncBucketManager, 'upload_part', upload_part)
+
+    assert async_sync(server_session, root, 'test-bucket') == ([], ['video.bin'])
+
+    assert len(most) == 5
+    assert max(most) > 1
+    etag = BucketManager(server_session).local_etag(str(root / 'video.bin'), 'video.bin')
+    assert client.head_object(Bucket='test-bucket', Key='video.bin')['ETag'] == etag
+
+
+def test_async_resume_uploads_every_missing_part(server_session, site, monkeypatch):
+    """Resuming an upload with gaps uploads just the missing parts, together, and completes it in part order."""
+    client = server_session.client('s3')
+    client.create_bucket(Bucket='test-bucket')
+    chunk_size = BucketManager.CHUNK_SIZE
+    data = bytes(range(256)) * (5 * chunk_size // 256)
+    root = site({'video.bin': data})
+
+    # an earlier sync finished parts 1 and 3 of 5 before it was interrupted
+    etag = BucketManager(server_session).local_etag(str(root / 'video.bin'), 'video.bin')
+    upload_id = client.create_multipart_upload(Bucket='test-bucket', Key='video.bin')['UploadId']
+    journal = UploadJournal('test-bucket')
+    journal.start('video.bin', upload_id, etag, chunk_size)
+    for number in (1, 3):
+        part = client.upload_part(Bucket='test-bucket', Key='video.bin', UploadId=upload_id, PartNumber=number,
+                                  Body=data[(number - 1) * chunk_size:number * chunk_size])
+        journal.add_part(upload_id, number, part['ETag'])
+    journal.close()
+
+    uploaded = []
+    real_upload_part = AsyncBucketManager.upload_part
+
+    async def upload_part(self, bucket_name, path, key, upload_id, number, chunk_size):
+        """Note the number of each part uploaded."""
+        uploaded.append(number)
+        return await real_upload_part(self, bucket_name, path, key, upload_id, number, chunk_size)
+
+    monkeypatch.setattr(AsyncBucketManager, 'upload_part', upload_part)
+
+    assert async_sync(server_session, root, 'test-bucket') == ([], ['video.bin'])
+
+    assert sorted(uploaded) == [2, 4, 5]
+    assert client.head_object(Bucket='test-bucket', Key='video.bin')['ETag'] == etag
+    assert client.list_multipart_uploads(Bucket='test-bucket').get('Uploads', []) == []
+
+
+def test_async_uploads_are_timed(server_session, site):
+    """Each file the async path uploads is timed through the tuner, for the per-file log and its throughput."""
+    server_session.client('s3').create_bucket(Bucket='test-bucket')
+    root = site({'index.html': 'home', 'video.bin': bytes(range(256)) * (9 * 1024 ** 2 // 256)})
+
+    async def run():
+        """Sync, then check what the manager measured."""
+        async with AsyncBucketManager(server_session, concurrency=10,
+                                      endpoint_url=os.environ['AWS_ENDPOINT_URL']) as manager:
+            assert await manager.sync(root, 'test-bucket') == []
+            assert sorted(manager.upload_stats) == ['index.html', 'video.bin']
+            assert manager.upload_stats['video.bin'][0] == 9 * 1024 ** 2
+            assert manager.tuner.active == 0
+            assert manager.tuner.stream_rate
+
+    asyncio.run(run())
+
+
+def test_async_parts_in_memory_are_capped(server_session, site):
+    """However many requests may be in flight, no more parts are held and sent at once than the tuner's connections."""
+    server_session.client('s3').create_bucket(Bucket='test-bucket')
+    part = bytes(range(256)) * (BucketManager.CHUNK_SIZE // 256)
+    root = site({'a.bin': part * 3, 'b.bin': part[::-1] * 3})
+    in_flight = []
+    most = []
+
+    async def run():
+        """Sync with room for two parts, noting how many are being sent at any one time."""
+        manager = AsyncBucketManager(server_session, concurrency=10, endpoint_url=os.environ['AWS_ENDPOINT_URL'])
+        manager.tuner.connections = 2
+        async with manager:
+            real_upload_part = manager.client.upload_part
+
+            async def upload_part(**kwargs):
+                """Note the part being sent alongside the others."""
+                in_flight.append(1)
+                most.append(len(in_flight))
+                try:
+                    return await real_upload_part(**kwargs)
+                finally:
+                    in_flight.pop()
+
+            manager.client.upload_part = upload_part
+            return await manager.sync(root, 'test-bucket')
+
+    assert asyncio.run(run()) == []
+    assert len(most) == 6
+    assert max(most) <= 2
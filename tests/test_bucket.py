@@ -0,0 +1,317 @@
+"""Tests of BucketManager.sync against moto."""
+
+import json
+import os
+
+from botocore.exceptions import ClientError
+
+from bucket import BucketManager
+from cache import UploadJournal
+from policy import HeaderPolicy
+from walker import RESERVED_PREFIX
+
+
+def test_serial_hashing_syncs_every_file(session, bucket_name, site, bucket_keys):
+    """With one hash worker, files past SERIAL_HASH_LIMIT are synced too and never deleted."""
+    count = BucketManager.SERIAL_HASH_LIMIT * 3
+    root = site({f"pages/{index:03d}.html": f"page {index}" for index in range(count)})
+
+    assert BucketManager(session, hash_workers=1).sync(root, bucket_name) == []
+    assert len(bucket_keys()) == count
+
+    # a second sync with nothing changed has nothing to upload, and above all nothing to delete
+    manager = BucketManager(session, hash_workers=1)
+    assert manager.sync(root, bucket_name) == []
+    assert manager.changed_keys == []
+    assert len(bucket_keys()) == count
+
+
+def test_sync_uploads_changes_and_deletes_removed_files(session, bucket_name, site, bucket_keys):
+    """Only changed files are uploaded again, and files removed locally are deleted from the bucket."""
+    root = site({'index.html': 'home', 'about.html': 'about', 'css/site.css': 'body {}'})
+    assert BucketManager(session).sync(root, bucket_name) == []
+
+    (root / 'about.html').unlink()
+    site({'index.html': 'new home'})
+    manager = BucketManager(session)
+    assert manager.sync(root, bucket_name) == []
+
+    assert sorted(manager.changed_keys) == ['about.html', 'index.html']
+    assert bucket_keys() == ['css/site.css', 'index.html']
+    body = session.client('s3').get_object(Bucket=bucket_name, Key='index.html')['Body'].read()
+    assert body == b'new home'
+
+
+def test_sync_keeps_excluded_objects(session, bucket_name, site, bucket_keys):
+    """Objects the exclude rules leave out are never deleted."""
+    root = site({'index.html': 'home'})
+    session.client('s3').put_object(Bucket=bucket_name, Key='logs/access.log', Body=b'log')
+
+    assert BucketManager(session).sync(root, bucket_name, exclude=['logs']) == []
+    assert bucket_keys() == ['index.html', 'logs/access.log']
+
+
+def test_sync_keeps_objects_of_unreadable_files(session, bucket_name, site, bucket_keys, monkeypatch):
+    """A file that can't be read is reported, and its object is left in the bucket rather than deleted."""
+    root = site({'index.html': 'home', 'private.txt': 'secret'})
+    assert BucketManager(session).sync(root, bucket_name) == []
+
+    real_gen_etag = BucketManager.gen_etag
+
+    def gen_etag(self, path):
+        """Fail to read private.txt."""
+        if str(path).endswith('private.txt'):
+            raise PermissionError(13, 'Permission denied', str(path))
+        return real_gen_etag(self, path)
+
+    monkeypatch.setattr(BucketManager, 'gen_etag', gen_etag)
+    site({'private.txt': 'changed'})  # so its cached etag is stale and it has to be hashed again
+    errors = BucketManager(session).sync(root, bucket_name)
+
+    assert [key for key, _ in errors] == ['private.txt']
+    assert bucket_keys() == ['index.html', 'private.txt']
+
+
+def test_dry_run_changes_nothing(session, bucket_name, site, bucket_keys):
+    """A dry run plans the sync without uploading or deleting anything."""
+    session.client('s3').put_object(Bucket=bucket_name, Key='gone.html', Body=b'old')
+    root = site({'index.html': 'home'})
+
+    assert BucketManager(session).sync(root, bucket_name, dry_run=True) == []
+    assert bucket_keys() == ['gone.html']
+
+
+def test_plain_sync_invalidates_an_earlier_snapshot(session, bucket_name, site):
+    """A snapshot sync after a plain sync changed the bucket lists it again instead of trusting the old snapshot."""
+    root = site({'index.html': 'A'})
+    assert BucketManager(session).sync(root, bucket_name, snapshot=True) == []
+
+    site({'index.html': 'B'})
+    assert BucketManager(session).sync(root, bucket_name) == []
+
+    site({'index.html': 'A'})
+    manager = BucketManager(session)
+    assert manager.sync(root, bucket_name, snapshot=True) == []
+
+    assert manager.changed_keys == ['index.html']
+    body = session.client('s3').get_object(Bucket=bucket_name, Key='index.html')['Body'].read()
+    assert body == b'A'
+
+
+def test_sync_changes_clears_the_snapshot_marker(session, bucket_name, site, bucket_keys):
+    """An incremental sync after a snapshot sync removes the marker before it changes anything."""
+    root = site({'index.html': 'home'})
+    manager = BucketManager(session)
+    assert manager.sync(root, bucket_name, snapshot=True) == []
+    assert BucketManager.SNAPSHOT_MARKER in bucket_keys()
+
+    site({'about.html': 'about'})
+    assert manager.sync_changes(root, bucket_name, ['about.html']) == []
+
+    assert bucket_keys() == ['about.html', 'index.html']
+
+
+def test_compressed_etags_are_cached(session, bucket_name, site):
+    """A second compressed sync of an unchanged tree hashes nothing, and uploads nothing."""
+    root = site({f"css/{index}.css": f"/* {index} */\n" + 'body { color: black; }\n' * 100 for index in range(5)})
+    assert BucketManager(session).sync(root, bucket_name, compression='gzip') == []
+
+    manager = BucketManager(session)
+    assert manager.sync(root, bucket_name, compression='gzip') == []
+
+    assert manager.metrics.counters.get('files_hashed', 0) == 0
+    assert manager.changed_keys == []
+    head = session.client('s3').head_object(Bucket=bucket_name, Key='css/0.css')
+    assert head['ContentEncoding'] == 'gzip'
+
+
+def test_headers_are_restored_after_a_sync_without_the_policy(session, bucket_name, site):
+    """A file uploaded without the header policy gets the policy's headers back on the next sync with it."""
+    policy = HeaderPolicy([{'match': '*.html', 'headers': {'CacheControl': 'no-cache'}}])
+    root = site({'index.html': 'home'})
+    assert BucketManager(session).sync(root, bucket_name, header_policy=policy) == []
+
+    site({'index.html': 'new home'})
+    assert BucketManager(session).sync(root, bucket_name) == []
+    assert 'CacheControl' not in session.client('s3').head_object(Bucket=bucket_name, Key='index.html')
+
+    manager = BucketManager(session)
+    assert manager.sync(root, bucket_name, header_policy=policy) == []
+
+    assert manager.changed_keys == ['index.html']
+    head = session.client('s3').head_object(Bucket=bucket_name, Key='index.html')
+    assert head['CacheControl'] == 'no-cache'
+
+
+def test_sync_keeps_objects_of_unreadable_directories(session, bucket_name, site, bucket_keys, monkeypatch):
+    """A directory that can't be read is reported, and the objects under it are left in the bucket."""
+    root = site({'index.html': 'home', 'private/a.html': 'a', 'private/sub/b.html': 'b'})
+    assert BucketManager(session).sync(root, bucket_name) == []
+
+    real_scandir = os.scandir
+
+    def scandir(path):
+        """Fail to list the private directory."""
+        if os.path.basename(path) == 'private':
+            raise PermissionError(13, 'Permission denied', path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', scandir)
+    errors = BucketManager(session).sync(root, bucket_name)
+
+    assert [key for key, _ in errors] == ['private/']
+    assert bucket_keys() == ['index.html', 'private/a.html', 'private/sub/b.html']
+
+
+def test_files_removed_after_upload_are_still_counted(session, bucket_name, site, bucket_keys, monkeypatch):
+    """Bytes are counted from the sizes seen when hashing, so a file gone once it was uploaded can't fail the sync."""
+    root = site({'index.html': 'home', 'copy.html': 'home', 'about.html': 'about us'})
+    real_upload_file = BucketManager.upload_file
+
+    def upload_file(self, bucket, path, key, etag):
+        """Upload the file, then remove it as an editor or build might."""
+        result = real_upload_file(self, bucket, path, key, etag)
+        os.remove(path)
+        return result
+
+    monkeypatch.setattr(BucketManager, 'upload_file', upload_file)
+    manager = BucketManager(session)
+
+    assert manager.sync(root, bucket_name) == []
+    assert bucket_keys() == ['about.html', 'copy.html', 'index.html']
+    assert manager.metrics.counters['bytes_uploaded'] == len('home') + len('about us')
+    assert manager.metrics.counters['bytes_copied'] == len('home')
+
+
+def test_reserved_prefix_is_private_and_left_alone(session, bucket_name, site, bucket_keys):
+    """The snapshot marker is kept out of the public policy, and no sync rules upload to or delete from its prefix."""
+    manager = BucketManager(session)
+    bucket = manager.s3.Bucket(bucket_name)
+    manager.set_policy(bucket)
+    statement, = json.loads(bucket.Policy().policy)['Statement']
+    assert statement['NotResource'] == [f"arn:aws:s3:::{bucket_name}/{RESERVED_PREFIX}*"]
+
+    root = site({'index.html': 'home', '.webinator/local.txt': 'not for the bucket'})
+    assert manager.sync(root, bucket_name, snapshot=True) == []
+    assert BucketManager.SNAPSHOT_MARKER.startswith(RESERVED_PREFIX)
+    assert bucket_keys() == [BucketManager.SNAPSHOT_MARKER, 'index.html']
+
+    site({'index.html': 'new home'})
+    assert BucketManager(session).sync(root, bucket_name, include=['*.html']) == []
+    session.client('s3').put_object(Bucket=bucket_name, Key=RESERVED_PREFIX + 'other', Body=b'')
+    assert BucketManager(session).sync(root, bucket_name) == []
+    assert bucket_keys() == [RESERVED_PREFIX + 'other', 'index.html']
+
+
+def count_parts(manager, fail=()):
+    """Note the number of every part manager uploads. Return them, failing the first try of each number in fail."""
+    numbers = []
+
+    def note_part(params, **kwargs):  # pylint: disable=unused-argument
+        """Record the part number, refusing it if it should fail."""
+        numbers.append(params['PartNumber'])
+        if params['PartNumber'] in fail and numbers.count(params['PartNumber']) == 1:
+            raise ClientError({'Error': {'Code': 'RequestTimeout', 'Message': 'timed out'}}, 'UploadPart')
+
+    manager.s3.meta.client.meta.events.register('before-parameter-build.s3.UploadPart', note_part)
+    return numbers
+
+
+def journal_entry(bucket_name, key):
+    """Get the journal's (upload id, etag, chunk size) for key, or None."""
+    journal = UploadJournal(bucket_name)
+    try:
+        return journal.get(key)
+    finally:
+        journal.close()
+
+
+def test_failed_part_is_resumed_by_the_next_sync(session, bucket_name, site):
+    """A large file whose part failed is completed by the next sync, which only sends the part that was missing."""
+    data = bytes(range(256)) * (5 * BucketManager.CHUNK_SIZE // 256)
+    root = site({'video.bin': data})
+    client = session.client('s3')
+
+    manager = BucketManager(session)
+    numbers = count_parts(manager, fail={3})
+    assert [key for key, _ in manager.sync(root, bucket_name)] == ['video.bin']
+    assert sorted(numbers) == [1, 2, 3, 4, 5]
+    assert journal_entry(bucket_name, 'video.bin') is not None
+
+    manager = BucketManager(session)
+    numbers = count_parts(manager)
+    assert manager.sync(root, bucket_name) == []
+
+    assert numbers == [3]
+    assert client.head_object(Bucket=bucket_name, Key='video.bin')['ETag'] == manager.local_manifest['video.bin']
+    # the interrupted upload was the one completed
+    assert client.list_multipart_uploads(Bucket=bucket_name).get('Uploads', []) == []
+    assert journal_entry(bucket_name, 'video.bin') is None
+
+
+def test_upload_of_an_older_version_is_aborted_not_resumed(session, bucket_name, site):
+    """An upload in the journal for other content is aborted, and the file is uploaded afresh."""
+    data = bytes(range(256)) * (2 * BucketManager.CHUNK_SIZE // 256)
+    root = site({'video.bin': data})
+    client = session.client('s3')
+
+    upload_id = client.create_multipart_upload(Bucket=bucket_name, Key='video.bin')['UploadId']
+    journal = UploadJournal(bucket_name)
+    journal.start('video.bin', upload_id, '"older-version-2"', BucketManager.CHUNK_SIZE)
+    journal.add_part(upload_id, 1, '"part"')
+    journal.close()
+
+    manager = BucketManager(session)
+    numbers = count_parts(manager)
+    assert manager.sync(root, bucket_name) == []
+
+    assert sorted(numbers) == [1, 2]
+    assert client.list_multipart_uploads(Bucket=bucket_name).get('Uploads', []) == []
+    assert journal_entry(bucket_name, 'video.bin') is None
+
+
+def test_upload_gone_from_s3_is_started_again(session, bucket_name, site):
+    """An upload in the journal that s3 no longer has (NoSuchUpload) is dropped, and the file is uploaded afresh."""
+    data = bytes(range(256)) * (2 * BucketManager.CHUNK_SIZE // 256)
+    root = site({'video.bin': data})
+    client = session.client('s3')
+
+    manager = BucketManager(session)
+    etag = manager.local_etag(str(root / 'video.bin'), 'video.bin')
+    upload_id = client.create_multipart_upload(Bucket=bucket_name, Key='video.bin')['UploadId']
+    part = client.upload_part(Bucket=bucket_name, Key='video.bin', UploadId=upload_id, PartNumber=1,
+                              Body=data[:BucketManager.CHUNK_SIZE])
+    journal = UploadJournal(bucket_name)
+    journal.start('video.bin', upload_id, etag, BucketManager.CHUNK_SIZE)
+    journal.add_part(upload_id, 1, part['ETag'])
+    journal.close()
+    client.abort_multipart_upload(Bucket=bucket_name, Key='video.bin', UploadId=upload_id)
+
+    numbers = count_parts(manager)
+    assert manager.sync(root, bucket_name) == []
+
+    assert sorted(numbers) == [1, 2]
+    assert client.head_object(Bucket=bucket_name, Key='video.bin')['ETag'] == etag
+    assert journal_entry(bucket_name, 'video.bin') is None
+
+
+def test_abort_stale_uploads_aborts_old_uploads_and_clears_the_journal(session, bucket_name):
+    """Uploads started before the cutoff are aborted and dropped from the journal, newer ones are left alone."""
+    client = session.client('s3')
+    journal = UploadJournal(bucket_name)
+    for key in ('a.bin', 'b.bin'):
+        upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key)['UploadId']
+        journal.start(key, upload_id, '"etag"', BucketManager.CHUNK_SIZE)
+    journal.close()
+    manager = BucketManager(session)
+
+    # moto dates every upload to 2010, so a cutoff a century back leaves them alone
+    assert manager.abort_stale_uploads(bucket_name, max_age_hours=24 * 365 * 100) == []
+    assert len(client.list_multipart_uploads(Bucket=bucket_name)['Uploads']) == 2
+
+    aborted = manager.abort_stale_uploads(bucket_name)
+
+    assert sorted(key for key, _ in aborted) == ['a.bin', 'b.bin']
+    assert client.list_multipart_uploads(Bucket=bucket_name).get('Uploads', []) == []
+    assert journal_entry(bucket_name, 'a.bin') is None
+    assert journal_entry(bucket_name, 'b.bin') is None
@@ -0,0 +1,91 @@
+"""Tests of the etag cache."""
+
+from types import SimpleNamespace
+
+from boto3.s3.transfer import TransferConfig
+
+import cache
+from cache import EtagCache
+
+MB = 1024 ** 2
+
+
+def file_stat(size=10, mtime=1000, inode=1):
+    """Build the parts of an os.stat_result the cache looks at."""
+    return SimpleNamespace(st_size=size, st_mtime_ns=mtime, st_ino=inode)
+
+
+def open_cache(root, chunk_size=8 * MB, **kwargs):
+    """Open the etag cache of root with the given multipart chunk size."""
+    return EtagCache(root, TransferConfig(multipart_chunksize=chunk_size, multipart_threshold=chunk_size), **kwargs)
+
+
+def test_unchanged_file_is_a_hit(tmp_path):
+    """An etag stored for a file is read back, after the cache is closed and opened again, while it is unchanged."""
+    etags = open_cache(tmp_path)
+    etags.put('index.html', file_stat(), '"abc"')
+    etags.close()
+
+    etags = open_cache(tmp_path)
+    assert etags.get('index.html', file_stat()) == '"abc"'
+    assert (etags.hits, etags.misses) == (1, 0)
+
+
+def test_changed_file_is_a_miss(tmp_path):
+    """A different size, mtime or inode means the file changed, so it has to be hashed again."""
+    etags = open_cache(tmp_path)
+    etags.put('index.html', file_stat(), '"abc"')
+
+    assert etags.get('index.html', file_stat(size=11)) is None
+    assert etags.get('index.html', file_stat(mtime=1001)) is None
+    assert etags.get('index.html', file_stat(inode=2)) is None
+    assert etags.get('other.html', file_stat()) is None
+    assert (etags.hits, etags.misses) == (0, 4)
+
+
+def test_rehash_bypasses_the_cache(tmp_path):
+    """With rehash every lookup is a miss, and the etags put are stored for the next sync."""
+    etags = open_cache(tmp_path)
+    etags.put('index.html', file_stat(), '"abc"')
+    etags.close()
+
+    etags = open_cache(tmp_path, rehash=True)
+    assert etags.get('index.html', file_stat()) is None
+    etags.put('index.html', file_stat(), '"def"')
+    etags.close()
+
+    assert open_cache(tmp_path).get('index.html', file_stat()) == '"def"'
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    """Past MAX_ENTRIES, the entries used longest ago are dropped when the cache is closed."""
+    monkeypatch.setattr(EtagCache, 'MAX_ENTRIES', 2)
+    clock = iter(range(100))
+    monkeypatch.setattr(cache, 'time', SimpleNamespace(time=lambda: next(clock)))
+
+    etags = open_cache(tmp_path)
+    for key in ('a.html', 'b.html', 'c.html'):
+        etags.put(key, file_stat(), f'"{key}"')
+    etags.get('a.html', file_stat())  # a.html is now the most recently used
+    etags.close()
+
+    etags = open_cache(tmp_path)
+    assert etags.get('a.html', file_stat()) == '"a.html"'
+    assert etags.get('b.html', file_stat()) is None
+    assert etags.get('c.html', file_stat()) == '"c.html"'
+
+
+def test_new_schema_or_transfer_settings_invalidate_entries(tmp_path, monkeypatch):
+    """Etags stored under another schema version or another multipart chunk size are never hits."""
+    etags = open_cache(tmp_path)
+    etags.put('big.bin', file_stat(), '"abc-2"')
+    etags.close()
+
+    etags = open_cache(tmp_path, chunk_size=16 * MB)
+    assert etags.get('big.bin', file_stat()) is None
+    etags.close()
+
+    monkeypatch.setattr(EtagCache, 'SCHEMA_VERSION', EtagCache.SCHEMA_VERSION + 1)
+    etags = open_cache(tmp_path)
+    assert etags.get('big.bin', file_stat()) is None
+    assert etags.connection.execute("SELECT COUNT(*) FROM etags").fetchone()[0] == 0
@@ -0,0 +1,142 @@
+"""Tests of the invalidation paths made from changed keys, of batching invalidations and of finding distributions."""
+
+from botocore.exceptions import ClientError
+
+from cache import IndexCache
+from cdn import (MAX_WILDCARD_PATHS, WILDCARD_MIN_FILES, DistributionManager, InvalidationQueue, coalesce_paths,
+                 object_paths)
+
+
+def test_index_pages_are_invalidated_with_their_directory():
+    """index.html is served for its directory too, and keys are url encoded with * escaped."""
+    assert object_paths('docs/index.html') == ['/docs/index.html', '/docs/']
+    assert object_paths('a b*.html') == ['/a%20b%2A.html']
+
+
+def test_few_changes_keep_their_own_paths():
+    """A handful of changed files are invalidated one by one."""
+    assert coalesce_paths(['index.html', 'css/site.css']) == ['/', '/css/site.css', '/index.html']
+
+
+def test_busy_directories_become_wildcards():
+    """A directory with WILDCARD_MIN_FILES changed files becomes one wildcard, files elsewhere stay as they are."""
+    keys = [f"img/{index}.png" for index in range(WILDCARD_MIN_FILES)] + ['about.html']
+
+    assert coalesce_paths(keys) == ['/about.html', '/img/*']
+
+
+def test_unrelated_files_keep_their_own_paths():
+    """Exact paths aren't held to the wildcard limit, many scattered changes are invalidated one by one."""
+    keys = [f"dir{index}/page.html" for index in range(40)]
+
+    assert coalesce_paths(keys) == sorted(f"/{key}" for key in keys)
+
+
+def test_paths_are_capped_deepest_directory_first():
+    """Past max_paths, the deepest directory holding several paths is merged first."""
+    keys = [f"a/b/{index}/app.js" for index in range(20)]
+
+    assert coalesce_paths(keys, max_paths=15) == ['/a/b/*']
+    assert coalesce_paths(keys + ['about.html'], max_paths=2) == ['/a/b/*', '/about.html']
+
+
+def test_wildcards_are_capped():
+    """Past max_wildcards busy directories are merged into wildcards further up, exact paths are kept."""
+    keys = [f"img/{group}/{index}.png"
+            for group in range(MAX_WILDCARD_PATHS + 1) for index in range(WILDCARD_MIN_FILES)]
+    keys += [f"docs/{group}/{index}.html" for group in range(3) for index in range(WILDCARD_MIN_FILES)]
+
+    paths = coalesce_paths(keys + ['about.html'])
+
+    assert paths == ['/about.html', '/docs/0/*', '/docs/1/*', '/docs/2/*', '/img/*']
+    assert len(coalesce_paths(keys, max_wildcards=1)) == 1
+
+
+class FakeDistributionManager:
+    """Stands in for DistributionManager, recording invalidations and reporting the status it is told to."""
+
+    def __init__(self):
+        """Create a FakeDistributionManager with nothing sent."""
+        self.sent = []
+        self.status = 'InProgress'
+        self.error = None
+        self.client = self
+
+    def invalidate(self, dist_id, keys):  # pylint: disable=unused-argument
+        """Record the keys, or fail with error if there is one."""
+        if self.error:
+            raise self.error
+        self.sent.append(list(keys))
+        return {'Id': f"I{len(self.sent)}", 'Status': 'InProgress'}
+
+    def get_invalidation(self, DistributionId, Id):  # pylint: disable=invalid-name,unused-argument
+        """Report the status of every invalidation as status."""
+        return {'Invalidation': {'Id': Id, 'Status': self.status}}
+
+
+def test_queue_holds_keys_back_while_an_invalidation_is_in_progress():
+    """Keys changed while the last invalidation runs are sent together once it has completed."""
+    dist_manager = FakeDistributionManager()
+    queue = InvalidationQueue(dist_manager, 'D1')
+
+    assert queue.add(['index.html']) == ({'Id': 'I1', 'Status': 'InProgress'}, ['index.html'])
+    assert queue.add(['a.html']) is None
+    assert queue.add(['b.html']) is None
+    assert dist_manager.sent == [['index.html']]
+
+    dist_manager.status = 'Completed'
+    assert queue.flush() == ({'Id': 'I2', 'Status': 'InProgress'}, ['a.html', 'b.html'])
+    assert queue.keys == set()
+
+
+def test_queue_keeps_keys_when_invalidating_fails():
+    """A failed invalidation is logged and its keys wait for the next try instead of raising."""
+    dist_manager = FakeDistributionManager()
+    dist_manager.error = ClientError({'Error': {'Code': 'TooManyInvalidationsInProgress', 'Message': 'busy'}},
+                                     'CreateInvalidation')
+    queue = InvalidationQueue(dist_manager, 'D1')
+
+    assert queue.add(['index.html']) is None
+    assert queue.keys == {'index.html'}
+
+    dist_manager.error = None
+    assert queue.add(['a.html'])[1] == ['a.html', 'index.html']
+
+
+def test_flush_without_waiting_sends_straight_away():
+    """flush(wait=False) sends the waiting keys even while an invalidation is in progress."""
+    dist_manager = FakeDistributionManager()
+    queue = InvalidationQueue(dist_manager, 'D1')
+    queue.add(['index.html'])
+    queue.add(['a.html'])
+
+    assert queue.flush(wait=False)[1] == ['a.html']
+    assert dist_manager.sent == [['index.html'], ['a.html']]
+
+
+CERT = {'CertificateArn': 'arn:aws:acm:us-east-1:123456789012:certificate/test'}
+
+
+def test_exact_alias_wins_over_wildcard_alias(session):
+    """An alias matching the name exactly is used before a wildcard alias one label up."""
+    IndexCache(f"distributions-{session.profile_name}").save({
+        'www.example.com': {'Id': 'EXACT'},
+        '*.example.com': {'Id': 'WILDCARD'},
+    })
+    manager = DistributionManager(session)
+
+    assert manager.find_matching_dist('WWW.example.com.')['Id'] == 'EXACT'
+    assert manager.find_matching_dist('shop.example.com')['Id'] == 'WILDCARD'
+
+
+def test_stale_cache_is_rebuilt_instead_of_creating_a_duplicate_dist(session):
+    """A distribution created after the alias index was cached is found by listing again."""
+    created = DistributionManager(session, refresh=True).create_dist('www.example.com', CERT)
+    # the index as another machine cached it before the distribution existed
+    IndexCache(f"distributions-{session.profile_name}").save({})
+
+    manager = DistributionManager(session)
+    dist = manager.find_matching_dist('www.example.com') or manager.create_dist('www.example.com', CERT)
+
+    assert dist['Id'] == created['Id']
+    assert session.client('cloudfront').list_distributions()['DistributionList']['Quantity'] == 1
@@ -0,0 +1,68 @@
+"""Tests of matching certificates through the SAN index."""
+
+from datetime import datetime, timezone
+
+from botocore.stub import Stubber
+
+from cache import IndexCache
+from certificate import CertificateManager
+
+OLD = 'arn:aws:acm:us-east-1:123456789012:certificate/old'
+NEW = 'arn:aws:acm:us-east-1:123456789012:certificate/new'
+WILDCARD = 'arn:aws:acm:us-east-1:123456789012:certificate/wildcard'
+
+
+def summary(arn, domain, names, expires):
+    """Build a list_certificates summary."""
+    return {'CertificateArn': arn, 'DomainName': domain, 'SubjectAlternativeNameSummaries': names,
+            'HasAdditionalSubjectAlternativeNames': False, 'NotAfter': datetime(expires, 1, 1, tzinfo=timezone.utc)}
+
+
+def cert_manager(session):
+    """Get a CertificateManager whose listing returns two certs for example.com and a wildcard one."""
+    manager = CertificateManager(session, refresh=True)
+    stubber = Stubber(manager.client)
+    stubber.add_response('list_certificates', {'CertificateSummaryList': [
+        summary(OLD, 'example.com', ['example.com', 'www.example.com'], 2030),
+        summary(NEW, 'example.com', ['example.com'], 2031),
+        summary(WILDCARD, '*.example.org', ['*.example.org'], 2030),
+    ]}, {'CertificateStatuses': ['ISSUED']})
+    stubber.activate()
+    return manager
+
+
+def test_find_prefers_the_certificate_expiring_last(session):
+    """Of two certificates covering a name, the one that expires last is used."""
+    manager = cert_manager(session)
+
+    assert manager.find_matching_cert('example.com')['CertificateArn'] == NEW
+    assert manager.find_matching_cert('www.example.com')['CertificateArn'] == OLD
+    assert manager.find_matching_cert('www.example.org')['CertificateArn'] == WILDCARD
+    assert manager.find_matching_cert('a.b.example.org') is None
+
+
+def test_every_covering_certificate_matches(session):
+    """cert_matches is True for any certificate covering the name, not only the one find_matching_cert picks."""
+    manager = cert_manager(session)
+
+    assert manager.cert_matches(OLD, 'example.com')
+    assert manager.cert_matches(NEW, 'EXAMPLE.com.')
+    assert manager.cert_matches(WILDCARD, 'shop.example.org')
+    assert not manager.cert_matches(NEW, 'www.example.com')
+    assert not manager.cert_matches(WILDCARD, 'example.com')
+
+
+def test_certificate_issued_since_the_index_was_cached_is_found(session):
+    """A miss on the index read from disk lists the certificates again before reporting no certificate."""
+    IndexCache(f"certificates-{session.profile_name}").save({'certificates': {}, 'covering': {}})
+    manager = CertificateManager(session)
+    stubber = Stubber(manager.client)
+    stubber.add_response('list_certificates', {'CertificateSummaryList': [
+        summary(NEW, 'example.com', ['example.com'], 2031),
+    ]}, {'CertificateStatuses': ['ISSUED']})
+    stubber.activate()
+
+    assert manager.find_matching_cert('example.com')['CertificateArn'] == NEW
+    # the index that was just listed is trusted, another miss doesn't list the certificates again
+    assert manager.find_matching_cert('example.org') is None
+    stubber.assert_no_pending_responses()
@@ -0,0 +1,53 @@
+"""Tests of the Compressor."""
+
+import gzip
+import os
+import time
+from pathlib import Path
+
+from compress import Compressor
+
+CSS = b'body { color: black; }\n' * 200
+
+
+def test_gzip_output_is_reproducible():
+    """The same input always compresses to the same bytes, so unchanged files keep their etag."""
+    compressor = Compressor('gzip')
+
+    data = compressor.compress_data(CSS)
+
+    assert data == compressor.compress_data(CSS)
+    assert gzip.decompress(data) == CSS
+    assert data[4:8] == b'\0\0\0\0'  # no timestamp in the header
+
+
+def test_only_worthwhile_files_are_compressed(tmp_path):
+    """Text files are compressed, small files and files that are already compressed aren't."""
+    compressor = Compressor('gzip')
+    css = tmp_path / 'site.css'
+    css.write_bytes(CSS)
+
+    compressed = compressor.compress(str(css), 'site.css', len(CSS), '"0123456789abcdef0123456789abcdef"')
+
+    assert gzip.decompress(Path(compressed).read_bytes()) == CSS
+    assert compressor.compress(str(css), 'logo.png', len(CSS), '"1"') is None
+    assert compressor.compress(str(css), 'tiny.css', Compressor.MIN_SIZE - 1, '"2"') is None
+
+
+def test_prune_removes_old_and_excess_copies(tmp_path):
+    """Copies unused for too long go, then the least recently used past the size cap, never ones in use."""
+    compressor = Compressor('gzip')
+    css = tmp_path / 'site.css'
+    css.write_bytes(CSS)
+    in_use = Path(compressor.compress(str(css), 'site.css', len(CSS), '"0123456789abcdef0123456789abcdef"'))
+
+    now = time.time()
+    for name, age_days in [('old.gzip', 40), ('recent.gzip', 1), ('older.gzip', 2), ('crashed.tmp', 40)]:
+        path = compressor.cache_dir / name
+        path.write_bytes(b'x' * 100)
+        os.utime(path, (now - age_days * 24 * 3600,) * 2)
+    os.utime(in_use, (now - 50 * 24 * 3600,) * 2)  # old, but used by this sync
+
+    assert compressor.prune(max_bytes=in_use.stat().st_size + 150) == 3
+
+    assert sorted(path.name for path in compressor.cache_dir.iterdir()) == sorted([in_use.name, 'recent.gzip'])
@@ -0,0 +1,119 @@
+"""Tests of uploading identical files once and copying them inside the bucket, against moto."""
+
+import pytest
+from botocore.exceptions import ClientError
+
+from bucket import BucketManager
+
+MB = 1024 ** 2
+
+
+@pytest.fixture
+def transfers(monkeypatch):
+    """Record the keys BucketManager uploads and the (key, source key) pairs it copies."""
+    recorded = {'uploads': [], 'copies': []}
+    real_upload_file = BucketManager.upload_file
+    real_copy_key = BucketManager.copy_key
+
+    def upload_file(self, bucket, path, key, etag=None):
+        """Note down the key being uploaded."""
+        recorded['uploads'].append(key)
+        return real_upload_file(self, bucket, path, key, etag)
+
+    def copy_key(self, bucket, source_key, key):
+        """Note down the key being copied and where from."""
+        recorded['copies'].append((key, source_key))
+        return real_copy_key(self, bucket, source_key, key)
+
+    monkeypatch.setattr(BucketManager, 'upload_file', upload_file)
+    monkeypatch.setattr(BucketManager, 'copy_key', copy_key)
+    return recorded
+
+
+def body(session, bucket_name, key):
+    """Read an object back from the bucket."""
+    return session.client('s3').get_object(Bucket=bucket_name, Key=key)['Body'].read()
+
+
+def test_identical_files_are_uploaded_once(session, bucket_name, site, bucket_keys, transfers):
+    """Of several files with the same content, the first is uploaded and the others are copied from it."""
+    root = site({'a/logo.svg': '<svg/>', 'b/logo.svg': '<svg/>', 'c/logo.svg': '<svg/>', 'index.html': 'home'})
+    manager = BucketManager(session)
+
+    assert manager.sync(root, bucket_name) == []
+
+    assert sorted(transfers['uploads']) == ['a/logo.svg', 'index.html']
+    assert sorted(transfers['copies']) == [('b/logo.svg', 'a/logo.svg'), ('c/logo.svg', 'a/logo.svg')]
+    assert bucket_keys() == ['a/logo.svg', 'b/logo.svg', 'c/logo.svg', 'index.html']
+    assert body(session, bucket_name, 'c/logo.svg') == b'<svg/>'
+    assert sorted(manager.changed_keys) == bucket_keys()
+
+
+def test_copies_come_from_objects_already_in_the_bucket(session, bucket_name, site, bucket_keys, transfers):
+    """A new file whose content an unchanged object already has is copied from that object."""
+    root = site({'v1/app.js': 'console.log(1)'})
+    assert BucketManager(session).sync(root, bucket_name) == []
+    transfers['uploads'].clear()
+
+    site({'v2/app.js': 'console.log(1)'})
+    assert BucketManager(session).sync(root, bucket_name) == []
+
+    assert transfers['uploads'] == []
+    assert transfers['copies'] == [('v2/app.js', 'v1/app.js')]
+    assert bucket_keys() == ['v1/app.js', 'v2/app.js']
+
+
+def test_objects_being_deleted_arent_copied_from(session, bucket_name, site, bucket_keys, transfers):
+    """An object the sync is about to delete is no source for a copy, the renamed file is uploaded."""
+    root = site({'old.css': 'body {}'})
+    assert BucketManager(session).sync(root, bucket_name) == []
+    transfers['uploads'].clear()
+
+    (root / 'old.css').rename(root / 'new.css')
+    assert BucketManager(session).sync(root, bucket_name) == []
+
+    assert transfers['uploads'] == ['new.css']
+    assert transfers['copies'] == []
+    assert bucket_keys() == ['new.css']
+
+
+def test_failed_source_upload_falls_back_to_uploading(session, bucket_name, site, bucket_keys, transfers,
+                                                      monkeypatch):
+    """When the upload a copy depends on fails, the copy's key is uploaded itself."""
+    root = site({'a.txt': 'same', 'b.txt': 'same'})
+    recording_upload_file = BucketManager.upload_file
+
+    def upload_file(self, bucket, path, key, etag=None):
+        """Fail to upload a.txt, the source of the copy."""
+        if key == 'a.txt':
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'boom'}}, 'PutObject')
+        return recording_upload_file(self, bucket, path, key, etag)
+
+    monkeypatch.setattr(BucketManager, 'upload_file', upload_file)
+    manager = BucketManager(session)
+    errors = manager.sync(root, bucket_name)
+
+    assert [key for key, _ in errors] == ['a.txt']
+    assert transfers['uploads'] == ['b.txt']
+    assert transfers['copies'] == []
+    assert bucket_keys() == ['b.txt']
+    assert manager.changed_keys == ['b.txt']
+
+
+def test_multipart_copy_keeps_the_local_etag(session, bucket_name, site, transfers):
+    """A large file copied inside the bucket ends up with the multipart etag it was hashed to locally."""
+    content = bytes(range(256)) * (20 * MB // 256)
+    root = site({'video/a.bin': content, 'video/b.bin': content})
+    manager = BucketManager(session)
+
+    assert manager.sync(root, bucket_name) == []
+
+    assert transfers['copies'] == [('video/b.bin', 'video/a.bin')]
+    etag = session.client('s3').head_object(Bucket=bucket_name, Key='video/b.bin')['ETag']
+    assert '-' in etag
+    assert etag == manager.local_manifest['video/b.bin']
+
+    # so the next sync sees nothing to do
+    manager = BucketManager(session)
+    assert manager.sync(root, bucket_name) == []
+    assert manager.changed_keys == []
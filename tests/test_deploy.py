@@ -0,0 +1,32 @@
+"""Tests of SiteDeployer against moto."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from bucket import BucketManager
+from deploy import SiteDeployer
+
+
+def test_sites_deploy_concurrently_on_their_own_resources(session, site, monkeypatch):
+    """Sites set up and sync their buckets from several threads, each through its own resource on one client."""
+    root = site({'index.html': 'home', 'css/site.css': 'body {}'})
+    shared = BucketManager(session, workers=4)
+    deployer = SiteDeployer(shared, None, None, None, workers=4)
+
+    managers = []
+    real_init = BucketManager.__init__
+
+    def init(self, *args, **kwargs):
+        """Note down every BucketManager the deployer creates."""
+        real_init(self, *args, **kwargs)
+        managers.append(self)
+
+    monkeypatch.setattr(BucketManager, '__init__', init)
+    sites = [{'bucket': f"site-{index}.example.com", 'root': str(root), 'region': 'us-west-2', 'domain': None,
+              'cdn': False} for index in range(6)]
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        results = list(executor.map(deployer.deploy_site, sites))
+
+    assert [result['failed_step'] for result in results] == [None] * 6
+    assert [result['changed'] for result in results] == [2] * 6
+    assert len({id(manager.s3) for manager in managers} | {id(shared.s3)}) == 7
+    assert all(manager.s3.meta.client is shared.s3.meta.client for manager in managers)
@@ -0,0 +1,181 @@
+"""Tests of finding hosted zones through the zone trie, and of batching record changes."""
+
+from types import SimpleNamespace
+
+import dns
+from cache import IndexCache
+from dns import DomainManager
+
+
+def zone(name, zone_id, private=False):
+    """Build a list_hosted_zones entry."""
+    return {'Id': f"/hostedzone/{zone_id}", 'Name': name, 'Config': {'PrivateZone': private}}
+
+
+def zone_trie(*zones):
+    """Build a trie holding zones."""
+    trie = {}
+    for entry in zones:
+        DomainManager.add_zone(trie, entry)
+    return trie
+
+
+def test_only_whole_labels_match():
+    """A name matches a zone a label at a time, example.com isn't in zone ample.com."""
+    trie = zone_trie(zone('ample.com.', 'AMPLE'))
+
+    assert DomainManager.lookup_zone(trie, 'example.com') is None
+    assert DomainManager.lookup_zone(trie, 'www.ample.com')['Id'] == '/hostedzone/AMPLE'
+
+
+def test_longest_zone_wins():
+    """Of the zones containing a name, the one with the most labels is used."""
+    trie = zone_trie(zone('example.com.', 'OUTER'), zone('b.example.com.', 'INNER'))
+
+    assert DomainManager.lookup_zone(trie, 'a.b.example.com')['Id'] == '/hostedzone/INNER'
+    assert DomainManager.lookup_zone(trie, 'A.example.com.')['Id'] == '/hostedzone/OUTER'
+
+
+def test_public_zone_wins_over_private_zone():
+    """A public and a private zone with the same name resolve to the public one, whichever is listed first."""
+    for zones in ([zone('example.com.', 'PRIVATE', True), zone('example.com.', 'PUBLIC')],
+                  [zone('example.com.', 'PUBLIC'), zone('example.com.', 'PRIVATE', True)]):
+        assert DomainManager.lookup_zone(zone_trie(*zones), 'www.example.com')['Id'] == '/hostedzone/PUBLIC'
+
+
+def test_stale_cache_is_rebuilt_instead_of_creating_a_duplicate_zone(session):
+    """A zone created after the trie was cached is found by listing again, rather than created a second time."""
+    IndexCache(f"zones-{session.profile_name}").save({})
+    session.client('route53').create_hosted_zone(Name='example.com.', CallerReference='elsewhere')
+
+    manager = DomainManager(session)
+    found = manager.find_hosted_zone('www.example.com') or manager.create_hosted_zone('www.example.com')
+
+    assert found['Name'] == 'example.com.'
+    assert len(session.client('route53').list_hosted_zones()['HostedZones']) == 1
+    assert DomainManager.lookup_zone(IndexCache(f"zones-{session.profile_name}").load(), 'example.com')
+
+
+def test_fresh_listing_isnt_repeated_on_a_miss(session, monkeypatch):
+    """A trie that was just listed is trusted, a name with no zone doesn't list the zones again."""
+    manager = DomainManager(session, refresh=True)
+    listings = []
+    real_build = manager.build_zone_trie
+    monkeypatch.setattr(manager, 'build_zone_trie', lambda: listings.append(1) or real_build())
+
+    assert manager.find_hosted_zone('www.example.com') is None
+    assert manager.find_hosted_zone('www.example.org') is None
+    assert len(listings) == 1
+
+
+class FakeRoute53:
+    """Stands in for the route53 client, recording change batches and reporting changes INSYNC after polls."""
+
+    def __init__(self, polls_until_insync=1):
+        """Create a FakeRoute53 with nothing sent."""
+        self.batches = []
+        self.polls = {}
+        self.polls_until_insync = polls_until_insync
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):  # pylint: disable=invalid-name
+        """Record the batch and give it a change id."""
+        self.batches.append((HostedZoneId, ChangeBatch['Changes']))
+        return {'ChangeInfo': {'Id': f"/change/C{len(self.batches)}", 'Status': 'PENDING'}}
+
+    def get_change(self, Id):  # pylint: disable=invalid-name
+        """Report a change PENDING until it has been polled polls_until_insync times."""
+        self.polls[Id] = self.polls.get(Id, 0) + 1
+        status = 'INSYNC' if self.polls[Id] > self.polls_until_insync else 'PENDING'
+        return {'ChangeInfo': {'Id': Id, 'Status': status}}
+
+
+def deferring_manager(session, client):
+    """Get a DomainManager sending its changes to client."""
+    manager = DomainManager(session)
+    manager.route53_client = client
+    return manager
+
+
+def record(change):
+    """Get (name, type, alias target) of a queued change."""
+    record_set = change['ResourceRecordSet']
+    return record_set['Name'], record_set['Type'], record_set['AliasTarget']['DNSName']
+
+
+def test_deferred_changes_are_sent_per_zone(session):
+    """Changes queued for several sites go out in one batch per zone."""
+    client = FakeRoute53()
+    manager = deferring_manager(session, client)
+    first, second = zone('example.com.', 'ONE'), zone('example.org.', 'TWO')
+    endpoint = SimpleNamespace(dns_zone='Z3BJ6K6RIION7M', host='s3-website-us-west-2.amazonaws.com')
+
+    assert manager.create_s3_domain_record(first, 'www.example.com', endpoint, defer=True) is None
+    manager.create_s3_domain_record(second, 'www.example.org', endpoint, defer=True)
+    manager.create_s3_domain_record(first, 'docs.example.com', endpoint, defer=True)
+    assert client.batches == []
+
+    change_ids, failed = manager.flush_changes()
+
+    assert failed == []
+    assert change_ids == ['/change/C1', '/change/C2']
+    assert [(zone_id, [record(change)[0] for change in changes]) for zone_id, changes in client.batches] == [
+        ('/hostedzone/ONE', ['www.example.com', 'docs.example.com']),
+        ('/hostedzone/TWO', ['www.example.org']),
+    ]
+    assert manager.pending == {}
+
+
+def test_large_batches_are_split(session):
+    """A zone with more than MAX_BATCH_CHANGES queued changes is sent in several batches."""
+    client = FakeRoute53()
+    manager = deferring_manager(session, client)
+    endpoint = SimpleNamespace(dns_zone='Z3BJ6K6RIION7M', host='s3-website-us-west-2.amazonaws.com')
+    for index in range(DomainManager.MAX_BATCH_CHANGES + 1):
+        manager.create_s3_domain_record(zone('example.com.', 'ONE'), f"site{index}.example.com", endpoint, defer=True)
+
+    change_ids, _ = manager.flush_changes()
+
+    assert len(change_ids) == 2
+    assert [len(changes) for _, changes in client.batches] == [DomainManager.MAX_BATCH_CHANGES, 1]
+
+
+def test_later_change_to_a_record_replaces_the_queued_one(session):
+    """A record can only be changed once per batch, so the last UPSERT queued for a name and type wins."""
+    client = FakeRoute53()
+    manager = deferring_manager(session, client)
+    example = zone('example.com.', 'ONE')
+
+    manager.create_cf_domain_record(example, 'www.example.com', 'old.cloudfront.net', defer=True)
+    manager.create_cf_domain_record(example, 'WWW.example.com.', 'new.cloudfront.net', defer=True)
+    manager.flush_changes()
+
+    (_, changes), = client.batches
+    assert [record(change) for change in changes] == [
+        ('WWW.example.com.', 'A', 'new.cloudfront.net'),
+        ('WWW.example.com.', 'AAAA', 'new.cloudfront.net'),
+    ]
+
+
+def test_cloudfront_records_are_an_a_and_aaaa_pair(session):
+    """A distribution gets an A and an AAAA alias record, both pointing at it."""
+    client = FakeRoute53()
+    manager = deferring_manager(session, client)
+
+    manager.create_cf_domain_record(zone('example.com.', 'ONE'), 'www.example.com', 'd1.cloudfront.net')
+
+    (_, changes), = client.batches
+    assert [record(change) for change in changes] == [
+        ('www.example.com', 'A', 'd1.cloudfront.net'),
+        ('www.example.com', 'AAAA', 'd1.cloudfront.net'),
+    ]
+    assert {change['ResourceRecordSet']['AliasTarget']['HostedZoneId'] for change in changes} == {'Z2FDTNDATAQYW2'}
+
+
+def test_await_changes_polls_every_change_until_insync(session, monkeypatch):
+    """Every change id is polled each round until all of them are INSYNC."""
+    client = FakeRoute53(polls_until_insync=2)
+    manager = deferring_manager(session, client)
+    monkeypatch.setattr(dns.time, 'sleep', lambda seconds: None)
+
+    assert manager.await_changes(['/change/C1', '/change/C2']) == []
+    assert client.polls == {'/change/C1': 3, '/change/C2': 3}
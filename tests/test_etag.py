@@ -0,0 +1,57 @@
+"""Tests of the etags generated for local files."""
+
+from hashlib import md5
+
+from boto3.s3.transfer import TransferConfig
+
+from etag import MAX_PARTS, MIN_CHUNK_SIZE, adjust_chunk_size, file_etag, parts_etag
+
+MB = 1024 ** 2
+
+
+def test_single_part_etag_is_the_md5(tmp_path):
+    """A file under the threshold gets the quoted md5 of its contents."""
+    path = tmp_path / 'index.html'
+    path.write_bytes(b'<html></html>')
+
+    assert file_etag(path, 8 * MB, 8 * MB) == f'"{md5(b"<html></html>").hexdigest()}"'
+
+
+def test_empty_file_etag(tmp_path):
+    """An empty file gets the md5 of nothing."""
+    path = tmp_path / 'empty'
+    path.write_bytes(b'')
+
+    assert file_etag(path, 8 * MB, 8 * MB) == f'"{md5().hexdigest()}"'
+
+
+def test_multipart_etag_matches_s3(tmp_path, session, bucket_name):
+    """A file over the threshold gets the same etag S3 gives it once uploaded in parts."""
+    path = tmp_path / 'video.bin'
+    # spanning a few read buffers and ending part way through a part
+    path.write_bytes(bytes(range(256)) * (12 * MB // 256) + b'tail')
+    config = TransferConfig(multipart_chunksize=MIN_CHUNK_SIZE, multipart_threshold=MIN_CHUNK_SIZE)
+
+    client = session.client('s3')
+    client.upload_file(str(path), bucket_name, 'video.bin', Config=config)
+    expected = client.head_object(Bucket=bucket_name, Key='video.bin')['ETag']
+
+    assert file_etag(path, MIN_CHUNK_SIZE, MIN_CHUNK_SIZE) == expected
+    assert expected.endswith('-3"')
+
+
+def test_parts_etag_combines_part_md5s():
+    """The etags of the parts give the same etag as hashing the file part by part."""
+    parts = [b'a' * 10, b'b' * 10]
+    combined = md5(b''.join(md5(part).digest() for part in parts)).hexdigest()
+
+    assert parts_etag([f'"{md5(part).hexdigest()}"' for part in parts]) == f'"{combined}-2"'
+
+
+def test_chunk_size_only_grows_past_the_part_limit():
+    """Files keep the part size asked for until they'd need more than MAX_PARTS parts, like s3transfer."""
+    assert adjust_chunk_size(8 * MB, 100 * MB) == 8 * MB
+    assert adjust_chunk_size(8 * MB, 8 * MB * MAX_PARTS) == 8 * MB
+    assert adjust_chunk_size(8 * MB, 8 * MB * MAX_PARTS + 1) == 16 * MB
+    # s3transfer never goes below its minimum part size
+    assert adjust_chunk_size(1 * MB, 100 * MB) == MIN_CHUNK_SIZE
@@ -0,0 +1,81 @@
+"""Tests of listing a bucket concurrently by partitions of its keyspace, against moto."""
+
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+from bucket import BucketManager
+
+
+@pytest.fixture
+def put_keys(session, bucket_name):
+    """Get a function putting an empty object at each key."""
+    def put(keys):
+        """Put the objects."""
+        client = session.client('s3')
+        for key in keys:
+            client.put_object(Bucket=bucket_name, Key=key, Body=b'')
+
+    return put
+
+
+def test_keys_without_a_slash_are_found_while_discovering(session, bucket_name, put_keys):
+    """Objects at the top level come back from discovery, the directories beside them become partitions."""
+    put_keys(['index.html', 'about.html', 'css/site.css', 'img/logo.png'])
+    manager = BucketManager(session, workers=4)
+
+    partitions, objects = manager.discover_partitions(bucket_name)
+
+    assert partitions == ['css/', 'img/']
+    assert sorted(obj['Key'] for obj in objects) == ['about.html', 'index.html']
+    assert sorted(obj['Key'] for obj in manager.iter_objects(bucket_name)) == [
+        'about.html', 'css/site.css', 'img/logo.png', 'index.html']
+
+
+def test_discovery_descends_through_a_single_prefix(session, bucket_name, put_keys):
+    """When everything is under one directory, that directory is split instead."""
+    put_keys(['site/index.html', 'site/css/site.css', 'site/js/app.js'])
+
+    partitions, objects = BucketManager(session).discover_partitions(bucket_name)
+
+    assert partitions == ['site/css/', 'site/js/']
+    assert [obj['Key'] for obj in objects] == ['site/index.html']
+
+
+def test_listing_stays_under_the_prefix(session, bucket_name, put_keys):
+    """Only keys starting with the prefix are listed."""
+    put_keys(['index.html', 'docs/a.html', 'docs/v1/b.html', 'docs/v2/c.html', 'docsite.html'])
+
+    keys = sorted(obj['Key'] for obj in BucketManager(session, workers=2).iter_objects(bucket_name, 'docs/'))
+
+    assert keys == ['docs/a.html', 'docs/v1/b.html', 'docs/v2/c.html']
+
+
+def test_closing_the_listing_early_doesnt_hang(session, bucket_name, put_keys):
+    """A consumer that stops part way leaves no worker blocked on the full queue."""
+    put_keys([f"dir{index:02d}/page.html" for index in range(20)])
+    objects = BucketManager(session, workers=1).iter_objects(bucket_name)
+    next(objects)
+
+    closer = threading.Thread(target=objects.close, daemon=True)
+    closer.start()
+    closer.join(timeout=30)
+
+    assert not closer.is_alive()
+
+
+def test_worker_errors_reach_the_consumer(session, bucket_name, put_keys):
+    """A partition that fails to list raises its error from the generator instead of being dropped."""
+    put_keys(['a/1.html', 'b/2.html', 'c/3.html'])
+    manager = BucketManager(session, workers=3)
+
+    def fail_partition_b(params, **kwargs):  # pylint: disable=unused-argument
+        """Refuse to list b/ once discovery is done (discovery lists with a delimiter)."""
+        if params.get('Prefix') == 'b/' and 'Delimiter' not in params:
+            raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'denied'}}, 'ListObjectsV2')
+
+    manager.s3.meta.client.meta.events.register('before-parameter-build.s3.ListObjectsV2', fail_partition_b)
+
+    with pytest.raises(ClientError, match='AccessDenied'):
+        list(manager.iter_objects(bucket_name))
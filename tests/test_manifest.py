@@ -0,0 +1,49 @@
+"""Tests of the compact Manifest."""
+
+import pytest
+
+from manifest import Manifest, pack_etag, unpack_etag
+
+SINGLE = '"0123456789abcdef0123456789abcdef"'
+MULTIPART = '"fedcba9876543210fedcba9876543210-12"'
+KMS = '"not-an-md5-etag"'
+
+
+def test_etags_round_trip_through_records():
+    """md5 etags, with or without a part count, come back exactly as S3 reported them."""
+    assert unpack_etag(pack_etag(SINGLE)) == SINGLE
+    assert unpack_etag(pack_etag(MULTIPART)) == MULTIPART
+    assert pack_etag(KMS) is None
+
+
+def test_manifest_behaves_like_a_dict():
+    """Keys set in any order, replaced and removed give the same answers a dict would."""
+    manifest, expected = Manifest(), {}
+    for key, etag in [('b/2.html', SINGLE), ('a.html', MULTIPART), ('b/1.html', KMS), ('b/3.html', SINGLE),
+                      ('b/2.html', MULTIPART), ('b/1.html', SINGLE)]:
+        manifest[key] = etag
+        expected[key] = etag
+
+    assert len(manifest) == len(expected)
+    assert dict(manifest.items()) == expected
+    assert sorted(manifest) == sorted(expected)
+    assert 'b/2.html' in manifest and 'b/4.html' not in manifest
+    assert manifest.get('missing', 'default') == 'default'
+
+    assert manifest.pop('b/1.html') == SINGLE
+    del manifest['a.html']
+    assert dict(manifest.items()) == {'b/2.html': MULTIPART, 'b/3.html': SINGLE}
+    with pytest.raises(KeyError):
+        manifest['a.html']  # pylint: disable=pointless-statement
+
+
+def test_other_etags_replace_md5_ones():
+    """A key that switches to an etag that isn't an md5 is only stored once."""
+    manifest = Manifest()
+    manifest['key'] = SINGLE
+    manifest['key'] = KMS
+
+    assert len(manifest) == 1
+    assert manifest['key'] == KMS
+    assert manifest.pop('key') == KMS
+    assert len(manifest) == 0
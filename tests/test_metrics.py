@@ -0,0 +1,143 @@
+"""Tests of SyncMetrics, the timers, counters and request latencies of a sync."""
+
+import json
+import os
+from types import SimpleNamespace
+
+from botocore.hooks import HierarchicalEmitter
+
+import metrics
+from bucket import BucketManager
+from metrics import LATENCY_BUCKETS, THROTTLE_CODES, SyncMetrics
+
+
+def test_phases_add_up_and_reset_clears_them(monkeypatch):
+    """Time spent in a phase is added to any earlier time in it, counters add up too."""
+    clock = iter([0.0, 1.5, 10.0, 10.25, 20.0, 23.0])
+    monkeypatch.setattr(metrics.time, 'perf_counter', lambda: next(clock))
+    sync_metrics = SyncMetrics()
+
+    with sync_metrics.phase('hash'):
+        pass
+    with sync_metrics.phase('hash'):
+        pass
+    with sync_metrics.phase('apply'):
+        sync_metrics.count('files_uploaded')
+        sync_metrics.count('bytes_uploaded', 300)
+        sync_metrics.count('bytes_uploaded', 200)
+
+    assert sync_metrics.phases == {'hash': 1.75, 'apply': 3.0}
+    assert sync_metrics.counters == {'files_uploaded': 1, 'bytes_uploaded': 500}
+
+    sync_metrics.reset()
+    assert (sync_metrics.phases, sync_metrics.counters, sync_metrics.latencies) == ({}, {}, {})
+
+
+def fake_client():
+    """Get something with the client.meta.events a SyncMetrics attaches to."""
+    return SimpleNamespace(meta=SimpleNamespace(events=HierarchicalEmitter()))
+
+
+def send(client, operation, attempt=1, error_code=None):
+    """Fire the events of one attempt at operation, as botocore would."""
+    context = {'retries': {'attempt': attempt}}
+    client.meta.events.emit(f"before-send.s3.{operation}", request=SimpleNamespace(context=context))
+    response = {'Error': {'Code': error_code}} if error_code else {}
+    client.meta.events.emit(f"response-received.s3.{operation}", context=context, parsed_response=response)
+
+
+def test_requests_retries_and_throttles_are_counted():
+    """Every attempt's latency is recorded, retried attempts and throttled ones are counted per operation."""
+    client = fake_client()
+    sync_metrics = SyncMetrics()
+    sync_metrics.attach(client)
+
+    send(client, 'PutObject', error_code='SlowDown')
+    send(client, 'PutObject', attempt=2)
+    send(client, 'ListObjectsV2', error_code='AccessDenied')
+
+    assert 'SlowDown' in THROTTLE_CODES
+    assert sync_metrics.latencies['PutObject'].count == 2
+    assert sync_metrics.latencies['ListObjectsV2'].count == 1
+    assert sync_metrics.retries == {'PutObject': 1}
+    assert sync_metrics.throttles == {'PutObject': 1}
+
+
+def test_real_requests_are_timed(session, bucket_name):
+    """The hooks on a real client time its requests."""
+    client = session.client('s3')
+    sync_metrics = SyncMetrics()
+    sync_metrics.attach(client)
+
+    client.put_object(Bucket=bucket_name, Key='index.html', Body=b'home')
+    client.head_object(Bucket=bucket_name, Key='index.html')
+
+    assert sorted(sync_metrics.latencies) == ['HeadObject', 'PutObject']
+    assert sync_metrics.latencies['PutObject'].count == 1
+
+
+def test_shared_client_is_only_counted_once(session, bucket_name):
+    """A manager sharing another's client doesn't hook it again, so each request is recorded once."""
+    shared = BucketManager(session)
+    site_manager = BucketManager(session, s3=shared.s3)
+    shared.metrics.reset()
+
+    site_manager.s3.meta.client.head_bucket(Bucket=bucket_name)
+
+    assert shared.metrics.latencies['HeadBucket'].count == 1
+    assert site_manager.metrics.latencies == {}
+
+
+def filled_metrics():
+    """Get a SyncMetrics with a phase, a counter and some requests in it."""
+    client = fake_client()
+    sync_metrics = SyncMetrics()
+    sync_metrics.attach(client)
+    sync_metrics.phases['hash'] = 1.25
+    sync_metrics.count('files_uploaded', 3)
+    send(client, 'PutObject')
+    send(client, 'PutObject', attempt=2, error_code='SlowDown')
+    return sync_metrics
+
+
+def test_json_report_shape(tmp_path):
+    """The JSON report has the phases, counters and per operation request statistics."""
+    path = tmp_path / 'metrics.json'
+    filled_metrics().save_json(path)
+
+    report = json.loads(path.read_text(encoding='utf-8'))
+    assert sorted(report) == ['counters', 'phases', 'requests', 'started']
+    assert report['phases'] == {'hash': 1.25}
+    assert report['counters'] == {'files_uploaded': 3}
+    put = report['requests']['PutObject']
+    assert sorted(put) == ['count', 'p50', 'p90', 'p99', 'retries', 'seconds', 'throttles']
+    assert (put['count'], put['retries'], put['throttles']) == (2, 1, 1)
+    assert put['p50'] in LATENCY_BUCKETS
+
+
+def test_prometheus_textfile_is_replaced_whole(tmp_path, monkeypatch):
+    """The textfile is written beside the target and moved over it, in the Prometheus text format."""
+    path = tmp_path / 'webinator.prom'
+    path.write_text('old\n', encoding='utf-8')
+    replaced = []
+    real_replace = os.replace
+
+    def replace(source, target):
+        """Note down the file being replaced."""
+        replaced.append(target)
+        real_replace(source, target)
+
+    monkeypatch.setattr(metrics.os, 'replace', replace)
+
+    filled_metrics().save_prometheus(path, {'bucket': 'www.example.com'})
+
+    assert replaced == [path]
+    assert os.listdir(tmp_path) == ['webinator.prom']
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert '# TYPE webinator_sync_phase_seconds gauge' in lines
+    assert 'webinator_sync_phase_seconds{bucket="www.example.com",phase="hash"} 1.25' in lines
+    assert 'webinator_sync_total{bucket="www.example.com",counter="files_uploaded"} 3' in lines
+    assert 'webinator_request_seconds_bucket{bucket="www.example.com",operation="PutObject",le="+Inf"} 2' in lines
+    assert 'webinator_request_seconds_count{bucket="www.example.com",operation="PutObject"} 2' in lines
+    assert 'webinator_request_retries_total{bucket="www.example.com",operation="PutObject"} 1' in lines
+    assert 'webinator_request_throttles_total{bucket="www.example.com",operation="PutObject"} 1' in lines
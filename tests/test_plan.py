@@ -0,0 +1,35 @@
+"""Tests of diff_manifests."""
+
+from plan import diff_manifests
+
+
+def test_diff_sorts_keys_into_uploads_skips_and_deletes():
+    """New and changed keys are uploaded, matching ones skipped and remote only ones deleted."""
+    local = {'index.html': '"a"', 'about.html': '"b"', 'new.html': '"c"'}
+    remote = {'index.html': '"a"', 'about.html': '"old"', 'gone.html': '"d"'}
+
+    plan = diff_manifests(local, remote)
+
+    assert plan.uploads == ['about.html', 'new.html']
+    assert plan.skips == ['index.html']
+    assert plan.deletes == ['gone.html']
+    assert plan.updates == () and plan.copies == ()
+
+
+def test_diff_leaves_unselected_keys_alone():
+    """Remote keys selects rejects are never deleted."""
+    remote = {'keep/log.txt': '"a"', 'gone.html': '"b"'}
+
+    plan = diff_manifests({}, remote, lambda key: not key.startswith('keep/'))
+
+    assert plan.deletes == ['gone.html']
+
+
+def test_diff_of_matching_manifests_is_empty():
+    """Nothing to do when both sides match."""
+    manifest = {'index.html': '"a"', 'css/site.css': '"b"'}
+
+    plan = diff_manifests(manifest, dict(manifest))
+
+    assert plan.uploads == [] and plan.deletes == []
+    assert plan.skips == ['css/site.css', 'index.html']
@@ -0,0 +1,46 @@
+"""Tests of matching keys to header rules."""
+
+import pytest
+
+from policy import HeaderPolicy
+
+NO_CACHE = {'CacheControl': 'no-cache'}
+IMMUTABLE = {'CacheControl': 'public, max-age=31536000, immutable'}
+DEFAULT = {'CacheControl': 'public, max-age=3600'}
+
+
+def test_first_matching_rule_wins():
+    """Rules are checked in order, globs against the whole key and regexes searched for in it."""
+    policy = HeaderPolicy([
+        {'match': '*.html', 'headers': NO_CACHE},
+        {'regex': r'\.[0-9a-f]{8,}\.(?:js|css)$', 'headers': IMMUTABLE},
+        {'match': 'assets/*', 'headers': DEFAULT},
+    ])
+
+    assert policy.regex is not None
+    assert policy.headers_for('docs/index.html') == NO_CACHE
+    assert policy.headers_for('assets/app.0123abcd.js') == IMMUTABLE
+    assert policy.headers_for('assets/logo.png') == DEFAULT
+    assert policy.headers_for('robots.txt') == {}
+
+
+def test_regexes_with_groups_keep_their_meaning():
+    """Numbered groups and backreferences match as they would on their own, the rules aren't folded together."""
+    policy = HeaderPolicy([
+        {'match': '*.html', 'headers': NO_CACHE},
+        {'regex': r'/(\w+)/\1\.(js|css)$', 'headers': IMMUTABLE},
+        {'match': '*', 'headers': DEFAULT},
+    ])
+
+    assert policy.regex is None
+    assert policy.headers_for('index.html') == NO_CACHE
+    assert policy.headers_for('lib/app/app.js') == IMMUTABLE
+    assert policy.headers_for('lib/app/other.js') == DEFAULT
+
+
+def test_invalid_rules_are_rejected():
+    """A broken regex or a header that can't be set is reported with the rule's number."""
+    with pytest.raises(ValueError, match='Rule 2 has an invalid regex'):
+        HeaderPolicy([{'match': '*', 'headers': DEFAULT}, {'regex': r'\1(', 'headers': DEFAULT}])
+    with pytest.raises(ValueError, match='Rule 1 sets unsupported headers: ContentType'):
+        HeaderPolicy([{'match': '*', 'headers': {'ContentType': 'text/plain'}}])
@@ -0,0 +1,98 @@
+"""Tests of the rate control shared by every client."""
+
+import botocore.session
+import pytest
+
+import ratecontrol
+from ratecontrol import MAX_ATTEMPTS, AdaptiveLimit, RateControl
+
+
+@pytest.fixture
+def aws_config(tmp_path, monkeypatch):
+    """Get a function writing a profile's settings to the AWS config file and returning a new botocore session."""
+    for name in ('AWS_PROFILE', 'AWS_MAX_ATTEMPTS', 'AWS_RETRY_MODE'):
+        monkeypatch.delenv(name, raising=False)
+    path = tmp_path / 'config'
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(path))
+
+    def write(settings, profile='default'):
+        """Write settings as profile's section, with a region so clients can be made."""
+        section = 'default' if profile == 'default' else f"profile {profile}"
+        lines = [f"[{section}]", 'region = us-east-1'] + [f"{name} = {value}" for name, value in settings.items()]
+        path.write_text('\n'.join(lines) + '\n')
+        session = botocore.session.get_session()
+        session.set_config_variable('profile', profile)
+        return session
+
+    return write
+
+
+def client_retries(session):
+    """Get the retries config of an s3 client made from session."""
+    return session.create_client('s3', aws_access_key_id='a', aws_secret_access_key='b').meta.config.retries
+
+
+def test_defaults_apply_when_nothing_is_configured(aws_config):
+    """With no retry settings anywhere, clients get standard mode and MAX_ATTEMPTS."""
+    session = aws_config({})
+    RateControl().install(session)
+
+    assert client_retries(session) == {'mode': 'standard', 'total_max_attempts': MAX_ATTEMPTS}
+
+
+def test_profile_retry_settings_are_kept(aws_config):
+    """A profile's max_attempts and retry_mode aren't overridden by the defaults."""
+    session = aws_config({'max_attempts': 1, 'retry_mode': 'legacy'}, profile='bench')
+
+    assert ratecontrol.retry_settings(session) == {}
+    RateControl().install(session)
+    assert client_retries(session) == {'mode': 'legacy', 'total_max_attempts': 1}
+
+
+def test_environment_retry_settings_are_kept(aws_config, monkeypatch):
+    """AWS_MAX_ATTEMPTS and AWS_RETRY_MODE aren't overridden by the defaults."""
+    monkeypatch.setenv('AWS_MAX_ATTEMPTS', '3')
+    monkeypatch.setenv('AWS_RETRY_MODE', 'adaptive')
+
+    assert ratecontrol.retry_settings(aws_config({})) == {}
+
+
+def test_max_attempts_overrides_the_profile(aws_config):
+    """An explicit max_attempts (eg --Max_Attempts) wins over the profile's, keeping its retry_mode."""
+    session = aws_config({'max_attempts': 1, 'retry_mode': 'legacy'})
+    RateControl(max_attempts=5).install(session)
+
+    assert client_retries(session) == {'mode': 'legacy', 'total_max_attempts': 5}
+
+
+def test_adaptive_limit_halves_on_throttling_and_grows_back(monkeypatch):
+    """Throttling halves the limit to what was in flight, at most once per cooldown, and successes grow it back."""
+    now = [100.0]
+    monkeypatch.setattr(ratecontrol.time, 'monotonic', lambda: now[0])
+    limit = AdaptiveLimit(8)
+
+    for _ in range(4):
+        limit.acquire()
+    limit.release(True)
+    assert limit.limit == 2
+
+    # a burst of throttled requests within the cooldown is one signal
+    limit.release(True)
+    assert limit.limit == 2
+
+    now[0] += AdaptiveLimit.COOLDOWN
+    limit.release(None)  # other failures leave the limit alone
+    limit.release(False)
+    assert limit.limit == 2.5
+    assert limit.lowest == 2
+    assert limit.in_flight == 0
+
+
+def test_adaptive_limit_try_acquire_does_not_wait():
+    """try_acquire takes a slot while there is one and refuses once the limit is reached."""
+    limit = AdaptiveLimit(2)
+
+    assert limit.try_acquire() and limit.try_acquire()
+    assert not limit.try_acquire()
+    limit.release(False)
+    assert limit.try_acquire()
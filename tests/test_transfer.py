@@ -0,0 +1,80 @@
+"""Tests of TransferTuner's per-file settings and throughput measurements."""
+
+import types
+
+import pytest
+
+import transfer
+from transfer import TransferTuner
+from util import RateLimiter
+
+MIB = 1024 ** 2
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace transfer's clock with one that only moves when told to."""
+    fake = types.SimpleNamespace(now=0.0)
+    fake.perf_counter = lambda: fake.now
+    monkeypatch.setattr(transfer, 'time', fake)
+    return fake
+
+
+def test_small_files_use_one_connection():
+    """A file below the threshold goes up in one request, however many connections are free."""
+    tuner = TransferTuner(8 * MIB, 8 * MIB, 10)
+
+    assert tuner.concurrency(MIB) == 1
+    assert tuner.config_for(MIB).max_concurrency == 1
+
+
+def test_connections_are_shared_between_active_uploads():
+    """Each upload in progress gets an even share of the pool, but never more parts than the file has."""
+    tuner = TransferTuner(8 * MIB, 8 * MIB, 10)
+    assert tuner.concurrency(800 * MIB) == 10
+    assert tuner.concurrency(24 * MIB) == 3
+
+    for _ in range(4):
+        tuner.start()
+    assert tuner.concurrency(800 * MIB) == 2
+
+    for _ in range(20):
+        tuner.start()
+    assert tuner.concurrency(800 * MIB) == 1
+
+
+def test_finish_keeps_a_moving_average_of_large_uploads(clock):
+    """Each large upload moves the per-connection rate by SMOOTHING, small ones and failures are left out."""
+    tuner = TransferTuner(8 * MIB, 8 * MIB, 10)
+
+    start = tuner.start()
+    clock.now += 2
+    assert tuner.finish(start, 80 * MIB, 4) == 2
+    assert tuner.stream_rate == 10 * MIB
+    assert tuner.active == 0
+
+    start = tuner.start()
+    clock.now += 1
+    tuner.finish(start, 80 * MIB, 2)
+    assert tuner.stream_rate == pytest.approx(TransferTuner.SMOOTHING * 40 * MIB
+                                              + (1 - TransferTuner.SMOOTHING) * 10 * MIB)
+
+    # a small file is mostly request overhead and a failed upload counts 0 bytes
+    rate = tuner.stream_rate
+    for size in (MIB, 0):
+        start = tuner.start()
+        clock.now += 1
+        tuner.finish(start, size, 1)
+    assert tuner.stream_rate == rate
+
+
+def test_bandwidth_cap_limits_streams_to_what_fills_it(clock):
+    """Under a cap, a file only gets as many connections as it takes to fill it at the measured rate."""
+    tuner = TransferTuner(8 * MIB, 8 * MIB, 10, RateLimiter(30 * MIB))
+    # nothing is measured yet, so there is nothing to go on
+    assert tuner.concurrency(800 * MIB) == 10
+
+    start = tuner.start()
+    clock.now += 1
+    tuner.finish(start, 80 * MIB, 8)
+    assert tuner.concurrency(800 * MIB) == 3
@@ -0,0 +1,72 @@
+"""Tests of the util helpers."""
+
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import util
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace util's clock with one that only moves when something sleeps."""
+    fake = types.SimpleNamespace(now=0.0, slept=[])
+    fake.monotonic = lambda: fake.now
+
+    def sleep(seconds):
+        """Move the clock on."""
+        fake.slept.append(seconds)
+        fake.now += seconds
+
+    fake.sleep = sleep
+    monkeypatch.setattr(util, 'time', fake)
+    return fake
+
+
+def test_rate_limiter_allows_a_burst_then_paces(clock):
+    """A full bucket lets burst calls straight through, after that calls are spaced 1/rate apart."""
+    limiter = util.RateLimiter(10)
+
+    assert [limiter.acquire() for _ in range(10)] == [0] * 10
+    assert limiter.acquire() == pytest.approx(0.1)
+    assert limiter.acquire() == pytest.approx(0.1)
+
+    # after a quiet second the bucket is full again, but never fuller than the burst
+    clock.now += 5
+    assert [limiter.acquire() for _ in range(10)] == [0] * 10
+    assert limiter.acquire() == pytest.approx(0.1)
+
+
+def test_rate_limiter_counts_bytes(clock):
+    """acquire(count) takes count tokens at once, eg bytes for a bandwidth cap."""
+    limiter = util.RateLimiter(1000, burst=1000)
+
+    assert limiter.acquire(500) == 0
+    assert limiter.acquire(1000) == pytest.approx(0.5)
+
+
+def test_rate_limiter_reserve_does_not_sleep(clock):
+    """reserve takes the tokens and returns the wait, leaving the sleeping to the caller (eg asyncio.sleep)."""
+    limiter = util.RateLimiter(1000, burst=1000)
+
+    assert limiter.reserve(1500) == pytest.approx(0.5)
+    assert limiter.reserve(500) == pytest.approx(1.0)
+    assert clock.slept == []
+
+
+def test_bounded_map_keeps_order_and_window():
+    """Results come back in order, with no more than window items taken from the generator ahead of them."""
+    taken = []
+
+    def items():
+        """Note every item as it is taken."""
+        for item in range(20):
+            taken.append(item)
+            yield item
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = util.bounded_map(executor, lambda item: item * 2, items(), 5)
+        assert next(results) == 0
+        assert len(taken) == 5
+        assert list(results) == [item * 2 for item in range(1, 20)]
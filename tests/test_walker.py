@@ -0,0 +1,62 @@
+"""Tests of walk_files and FileRules."""
+
+import os
+
+from walker import DEFAULT_EXCLUDE, FileRules, walk_files
+
+
+def test_walk_finds_every_file_with_slash_keys(site):
+    """Every file under the root is found, keyed by its path with / separators."""
+    root = site({'index.html': 'a', 'css/site.css': 'b', 'img/icons/logo.svg': 'c'})
+
+    files = {file.key: file for file in walk_files(root)}
+
+    assert sorted(files) == ['css/site.css', 'img/icons/logo.svg', 'index.html']
+    assert files['css/site.css'].stat.st_size == 1
+    assert files['css/site.css'].path == str(root / 'css' / 'site.css')
+
+
+def test_walk_applies_include_and_exclude(site):
+    """Excluded directories are skipped whole, and only included files are produced."""
+    root = site({'index.html': 'a', 'app.js': 'b', 'app.js.map': 'c', 'drafts/post.html': 'd', '.DS_Store': 'e'})
+    rules = FileRules(['*.html', '*.js'], DEFAULT_EXCLUDE + ('drafts',))
+
+    assert sorted(file.key for file in walk_files(root, rules)) == ['app.js', 'index.html']
+
+
+def test_selects_agrees_with_the_walk(site):
+    """selects accepts exactly the keys walk_files would produce for the same rules."""
+    root = site({'index.html': 'a', 'css/site.css': 'b', 'css/site.css.map': 'c', 'build/out.html': 'd'})
+    rules = FileRules(['*.html', 'css/*'], ('build', '*.map'))
+
+    walked = {file.key for file in walk_files(root, rules)}
+    candidates = ['index.html', 'css/site.css', 'css/site.css.map', 'build/out.html', 'build/sub/x.html', 'x.txt']
+
+    assert {key for key in candidates if rules.selects(key)} == walked
+    assert not rules.selects('build/sub/x.html')
+
+
+def test_walk_doesnt_follow_symlinked_directories(site):
+    """A symlink back up the tree is skipped rather than walked round and round."""
+    root = site({'index.html': 'a', 'docs/page.html': 'b'})
+    (root / 'docs' / 'loop').symlink_to(root, target_is_directory=True)
+
+    assert sorted(file.key for file in walk_files(root)) == ['docs/page.html', 'index.html']
+
+
+def test_walk_skips_unreadable_directories(site, monkeypatch):
+    """A directory that can't be listed is recorded in errors by its prefix, and the rest of the tree is walked."""
+    root = site({'index.html': 'a', 'private/secret.html': 'b', 'public/page.html': 'c'})
+    real_scandir = os.scandir
+
+    def scandir(path):
+        """Fail to list the private directory."""
+        if os.path.basename(path) == 'private':
+            raise PermissionError(13, 'Permission denied', path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', scandir)
+    errors = []
+
+    assert sorted(file.key for file in walk_files(root, errors=errors)) == ['index.html', 'public/page.html']
+    assert [prefix for prefix, _ in errors] == ['private/']
@@ -0,0 +1,131 @@
+"""Tests of watch mode's change detection and sync loop."""
+
+import types
+
+import pytest
+
+from walker import FileRules
+from watch import InotifyWatcher, PollingWatcher, SiteWatcher, load_inotify
+
+
+class Stop(Exception):
+    """Raised by FakeWatcher to end SiteWatcher.watch's loop."""
+
+
+class FakeWatcher:
+    """Hands out a scripted list of changes, then stops the loop."""
+
+    def __init__(self, changes):
+        """Create a FakeWatcher returning each set of changes in turn."""
+        self.changes_left = list(changes)
+        self.timeouts = []
+
+    def changes(self, timeout=None):
+        """Return the next set of changes, noting the timeout asked for."""
+        self.timeouts.append(timeout)
+        if not self.changes_left:
+            raise Stop()
+        return self.changes_left.pop(0)
+
+
+def fake_bucket_manager(local_manifest=()):
+    """Get a stand-in BucketManager whose sync_changes reports every key it is given as changed."""
+    bucket_manager = types.SimpleNamespace(local_manifest=dict.fromkeys(local_manifest, '"etag"'), changed_keys=[])
+
+    def sync_changes(path_name, bucket_name, keys, rules=None):
+        """Note the keys as changed."""
+        bucket_manager.changed_keys = sorted(keys)
+        return []
+
+    bucket_manager.sync_changes = sync_changes
+    return bucket_manager
+
+
+def test_polling_watcher_finds_new_changed_and_removed_files(site):
+    """A rescan reports the keys whose size, mtime or inode changed, and ones that appeared or went away."""
+    root = site({'index.html': 'a', 'about.html': 'b', 'app.js.map': 'c'})
+    watcher = PollingWatcher(str(root), FileRules(exclude=('*.map',)), interval=0)
+
+    site({'index.html': 'changed', 'css/site.css': 'new', 'app.js.map': 'ignored'})
+    (root / 'about.html').unlink()
+
+    assert watcher.changes(timeout=0) == {'index.html', 'css/site.css', 'about.html'}
+    assert watcher.changes(timeout=0) == set()
+
+
+@pytest.mark.skipif(load_inotify() is None, reason="needs inotify")
+def test_inotify_watcher_reports_files_and_new_directories(site):
+    """Written files are reported by key, and a new directory is reported and watched from then on."""
+    root = site({'index.html': 'a'})
+    watcher = InotifyWatcher(str(root), FileRules(), load_inotify())
+    try:
+        site({'index.html': 'b'})
+        assert watcher.changes(timeout=1) == {'index.html'}
+
+        (root / 'docs').mkdir()
+        assert watcher.changes(timeout=1) == {'docs'}
+        site({'docs/page.html': 'c'})
+        assert watcher.changes(timeout=1) == {'docs/page.html'}
+    finally:
+        watcher.close()
+
+
+def test_expand_turns_directories_into_their_files(site):
+    """A directory key becomes the files in it now and the ones the last sync knew of, '' means the whole tree."""
+    root = site({'index.html': 'a', 'docs/new.html': 'b'})
+    site_watcher = SiteWatcher(fake_bucket_manager(['index.html', 'docs/old.html', 'gone/page.html']), str(root),
+                               'test-bucket')
+
+    assert site_watcher.expand(['docs']) == {'docs/new.html', 'docs/old.html'}
+    # a directory that was moved away leaves its known files behind to be deleted
+    assert site_watcher.expand(['gone']) == {'gone', 'gone/page.html'}
+    assert site_watcher.expand(['']) == {'index.html', 'docs/new.html', 'docs/old.html', 'gone/page.html'}
+
+
+def test_watch_calls_on_change_again_while_it_has_work_left(site):
+    """An on_change that returns True is called with no keys after RETRY_INTERVAL until it returns False."""
+    site_watcher = SiteWatcher(fake_bucket_manager(), str(site({})), 'test-bucket')
+    site_watcher.MAX_DELAY = 0
+    calls = []
+
+    def on_change(keys):
+        """Note the keys, with work left over until the second call."""
+        calls.append(keys)
+        return len(calls) < 2
+
+    # a change, then a quiet spell with work left over, then a quiet spell with none
+    watcher = FakeWatcher([{'index.html'}, set(), set()])
+    with pytest.raises(Stop):
+        site_watcher.watch(watcher, on_change)
+
+    assert calls == [['index.html'], []]
+    assert watcher.timeouts == [None, SiteWatcher.RETRY_INTERVAL, None, None]
+
+
+def test_watch_keeps_going_and_tries_a_failed_batch_again(site):
+    """A batch whose sync raises is logged and its keys are synced again after RETRY_INTERVAL."""
+    bucket_manager = fake_bucket_manager()
+    synced = []
+
+    def sync_changes(path_name, bucket_name, keys, rules=None):
+        """Fail the first time, as if a file went away just after it was uploaded, then note the keys."""
+        if not synced:
+            synced.append(None)
+            raise FileNotFoundError(2, 'No such file or directory', 'index.html')
+        synced.append(sorted(keys))
+        bucket_manager.changed_keys = sorted(keys)
+        return []
+
+    bucket_manager.sync_changes = sync_changes
+    site_watcher = SiteWatcher(bucket_manager, str(site({})), 'test-bucket')
+    site_watcher.MAX_DELAY = 0
+    calls = []
+
+    # a change whose sync fails, then a quiet spell before it is tried again
+    watcher = FakeWatcher([{'index.html'}, set()])
+    with pytest.raises(Stop):
+        site_watcher.watch(watcher, calls.append)
+
+    assert synced == [None, ['index.html']]
+    assert calls == [['index.html']]
+    assert watcher.timeouts == [None, SiteWatcher.RETRY_INTERVAL, None]
@@ -0,0 +1,454 @@
+"""Asyncio variant of BucketManager.
+
+Every S3 request is a coroutine on one event loop instead of a blocked thread,
+so thousands of small uploads can be in flight from a single process.
+Needs aiobotocore, which is only imported when this module is.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import time
+import uuid
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import AioSession
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError, ClientError
+
+from bucket import BucketManager
+from cache import ManifestSnapshot, UploadJournal
+from etag import parts_etag
+from manifest import Manifest
+from ratecontrol import retry_settings
+from walker import DEFAULT_EXCLUDE, FileRules
+
+# every module logs through the one webinator logger, so its level is set in one place
+log = logging.getLogger('webinator')
+
+
+def read_part(path, number, chunk_size):
+    """Read part number (counting from 1) of the file at path."""
+    # each part opens the file itself, so parts read on different threads don't move each other's position
+    with open(path, 'rb') as file:
+        file.seek((number - 1) * chunk_size)
+        return file.read(chunk_size)
+
+
+class AsyncBucketManager(BucketManager):
+    """Manage an S3 Bucket using asyncio.
+
+    Use it as an async context manager so its client is opened and closed:
+
+        async with AsyncBucketManager(session) as bucket_manager:
+            await bucket_manager.sync(path_name, bucket_name)
+
+    The methods that talk to S3 are coroutines taking a bucket name rather than a bucket resource,
+    so BucketManager's blocking entry points that call them (eg plan_sync, iter_objects) aren't for use here.
+    """
+
+    # files at least this big wait for one of the buffers to upload, smaller ones only for a request slot
+    BUFFERED_SIZE = 256 * 1024
+
+    def __init__(self, session, concurrency=200, hash_workers=None, endpoint_url=None, bandwidth_limiter=None,
+                 rate_control=None):
+        """Create an AsyncBucketManager Object, bandwidth_limiter caps uploads like BucketManager's.
+
+        rate_control is the RateControl installed on session, its token buckets and limits are shared with the client.
+        """
+        super().__init__(session, hash_workers=hash_workers, bandwidth_limiter=bandwidth_limiter)
+        self.rate_control = rate_control
+
+        # maximum number of requests in flight at once, also the size of the client's connection pool
+        self.concurrency = concurrency
+        self.semaphore = None
+        # parts (and other bodies of BUFFERED_SIZE or more) are read into memory whole before they're sent,
+        # so no more of them are held at once than the tuner's connections, the parts the threaded path has in flight
+        self.buffers = None
+
+        # endpoint_url points the client at a local S3 stand-in (eg moto server) instead of AWS
+        self.endpoint_url = endpoint_url
+        self.client_context = None
+        self.client = None
+
+        # the state the coroutines below keep up to date, starting out the way BucketManager's does
+        self.manifest = Manifest()
+        self.listing_rate = 0
+        self.snapshot_generation = None
+        self.marker_cleared = False
+        self.copy_sources = {}
+        self.header_policy = None
+        self.journal = None
+
+    async def __aenter__(self):
+        """Open the async S3 client."""
+        credentials = self.session.get_credentials().get_frozen_credentials()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.buffers = asyncio.Semaphore(self.tuner.connections)
+        # the same profile as session, so its retry settings are kept like they are for every other client
+        # (a session without a config file still calls its profile default, which botocore won't load by name)
+        profile = self.session.profile_name if self.session.profile_name in self.session.available_profiles else None
+        aio_session = AioSession(profile=profile)
+        max_attempts = self.rate_control.max_attempts if self.rate_control else None
+        self.client_context = aio_session.create_client(
+            's3',
+            region_name=self.session.region_name,
+            endpoint_url=self.endpoint_url,
+            aws_access_key_id=credentials.access_key,
+            aws_secret_access_key=credentials.secret_key,
+            aws_session_token=credentials.token,
+            config=AioConfig(max_pool_connections=self.concurrency,
+                             retries=retry_settings(aio_session, max_attempts) or None)
+        )
+        self.client = await self.client_context.__aenter__()
+        # the client isn't made from session, so rate control has to be attached to it
+        if self.rate_control:
+            self.rate_control.attach_async(self.client)
+        self.metrics.attach(self.client)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Close the async S3 client."""
+        await self.client_context.__aexit__(*exc_info)
+        self.client = None
+
+    async def discover_partitions(self, bucket_name, prefix=''):
+        """Split the keyspace under prefix into key prefixes that can be listed independently."""
+        objects = []
+
+        for _ in range(self.MAX_DISCOVERY_DEPTH):
+            partitions = []
+            paginator = self.client.get_paginator('list_objects_v2')
+            async for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+                objects.extend(page.get('Contents', []))
+                partitions.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+
+            if len(partitions) != 1:
+                break
+            prefix = partitions[0]
+
+        return partitions, objects
+
+    async def list_partition(self, bucket_name, partition):
+        """Page through a single partition of the bucket into the manifest."""
+        async with self.semaphore:
+            paginator = self.client.get_paginator('list_objects_v2')
+            async for page in paginator.paginate(Bucket=bucket_name, Prefix=partition):
+                for obj in page.get('Contents', []):
+                    self.manifest[obj['Key']] = obj['ETag']
+
+    async def load_manifest(self, bucket_name, prefix=''):
+        """Load manifest for s3 bucket caching purposes, optionally only for keys starting with prefix."""
+        self.manifest = Manifest()
+
+        start = time.perf_counter()
+        partitions, objects = await self.discover_partitions(bucket_name, prefix)
+        for obj in objects:
+            self.manifest[obj['Key']] = obj['ETag']
+        await asyncio.gather(*(self.list_partition(bucket_name, partition) for partition in partitions))
+        elapsed = time.perf_counter() - start
+
+        self.listing_rate = len(self.manifest) / elapsed if elapsed else 0
+        self.metrics.count('objects_listed', len(self.manifest))
+        log.info("Listed %d objects in %.1fs (%.0f objects/s)", len(self.manifest), elapsed, self.listing_rate)
+
+    async def throttle(self, count):
+        """Wait until count more bytes fit under the bandwidth cap, without blocking the event loop."""
+        if self.tuner.limiter:
+            await asyncio.sleep(self.tuner.limiter.reserve(count))
+
+    async def resume_upload(self, bucket_name, key, etag, chunk_size):
+        """Find an interrupted upload of this version of key. Return its upload id and finished parts {number: etag}.
+
+        Return None and no parts if there isn't one to resume, like BucketManager.resume_upload.
+        """
+        entry = self.journal.get(key)
+        if entry is None:
+            return None, {}
+
+        upload_id, journal_etag, journal_chunk_size = entry
+        if journal_etag == etag and journal_chunk_size == chunk_size:
+            try:
+                # only parts s3 still has are reused, the upload may have been aborted since (eg by abort_uploads)
+                uploaded = {}
+                paginator = self.client.get_paginator('list_parts')
+                async for page in paginator.paginate(Bucket=bucket_name, Key=key, UploadId=upload_id):
+                    uploaded.update((part['PartNumber'], part['ETag']) for part in page.get('Parts', []))
+                parts = self.journal.parts(upload_id)
+                return upload_id, {number: part for number, part in parts.items() if uploaded.get(number) == part}
+            except ClientError as err:
+                if err.response['Error']['Code'] != 'NoSuchUpload':
+                    raise
+        else:
+            # an upload of an older version of the file is no use, and s3 charges for its parts until it's aborted
+            try:
+                await self.client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            except ClientError:
+                pass
+
+        self.journal.finish(upload_id)
+        return None, {}
+
+    async def upload_part(self, bucket_name, path, key, upload_id, number, chunk_size):
+        """Upload part number of a multipart upload of path. Return (number, etag of the part)."""
+        loop = asyncio.get_event_loop()
+        async with self.buffers, self.semaphore:
+            data = await loop.run_in_executor(None, read_part, path, number, chunk_size)
+            await self.throttle(len(data))
+            part = await self.client.upload_part(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                                 PartNumber=number, Body=data)
+
+        # recorded as soon as it's done, so being killed only loses the parts in flight
+        self.journal.add_part(upload_id, number, part['ETag'])
+        return number, part['ETag']
+
+    async def upload_parts(self, bucket_name, path, key, upload_id, chunk_size, count, parts, streams):
+        """Upload the parts of path that aren't in parts {number: etag} yet, up to streams of them at once.
+
+        Return the etags of every part, in part number order.
+        """
+        in_flight = asyncio.Semaphore(streams)
+
+        async def upload(number):
+            """Upload a part once one of this file's streams is free."""
+            async with in_flight:
+                return await self.upload_part(bucket_name, path, key, upload_id, number, chunk_size)
+
+        results = await asyncio.gather(*(upload(number) for number in range(1, count + 1) if number not in parts),
+                                       return_exceptions=True)
+
+        # every part is waited for before a failure is raised, so all of those that finished are in the journal
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        finished = dict(parts)
+        finished.update(results)
+        return [part for _, part in sorted(finished.items())]
+
+    async def upload_multipart(self, bucket_name, path, key, etag, size, streams=1):
+        """Upload a large file in parts, carrying on from an interrupted upload of the same file if there is one.
+
+        Up to streams parts are uploaded at once.
+        """
+        # the same part size our etags are generated with, so the object ends up with the etag we expect
+        chunk_size = self.tuner.part_size(size)
+        count = math.ceil(size / chunk_size)
+
+        upload_id, parts = await self.resume_upload(bucket_name, key, etag, chunk_size)
+        if upload_id is None:
+            async with self.semaphore:
+                upload = await self.client.create_multipart_upload(Bucket=bucket_name, Key=key,
+                                                                   **self.extra_args(key))
+            upload_id = upload['UploadId']
+            self.journal.start(key, upload_id, etag, chunk_size)
+        elif parts:
+            log.info("Resuming %s: %d of %d parts already uploaded", key, len(parts), count)
+
+        # the parts go up side by side, like s3transfer's threads upload them, rather than one after another
+        # if a part fails the upload is left in place (and in the journal) for the next sync to resume
+        part_etags = await self.upload_parts(bucket_name, path, key, upload_id, chunk_size, count, parts, streams)
+
+        # if the part etags aren't the file's etag the file changed part way through
+        if parts_etag(part_etags) != etag:
+            await self.client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            self.journal.finish(upload_id)
+            raise S3UploadFailedError(f"{path} changed while it was being uploaded")
+
+        async with self.semaphore:
+            await self.client.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': [{'ETag': part, 'PartNumber': number}
+                                           for number, part in enumerate(part_etags, 1)]}
+            )
+        self.journal.finish(upload_id)
+
+    async def put_file(self, bucket_name, path, key):
+        """Upload path in a single request."""
+        loop = asyncio.get_event_loop()
+        async with self.semaphore:
+            with open(path, 'rb') as file:
+                body = await loop.run_in_executor(None, file.read)
+            await self.throttle(len(body))
+            await self.client.put_object(Bucket=bucket_name, Key=key, Body=body, **self.extra_args(key))
+
+    async def upload_file(self, bucket_name, path, key, etag=None):
+        """Upload website files to specified S3 bucket. Return True if uploaded, False if skipped."""
+        loop = asyncio.get_event_loop()
+
+        # hashing is cpu work, so it is done off the event loop
+        if etag is None:
+            etag = await loop.run_in_executor(None, self.local_etag, path, key)
+
+        if self.manifest.get(key, '') == etag:
+            return False
+
+        size = os.path.getsize(path)
+        # timed like BucketManager.upload_file, so the tuner's throughput and the per-file log cover --Async too
+        streams = self.tuner.concurrency(size)
+        start = self.tuner.start()
+        uploaded = 0  # stays 0 if the upload fails, so it doesn't count towards the measured throughput
+        try:
+            # files below the multipart threshold go up in a single request, like s3transfer does
+            # a large file's parts take a slot each, so the file itself doesn't hold one while they wait for theirs
+            if size < self.BUFFERED_SIZE:
+                await self.put_file(bucket_name, path, key)
+            elif size < self.transfer_config.multipart_threshold:
+                async with self.buffers:
+                    await self.put_file(bucket_name, path, key)
+            else:
+                await self.upload_multipart(bucket_name, path, key, etag, size, streams)
+            uploaded = size
+        finally:
+            elapsed = self.tuner.finish(start, uploaded, streams)
+
+        self.upload_stats[key] = (size, elapsed)
+        return True
+
+    async def delete_keys(self, bucket_name, keys):
+        """Delete a batch of up to 1000 keys from bucket. Return a list of (key, error) for keys that failed."""
+        async with self.semaphore:
+            response = await self.client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+
+        return [(error['Key'], error['Message']) for error in response.get('Errors', [])]
+
+    async def read_marker(self, bucket_name):
+        """Return the snapshot generation recorded in bucket, or None if there isn't one."""
+        try:
+            response = await self.client.get_object(Bucket=bucket_name, Key=self.SNAPSHOT_MARKER)
+        except ClientError as err:
+            if err.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise err
+
+        async with response['Body'] as body:
+            return (await body.read()).decode()
+
+    async def load_snapshot(self, bucket_name):
+        """Load the manifest from the local snapshot, falling back to listing the bucket if it is out of date."""
+        loop = asyncio.get_event_loop()
+        generation = await self.read_marker(bucket_name)
+        # reading a snapshot of millions of keys takes a while, so it is done off the event loop
+        manifest = await loop.run_in_executor(None, ManifestSnapshot(bucket_name).load, generation) \
+            if generation else None
+        if manifest is not None:
+            log.info("Loaded %d objects from snapshot %s", len(manifest), generation)
+            self.manifest = manifest
+            self.snapshot_generation = generation
+            return
+
+        await self.load_manifest(bucket_name)
+        self.manifest.pop(self.SNAPSHOT_MARKER, None)
+        self.snapshot_generation = None
+
+    async def save_snapshot(self, bucket_name):
+        """Save the manifest as a new snapshot and record its generation in bucket."""
+        loop = asyncio.get_event_loop()
+        generation = str(uuid.uuid4())
+        await loop.run_in_executor(None, ManifestSnapshot(bucket_name).save, generation, self.manifest)
+        await self.client.put_object(Bucket=bucket_name, Key=self.SNAPSHOT_MARKER, Body=generation.encode())
+        self.snapshot_generation = generation
+        self.marker_cleared = False
+
+    async def clear_marker(self, bucket_name):
+        """Remove the snapshot marker before changing bucket, so a sync that fails part way leaves no stale snapshot."""
+        await self.client.delete_object(Bucket=bucket_name, Key=self.SNAPSHOT_MARKER)
+        self.manifest.pop(self.SNAPSHOT_MARKER, None)
+        self.snapshot_generation = None
+        self.marker_cleared = True
+
+    async def apply_plan(self, bucket_name, plan):
+        """Upload and delete the keys in plan. Return a list of (key, error) for keys that failed."""
+        loop = asyncio.get_event_loop()
+        self.copy_sources = dict(plan.copies)
+        errors = []
+
+        async def worker(tasks):
+            """Take tasks off the shared generator until there are none left."""
+            # a fixed number of workers rather than one coroutine per file
+            # keeps memory flat for plans with hundreds of thousands of uploads
+            for action, keys in tasks:
+                try:
+                    if action == 'upload':
+                        await self.upload_file(bucket_name, self.local_files[keys[0]], keys[0],
+                                               self.local_manifest[keys[0]])
+                        failed = []
+                    elif action == 'copy':
+                        # copies are rare next to uploads, so they use the blocking managed copy on a thread
+                        await loop.run_in_executor(None, self.copy_key, self.s3.Bucket(bucket_name),
+                                                   self.copy_sources[keys[0]], keys[0])
+                        failed = []
+                    elif action == 'update':
+                        # copies in place are rare, so they use the blocking copy on a thread
+                        await loop.run_in_executor(None, self.update_headers, self.s3.Bucket(bucket_name), keys[0])
+                        failed = []
+                    else:
+                        failed = await self.delete_keys(bucket_name, keys)
+                except (BotoCoreError, ClientError, S3UploadFailedError, OSError) as err:
+                    failed = [(key, err) for key in keys]
+
+                self.report_task(action, keys, failed)
+                errors.extend(failed)
+
+        # copies of files uploaded by this sync wait for a second round, after their source is in the bucket
+        tasks = self.plan_tasks(plan)
+        await asyncio.gather(*(worker(tasks) for _ in range(self.concurrency)))
+        tasks = self.copy_tasks(plan, list(errors))
+        await asyncio.gather(*(worker(tasks) for _ in range(self.concurrency)))
+
+        self.record_applied(plan, errors)
+        self.report_applied()
+        return errors
+
+    async def sync(self, path_name, bucket_name, rehash=False, dry_run=False, include=(), exclude=(), snapshot=False,
+                   compression=None, header_policy=None):
+        """Sync contents of path_name to bucket. Return a list of (key, error) for files that failed.
+
+        With snapshot=True the manifest comes from (and is saved to) a local snapshot, like BucketManager.sync.
+        """
+        loop = asyncio.get_event_loop()
+        self.header_policy = header_policy
+        self.upload_stats = {}
+        self.metrics.reset()
+        rules = FileRules(include, DEFAULT_EXCLUDE + tuple(exclude))
+
+        async def list_bucket():
+            """Load the bucket's manifest, timed as the list phase."""
+            with self.metrics.phase('list'):
+                await (self.load_snapshot if snapshot else self.load_manifest)(bucket_name)
+
+        # the local files are hashed on a thread pool while the bucket is listed on the event loop
+        listing = asyncio.ensure_future(list_bucket())
+        with self.metrics.phase('hash'):
+            errors = await loop.run_in_executor(None, self.hash_local, path_name, rehash, rules, compression)
+        await listing
+
+        with self.metrics.phase('plan'):
+            plan = await loop.run_in_executor(None, self.check_headers, bucket_name, self.diff_local(errors, rules))
+            plan = self.dedupe(plan)
+        self.report_plan(plan, dry_run)
+        if dry_run:
+            return errors
+
+        if plan.uploads or plan.copies or plan.deletes or plan.updates:
+            await self.clear_marker(bucket_name)
+
+        self.journal = UploadJournal(bucket_name)
+        try:
+            with self.metrics.phase('apply'):
+                errors += await self.apply_plan(bucket_name, plan)
+        finally:
+            self.journal.close()
+            self.journal = None
+
+        # a snapshot is only saved when the manifest is known to match the bucket exactly
+        if snapshot and not errors and not self.snapshot_generation:
+            await self.save_snapshot(bucket_name)
+
+        return errors
@@ -3,16 +3,40 @@
 Encapsulation of our bucket logic in this module
 """
 
+import logging
+import math
 import mimetypes
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import chain, islice
 from pathlib import Path
+from stat import S_ISREG
 
 import boto3
-from botocore.exceptions import ClientError  # for catching Boto3 specific errors
-
-from functools import reduce
-from hashlib import md5
+from boto3.exceptions import S3UploadFailedError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError  # for catching Boto3 specific errors
+
+from cache import EtagCache, HeaderRecords, ManifestSnapshot, UploadJournal
+from compress import Compressor
+from etag import file_etag, parts_etag
+from manifest import Manifest
+from metrics import SyncMetrics
+from plan import SyncPlan, diff_manifests
+from policy import FINGERPRINT_METADATA, fingerprint
+from transfer import TransferTuner
+from walker import DEFAULT_EXCLUDE, RESERVED_PREFIX, FileRules, LocalFile, walk_files
 import util
 
+# every module logs through the one webinator logger, so its level is set in one place
+log = logging.getLogger('webinator')
+
+
 class BucketManager:
     """Manage an S3 Bucket."""
 
@@ -23,19 +47,84 @@ class BucketManager:
     # than the hash of the full file that we are going to upload
     CHUNK_SIZE = 8388608
 
-    def __init__(self, session):  # instances of this class will be constructed with this function
-        """Create a BucketManager Object."""
+    # below this many files, hashing them one after the other is quicker than starting a pool of threads
+    SERIAL_HASH_LIMIT = 32
+
+    # instances of this class will be constructed with this function
+    def __init__(self, session, workers=1, hash_workers=None, s3=None, bandwidth_limiter=None):
+        """Create a BucketManager Object, optionally sharing the client of another one's s3 resource.
+
+        bandwidth_limiter is a util.RateLimiter in bytes per second capping uploads, it can be shared between managers.
+        """
         self.session = session
-        self.s3 = self.session.resource('s3')
 
-        # create transfer config object to be used each time we upload a file
+        # number of files hashed at the same time before a sync uploads anything
+        # hashlib releases the GIL while hashing, so threads are enough to keep every core busy
+        self.hash_workers = hash_workers or os.cpu_count() or 1
+
+        # number of files sync will upload at the same time
+        # every worker shares the one low level client (boto3 clients are thread safe, resources are not)
+        # so the client's connection pool has to be big enough for all of the workers at once
+        self.workers = workers
+        if s3 is None:
+            self.s3 = self.session.resource('s3', config=Config(max_pool_connections=max(10, workers)))
+        else:
+            # a resource of our own around the shared client, as managers sharing one may run on different threads
+            self.s3 = type(s3)(client=s3.meta.client)
+
+        # phase timers, counters and request latencies of the current sync
+        # only a client of our own is hooked, a shared one would count every manager's requests in each of them
+        self.metrics = SyncMetrics()
+        if s3 is None:
+            self.metrics.attach(self.s3.meta.client)
+
+        # create transfer config object with the base settings etags are generated from
         self.transfer_config = boto3.s3.transfer.TransferConfig(
             multipart_chunksize=self.CHUNK_SIZE,
             multipart_threshold=self.CHUNK_SIZE
         )
 
+        # each upload gets its own TransferConfig from the tuner, with a part size picked from the file's size
+        self.tuner = TransferTuner(self.CHUNK_SIZE, self.CHUNK_SIZE, max(10, workers), bandwidth_limiter)
+        self.upload_stats = {}  # key -> (bytes, seconds) of the uploads in the current sync
+
         # empty manifest object to be used by load_manifest method below, used for getting s3 bucket e-tags
-        self.manifest = {}
+        # Manifest works like a dict of key -> etag but stores them compactly enough for very large buckets
+        self.manifest = Manifest()
+        self.listing_rate = 0  # objects per second the last load_manifest listed
+
+        # keys the last sync uploaded, updated or deleted, eg for invalidating them in CloudFront
+        self.changed_keys = []
+
+        # generation of the snapshot the manifest was loaded from, None if the bucket was listed instead
+        self.snapshot_generation = None
+
+        # True once the snapshot marker has been removed from the bucket, until a new snapshot is saved
+        self.marker_cleared = False
+
+        # local etag cache, opened by sync for the website root being synced
+        self.etag_cache = None
+
+        # the local side of a sync, filled in by plan_sync
+        # local_files maps each key to the full path of its file, local_manifest maps each key to its etag
+        # and file_sizes to the size of the bytes uploaded for it, as hashed (the file may change or go after)
+        self.local_files = {}
+        self.local_manifest = {}
+        self.file_sizes = {}
+
+        # optional Compressor used by sync, and the Content-Encoding of each key it compressed
+        self.compressor = None
+        self.content_encodings = {}
+
+        # optional HeaderPolicy used by sync, and the fingerprints of the headers objects were uploaded with
+        self.header_policy = None
+        self.header_records = None
+
+        # journal of multipart uploads in progress, open while sync uploads files
+        self.journal = None
+
+        # the source key of each key a sync copies inside the bucket instead of uploading
+        self.copy_sources = {}
 
     def get_bucket(self, bucket_name):
         """Get a bucket by name."""
@@ -78,7 +167,8 @@ class BucketManager:
         return s3_bucket
 
     def set_policy(self, bucket):
-        """Set S3 Bucket Policy to be readable by everyone."""
+        """Set S3 Bucket Policy to be readable by everyone, apart from the webinator's own objects."""
+        # NotResource allows every object except those under the reserved prefix (eg the snapshot marker)
         s3_bucket_website_policy = """
         {
           "Version":"2012-10-17",
@@ -87,12 +177,12 @@ class BucketManager:
           "Effect":"Allow",
           "Principal": "*",
               "Action":["s3:GetObject"],
-              "Resource":["arn:aws:s3:::%s/*"
+              "NotResource":["arn:aws:s3:::%s/%s*"
               ]
             }
           ]
         }
-        """ % bucket.name
+        """ % (bucket.name, RESERVED_PREFIX)
 
         # strip off \n characters at beginning and end of policy so that it is valid
         s3_bucket_website_policy = s3_bucket_website_policy.strip()
@@ -113,115 +203,795 @@ class BucketManager:
             }
         })
 
-    def load_manifest(self, bucket):
-        """Load manifest for s3 bucket caching purposes."""
+    # when the top level of the bucket has a single "directory", split that one instead
+    # (eg every key starts with site/), going at most this many levels down
+    MAX_DISCOVERY_DEPTH = 3
+
+    def discover_partitions(self, bucket_name, prefix=''):
+        """Split the keyspace under prefix into key prefixes that can be listed independently.
+
+        Return the partition prefixes and the objects found along the way that belong to none of them.
+        """
         paginator = self.s3.meta.client.get_paginator('list_objects_v2')
-        # using pagination to load data by pages into memory rather than the entire data set all at once
-        for page in paginator.paginate(Bucket=bucket.name):
-            for obj in page.get('Contents', []):  # empty list covers empty pages being returned
-                self.manifest[obj['Key']] = obj['ETag']  # populating manifest with ETags for each s3 object
+        objects = []
+
+        for _ in range(self.MAX_DISCOVERY_DEPTH):
+            partitions = []
+            # using the / delimiter, s3 rolls everything below this level up into CommonPrefixes
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+                objects.extend(page.get('Contents', []))
+                partitions.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+
+            if len(partitions) != 1:
+                break
+            prefix = partitions[0]
+
+        return partitions, objects
+
+    def iter_objects(self, bucket_name, prefix=''):
+        """Generate the objects in a bucket as they are listed, listing partitions of the keyspace concurrently."""
+        partitions, objects = self.discover_partitions(bucket_name, prefix)
+        yield from objects
+
+        # each partition is paged through by its own worker, pages are handed back through a bounded queue
+        pages = queue.Queue(maxsize=self.workers * 4)
+        stop = threading.Event()
+        done = object()  # marker a worker puts on the queue when its partition is finished
+
+        def list_partition(partition):
+            """Page through a single partition, putting each page's objects on the queue."""
+            try:
+                paginator = self.s3.meta.client.get_paginator('list_objects_v2')
+                for page in paginator.paginate(Bucket=bucket_name, Prefix=partition):
+                    if stop.is_set():
+                        return
+                    pages.put(page.get('Contents', []))
+            except (BotoCoreError, ClientError) as err:
+                pages.put(err)
+            finally:
+                pages.put(done)
+
+        remaining = len(partitions)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for partition in partitions:
+                executor.submit(list_partition, partition)
+
+            try:
+                while remaining:
+                    page = pages.get()
+                    if page is done:
+                        remaining -= 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        yield from page
+            finally:
+                # if the caller stops early, let the workers finish their current page and drain the queue
+                stop.set()
+                while remaining:
+                    if pages.get() is done:
+                        remaining -= 1
+
+    def load_manifest(self, bucket, prefix=''):
+        """Load manifest for s3 bucket caching purposes, optionally only for keys starting with prefix."""
+        self.manifest = Manifest()
+
+        start = time.perf_counter()
+        for obj in self.iter_objects(bucket.name, prefix):
+            self.manifest[obj['Key']] = obj['ETag']  # populating manifest with ETags for each s3 object
+        elapsed = time.perf_counter() - start
+
+        # listing rate in objects per second, to see how long listing a large bucket takes
+        self.listing_rate = len(self.manifest) / elapsed if elapsed else 0
+        self.metrics.count('objects_listed', len(self.manifest))
+        log.info("Listed %d objects in %.1fs (%.0f objects/s)", len(self.manifest), elapsed, self.listing_rate)
 
         # before we upload our files, we want to load our files from the manifest first
 
-    @staticmethod
-    def hash_data(data):
-        """Get hash value for data files to be uploaded to S3."""
-        hash = md5()
-        hash.update(data)
+    # object written to the bucket after a sync that saved a snapshot
+    # its contents are the generation of the matching local snapshot
+    # it lives under the reserved prefix, so it isn't public and syncs leave it alone whatever their rules
+    SNAPSHOT_MARKER = RESERVED_PREFIX + 'snapshot'
 
-        return hash
+    def read_marker(self, bucket):
+        """Return the snapshot generation recorded in bucket, or None if there isn't one."""
+        try:
+            response = self.s3.meta.client.get_object(Bucket=bucket.name, Key=self.SNAPSHOT_MARKER)
+        except ClientError as err:
+            if err.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise err
+
+        return response['Body'].read().decode()
+
+    def load_snapshot(self, bucket):
+        """Load the manifest from the local snapshot, falling back to listing the bucket if it is out of date."""
+        # we are the only writer to the bucket, so if its marker matches our snapshot
+        # the snapshot is exactly what a full listing would return
+        generation = self.read_marker(bucket)
+        manifest = ManifestSnapshot(bucket.name).load(generation) if generation else None
+        if manifest is not None:
+            log.info("Loaded %d objects from snapshot %s", len(manifest), generation)
+            self.manifest = manifest
+            self.snapshot_generation = generation
+            return
+
+        self.load_manifest(bucket)
+        self.manifest.pop(self.SNAPSHOT_MARKER, None)
+        self.snapshot_generation = None
+
+    def save_snapshot(self, bucket):
+        """Save the manifest as a new snapshot and record its generation in bucket."""
+        generation = str(uuid.uuid4())
+        ManifestSnapshot(bucket.name).save(generation, self.manifest)
+        self.s3.meta.client.put_object(Bucket=bucket.name, Key=self.SNAPSHOT_MARKER, Body=generation.encode())
+        self.snapshot_generation = generation
+        self.marker_cleared = False
+
+    def clear_marker(self, bucket):
+        """Remove the snapshot marker before changing bucket, so a sync that fails part way leaves no stale snapshot.
+
+        Every write to the bucket has to do this first, with or without --Snapshot, or a later snapshot sync
+        would trust a snapshot of the bucket as it was before the write.
+        """
+        self.s3.meta.client.delete_object(Bucket=bucket.name, Key=self.SNAPSHOT_MARKER)
+        self.manifest.pop(self.SNAPSHOT_MARKER, None)
+        self.snapshot_generation = None
+        self.marker_cleared = True
 
     def gen_etag(self, path):
         """Generate etag for file."""
-        print("generating hashes for local files")
-        # creating a list of hashes for our file to upload.
-        # The list if for the scenario where multiple hashes are created
-        # (eg the file is so large that is is chunked - split into multiple parts before being uploaded)
-        hashes = []
-
-        with open(path, 'rb') as file:
-            while True:  # used to iterate over the chunks of the file
-                data = file.read(self.CHUNK_SIZE)  # read in the file data into memory up to the defined chunk_size
+        self.metrics.count('files_hashed')
+        self.metrics.count('bytes_hashed', os.path.getsize(path))
+        # the etag depends on the chunk size and threshold the file will be uploaded with
+        # so they come from the same transfer config upload_file uses
+        return file_etag(
+            path,
+            self.transfer_config.multipart_chunksize,
+            self.transfer_config.multipart_threshold
+        )
 
-                if not data:
-                    break  # break out of loop if no more data is available to be read
+    def local_etag(self, path, key, stat=None):
+        """Get the etag for a local file, only hashing it if it changed since the last sync."""
+        if self.etag_cache is None:
+            return self.gen_etag(path)
+
+        stat = stat or os.stat(path)
+        etag = self.etag_cache.get(key, stat)
+        if etag is None:
+            etag = self.gen_etag(path)
+            self.etag_cache.put(key, stat, etag)
+
+        return etag
+
+    def hash_files(self, files):
+        """Hash LocalFiles across hash_workers threads. Return the local manifest {key: etag} and errors."""
+        def hash_file(file):
+            """Get the etag of a single file, catching the error if the file can't be read."""
+            try:
+                etag = self.local_etag(file.path, file.key, file.stat)
+                self.file_sizes[file.key] = file.stat.st_size
+                if self.compressor:
+                    compressed = self.compressor.compress(file.path, file.key, file.stat.st_size, etag)
+                    if compressed:
+                        # the bucket holds the compressed bytes, so those are what get compared and uploaded
+                        self.local_files[file.key] = compressed
+                        self.file_sizes[file.key] = os.path.getsize(compressed)
+                        self.content_encodings[file.key] = self.compressor.encoding
+                        # compression is deterministic, so the compressed etag is cached against the source file
+                        # under a key no real file can have (file names can't contain a NUL)
+                        etag = self.local_etag(compressed, f"{file.key}\0{self.compressor.encoding}", file.stat)
+                return file.key, etag, None
+            except OSError as err:
+                return file.key, None, err
+
+        manifest = {}
+        errors = []
+
+        def collect(results):
+            """Sort hashing results into the manifest and the errors."""
+            for key, etag, error in results:
+                if error:
+                    errors.append((key, error))
+                else:
+                    manifest[key] = etag
+
+        # files can come from a generator, so peek at the first few to see if a pool is worth starting
+        files = iter(files)
+        first = list(islice(files, self.SERIAL_HASH_LIMIT))
+
+        # with a single worker the files past the first few are hashed serially too
+        if self.hash_workers <= 1 or len(first) < self.SERIAL_HASH_LIMIT:
+            collect(map(hash_file, chain(first, files)))
+        else:
+            with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+                collect(util.bounded_map(executor, hash_file, chain(first, files), self.hash_workers * 4))
 
-                hashes.append(self.hash_data(data))  # append to hashes list
+        return manifest, errors
 
-        if not hashes:  # if no hashes were generated (eg the file was empty)
-            print("no hashes generated")
-            return
-        elif len(hashes) == 1:  # if just one hash returned (eg the file was less than the chunk size)
-            print("one hash generated")
-            return f"{hashes[0].hexdigest()}"
-        else:
-            hash = self.hash_data(reduce(lambda x, y: x + y, (h.digest() for h in hashes)))
-            # basically this is the algorithm AWS uses to generate etags
-            # first part takes a hash,
-            # the reduce function takes another function (in this case a lambda/anonymous function)
-            # lambda function takes two arguments
-            # reduce will take a list of things, iterate over it and append each element to the previous one
-            # each element will be the digest
-            # (h.digest() for h in hashes))) == getting a digest for each of the hashes
-            # x + y == appending those digests together
-            print("multiple hashes generated")
-            return f'"{hash.hexdigest()}"-{len(hashes)}'
-
-
-        # the way AWS works is that it takes a hash of each chunk of the data
-        # and then takes a hash of those hashes - this becomes the etag of the file
-        # note the etag uses a double quote. So the etag string also includes double quotes in the string
-        # this is the reason we include he double quotes inside the f string
-
-    def upload_file(self, bucket, path, key):
-        """Upload website files to specified S3 bucket."""
+    def extra_args(self, key):
+        """Get the headers to upload key with."""
         # guess_type method gives us a tuple, the first element is the file
         content_type = mimetypes.guess_type(key)[0] or 'text/plain'  # if can't guess type, assign text/plain mimetype
 
-        # generate an etag for a particular file
-        etag = self.gen_etag(path)
+        extra_args = {'ContentType': content_type}
+        if key in self.content_encodings:
+            extra_args['ContentEncoding'] = self.content_encodings[key]
+
+        if self.header_policy:
+            extra_args.update(self.header_policy.headers_for(key))
+            # the object carries a fingerprint of its headers, so a later change to the policy can be spotted
+            metadata = dict(extra_args.get('Metadata', {}))
+            metadata[FINGERPRINT_METADATA] = fingerprint(extra_args)
+            extra_args['Metadata'] = metadata
+
+        return extra_args
+
+    def copy_key(self, bucket, source_key, key):
+        """Copy source_key to key inside bucket, giving key its own headers, without uploading anything."""
+        extra_args = self.extra_args(key)
+        extra_args['MetadataDirective'] = 'REPLACE'
+
+        # a managed copy uses multipart for large objects, given the same part size as an upload
+        # of the file the object's etag is the same afterwards
+        self.s3.meta.client.copy(
+            {'Bucket': bucket.name, 'Key': source_key},
+            bucket.name,
+            key,
+            ExtraArgs=extra_args,
+            Config=self.tuner.config_for(os.path.getsize(self.local_files[key]))
+        )
+
+    def update_headers(self, bucket, key):
+        """Give key the headers from the header policy by copying it onto itself, without uploading it again."""
+        self.copy_key(bucket, key, key)
+
+    def header_fingerprint(self, key):
+        """Get the fingerprint of the headers the header policy gives key."""
+        return self.extra_args(key)['Metadata'][FINGERPRINT_METADATA]
+
+    def remote_fingerprint(self, bucket_name, key):
+        """Get the fingerprint of the headers key was last uploaded with, asking S3 if we have no record of it."""
+        if key not in self.header_records.fingerprints:
+            try:
+                response = self.s3.meta.client.head_object(Bucket=bucket_name, Key=key)
+                self.header_records.fingerprints[key] = response['Metadata'].get(FINGERPRINT_METADATA)
+            except ClientError:
+                return None
+
+        return self.header_records.fingerprints[key]
+
+    def check_headers(self, bucket_name, plan):
+        """Add the unchanged keys in plan whose headers don't match the header policy to plan's updates."""
+        # loaded with or without a policy, record_applied has to forget the headers of objects uploaded without one
+        self.header_records = HeaderRecords(bucket_name)
+        if not self.header_policy:
+            return plan
+
+        def outdated(key):
+            """Return key and whether its headers need updating."""
+            return key, self.remote_fingerprint(bucket_name, key) != self.header_fingerprint(key)
+
+        # only keys we have no record of need a request to S3, so this is quick after the first sync
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            updates = [key for key, stale in util.bounded_map(executor, outdated, plan.skips, self.workers * 4)
+                       if stale]
+
+        return plan._replace(updates=updates)
+
+    def upload_file(self, bucket, path, key, etag=None):
+        """Upload website files to specified S3 bucket. Return True if uploaded, False if skipped."""
+        # generate an etag for a particular file (or reuse the cached one if the file hasn't changed)
+        # unless the caller already hashed it
+        if etag is None:
+            etag = self.local_etag(path, key)
 
         # the manifest are the etags from AWS
         # conditional checks to see if the digest of our local file matches the etag of the file in s3
         # if it does, just return (files are the same), if not, run the upload.file method
         if self.manifest.get(key, '') == etag:  # if key doesn't exist, we'll get an empty string
-            print(f"Skipping {key}, etags match")
-            return
-
-        # return statement isn't required but can be used as a design decision
-        return bucket.upload_file(
-            path,
-            key,
-            ExtraArgs={
-                'ContentType': content_type
-            },
-            Config=self.transfer_config
+            return False
+
+        size = os.path.getsize(path)
+        config = self.tuner.config_for(size)
+        start = self.tuner.start()
+        uploaded = 0  # stays 0 if the upload fails, so it doesn't count towards the measured throughput
+        try:
+            # large files are uploaded part by part with every finished part recorded in the journal,
+            # so if the sync is interrupted the next one carries on from the parts that are missing
+            if self.journal is not None and size >= self.transfer_config.multipart_threshold:
+                self.upload_resumable(bucket.name, path, key, etag, size, config.max_concurrency)
+            else:
+                # uploading through the shared client rather than the bucket resource
+                # so that this method is safe to call from several worker threads at once
+                self.s3.meta.client.upload_file(
+                    path,
+                    bucket.name,
+                    key,
+                    ExtraArgs=self.extra_args(key),
+                    Config=config,
+                    Callback=self.tuner.throttle if self.tuner.limiter else None
+                )
+            uploaded = size
+        finally:
+            elapsed = self.tuner.finish(start, uploaded, config.max_concurrency)
+
+        self.upload_stats[key] = (size, elapsed)
+        return True
+
+    def resume_upload(self, bucket_name, key, etag, chunk_size):
+        """Find an interrupted upload of this version of key. Return its upload id and finished parts {number: etag}.
+
+        Return None and no parts if there isn't one to resume.
+        """
+        entry = self.journal.get(key)
+        if entry is None:
+            return None, {}
+
+        upload_id, journal_etag, journal_chunk_size = entry
+        client = self.s3.meta.client
+        if journal_etag == etag and journal_chunk_size == chunk_size:
+            try:
+                # only parts s3 still has are reused, the upload may have been aborted since (eg by abort_uploads)
+                paginator = client.get_paginator('list_parts')
+                uploaded = {part['PartNumber']: part['ETag']
+                            for page in paginator.paginate(Bucket=bucket_name, Key=key, UploadId=upload_id)
+                            for part in page.get('Parts', [])}
+                parts = self.journal.parts(upload_id)
+                return upload_id, {number: part for number, part in parts.items() if uploaded.get(number) == part}
+            except ClientError as err:
+                if err.response['Error']['Code'] != 'NoSuchUpload':
+                    raise
+        else:
+            # an upload of an older version of the file is no use, and s3 charges for its parts until it's aborted
+            try:
+                client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            except ClientError:
+                pass
+
+        self.journal.finish(upload_id)
+        return None, {}
+
+    def upload_resumable(self, bucket_name, path, key, etag, size, concurrency=1):
+        """Upload a large file in parts, carrying on from an interrupted upload of the same file if there is one."""
+        client = self.s3.meta.client
+
+        # the same part size our etags are generated with, so the object ends up with the etag we expect
+        chunk_size = self.tuner.part_size(size)
+        count = math.ceil(size / chunk_size)
+
+        upload_id, parts = self.resume_upload(bucket_name, key, etag, chunk_size)
+        if upload_id is None:
+            upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key, **self.extra_args(key))['UploadId']
+            self.journal.start(key, upload_id, etag, chunk_size)
+        elif parts:
+            log.info("Resuming %s: %d of %d parts already uploaded", key, len(parts), count)
+
+        def upload_part(number):
+            """Upload a single part and record it in the journal."""
+            with open(path, 'rb') as file:
+                file.seek((number - 1) * chunk_size)
+                data = file.read(chunk_size)
+
+            self.tuner.throttle(len(data))
+            response = client.upload_part(Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=number,
+                                          Body=data)
+            # recorded as soon as it's done, so being killed only loses the parts in flight
+            self.journal.add_part(upload_id, number, response['ETag'])
+            return number, response['ETag']
+
+        # if a part fails the upload is left in place (and in the journal) for the next sync to resume
+        missing = [number for number in range(1, count + 1) if number not in parts]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            parts.update(executor.map(upload_part, missing))
+
+        # the part etags, including the ones from before an interruption, give the object's etag before it exists
+        # if it isn't the file's etag the file changed part way through and the object would be a mix of versions
+        part_etags = [parts[number] for number in range(1, count + 1)]
+        if parts_etag(part_etags) != etag:
+            client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            self.journal.finish(upload_id)
+            raise S3UploadFailedError(f"{path} changed while it was being uploaded")
+
+        client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [{'ETag': part, 'PartNumber': number}
+                                       for number, part in enumerate(part_etags, 1)]}
+        )
+        self.journal.finish(upload_id)
+
+    def abort_stale_uploads(self, bucket_name, max_age_hours=24):
+        """Abort multipart uploads in bucket started over max_age_hours ago. Return (key, initiated) of each one."""
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=max_age_hours)
+        client = self.s3.meta.client
+        journal = UploadJournal(bucket_name)
+        aborted = []
+
+        # s3 keeps (and charges for) the parts of an unfinished upload until it is completed or aborted
+        paginator = client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=bucket_name):
+            for upload in page.get('Uploads', []):
+                if upload['Initiated'] < cutoff:
+                    client.abort_multipart_upload(Bucket=bucket_name, Key=upload['Key'], UploadId=upload['UploadId'])
+                    journal.finish(upload['UploadId'])
+                    aborted.append((upload['Key'], upload['Initiated']))
+
+        journal.close()
+        return aborted
+
+    # delete_objects accepts at most 1000 keys per call
+    DELETE_BATCH_SIZE = 1000
+
+    def delete_keys(self, bucket, keys):
+        """Delete a batch of up to 1000 keys from bucket. Return a list of (key, error) for keys that failed."""
+        response = self.s3.meta.client.delete_objects(
+            Bucket=bucket.name,
+            Delete={
+                'Objects': [{'Key': key} for key in keys],
+                'Quiet': True  # only report the keys that couldn't be deleted
+            }
         )
 
-    def sync(self, path_name, bucket_name):
-        """Sync contents of path_name to bucket."""
-        bucket = self.s3.Bucket(bucket_name)
-        self.load_manifest(bucket)
+        return [(error['Key'], error['Message']) for error in response.get('Errors', [])]
 
+    def hash_local(self, path_name, rehash=False, rules=None, compression=None):
+        """Walk and hash path_name into local_manifest. Return a list of (key, error) for unreadable files."""
         website_root_path = Path(path_name).expanduser().resolve()
 
         # creating a Path object from the user's cli website path argument
         # the expanduser() method is for expanding ~ to the actual user's homedir
         # the resolve() method resolve symlinks and eliminate “..” components
 
-        def handle_directory(source_dir):
-            """Identify and upload website files and folders to S3."""
-            for item in source_dir.iterdir():
-                if item.is_dir():
-                    handle_directory(item)  # if item is a directory, use that
-                                            # dir as input int the same function (recursion)
-                if item.is_file():
-                    if item.match('.DS_Store'):  # skip mac index files
-                        continue
-                    print(f"Path: {item}\n Key: {item.relative_to(website_root_path)}")
-                    self.upload_file(bucket, str(item), str(item.relative_to(website_root_path)))
-                    # calling upload_file method above
-                    # path is the full path to the file and the key is the part we upload to s3
-                    #  - the relative path to the file
-
-        handle_directory(website_root_path)
+        # etags of files that haven't changed since the last sync are read from the cache instead of rehashing
+        # rehash=True ignores the cached etags (they still get refreshed)
+        self.etag_cache = EtagCache(website_root_path, self.transfer_config, rehash=rehash)
+        self.local_files = {}
+        self.file_sizes = {}
+
+        # eligible files are compressed (gzip or br) while they are hashed
+        self.compressor = Compressor(compression) if compression else None
+        self.content_encodings = {}
+
+        def remember(files):
+            """Note down the path of each file as it streams past on its way to be hashed."""
+            for file in files:
+                self.local_files[file.key] = file.path
+                yield file
+
+        # files are hashed straight from the walker as it finds them
+        # directories the walker can't read end up in errors too, as key prefixes ending in /
+        log.info("Generating hashes for local files in %s", website_root_path)
+        unreadable_dirs = []
+        self.local_manifest, errors = self.hash_files(
+            remember(walk_files(website_root_path, rules, unreadable_dirs)))
+        errors = unreadable_dirs + errors
+
+        log.info("Etag cache: %d hits, %d misses", self.etag_cache.hits, self.etag_cache.misses)
+        self.etag_cache.close()
+        self.etag_cache = None
+
+        if self.compressor:
+            removed = self.compressor.prune()
+            if removed:
+                log.info("Removed %d unused file(s) from the compression cache", removed)
+
+        return errors
+
+    def diff_local(self, errors, rules=None):
+        """Diff local_manifest against the bucket's manifest. Return the SyncPlan."""
+        rules = rules or FileRules()
+
+        # files that couldn't be read, files in directories that couldn't be read, and files that
+        # the include/exclude rules leave out aren't part of the plan so they are never mistaken for deleted files
+        unreadable = dict(errors)
+        unreadable_dirs = tuple(key for key in unreadable if key == '' or key.endswith('/'))
+        return diff_manifests(self.local_manifest, self.manifest,
+                              lambda key: key not in unreadable and not key.startswith(unreadable_dirs)
+                              and not key.startswith(RESERVED_PREFIX) and rules.selects(key))
+
+    def dedupe(self, plan):
+        """Turn uploads of content the bucket already has, or that is uploaded under another key, into copies."""
+        if not plan.uploads:
+            return plan
+
+        # keys being uploaded, grouped by content
+        wanted = {}
+        for key in plan.uploads:
+            wanted.setdefault(self.local_manifest[key], []).append(key)
+
+        # an object already in the bucket with the same etag has the same content
+        # unless the sync is about to replace or delete it
+        changing = set(plan.uploads).union(plan.deletes)
+        sources = {}
+        for key, etag in self.manifest.items():
+            if etag in wanted and etag not in sources and key not in changing:
+                sources[etag] = key
+
+        # each blob the bucket doesn't have is uploaded once, under its first key, the other keys are copies of it
+        uploads, copies = [], []
+        for etag, keys in wanted.items():
+            source = sources.get(etag)
+            if source is None:
+                source = keys.pop(0)
+                uploads.append(source)
+            copies.extend((key, source) for key in keys)
+
+        return plan._replace(uploads=sorted(uploads), copies=sorted(copies))
+
+    def plan_sync(self, path_name, bucket, rehash=False, rules=None, snapshot=False, compression=None):
+        """Hash the files in path_name and diff them against bucket. Return the SyncPlan and unreadable files."""
+        # every local file is hashed before anything is uploaded
+        # the bucket listing (network) runs in the background while the files are hashed (cpu)
+        def list_bucket():
+            """Load the bucket's manifest, timed as the list phase."""
+            with self.metrics.phase('list'):
+                (self.load_snapshot if snapshot else self.load_manifest)(bucket)
+
+        with ThreadPoolExecutor(max_workers=1) as lister:
+            listing = lister.submit(list_bucket)
+            with self.metrics.phase('hash'):
+                errors = self.hash_local(path_name, rehash, rules, compression)
+            listing.result()
+
+        with self.metrics.phase('plan'):
+            plan = self.dedupe(self.check_headers(bucket.name, self.diff_local(errors, rules)))
+
+        return plan, errors
+
+    def plan_tasks(self, plan):
+        """Generate the ('upload', [key]), ('copy', [key]), ('update', [key]) and ('delete', [keys]) tasks of plan.
+
+        Copies of keys that are uploaded by the plan are left to copy_tasks, they can't start before the upload is done.
+        """
+        uploading = set(plan.uploads)
+        for key in plan.uploads:
+            yield 'upload', [key]
+        for key, source_key in plan.copies:
+            if source_key not in uploading:
+                yield 'copy', [key]
+        for key in plan.updates:
+            yield 'update', [key]
+        for start in range(0, len(plan.deletes), self.DELETE_BATCH_SIZE):
+            yield 'delete', plan.deletes[start:start + self.DELETE_BATCH_SIZE]
+
+    def copy_tasks(self, plan, errors):
+        """Generate the tasks for copies of keys uploaded by plan, once plan_tasks have all finished."""
+        uploading = set(plan.uploads)
+        failed = dict(errors)
+        for key, source_key in plan.copies:
+            if source_key in uploading:
+                # when the upload of the source failed there is nothing to copy, the key is uploaded itself
+                yield ('upload' if source_key in failed else 'copy'), [key]
+
+    def report_task(self, action, keys, failed):
+        """Log the outcome of a single upload, copy, header update or batch of deletes."""
+        if action in ('upload', 'copy', 'update') and failed:
+            log.warning("Failed to %s %s: %s", action, keys[0], failed[0][1])
+        elif action == 'delete' and failed:
+            log.warning("Failed to delete %d of %d objects", len(failed), len(keys))
+
+        # a line per file is only worth its I/O when debugging, the totals are logged at the end of the sync
+        if failed or not log.isEnabledFor(logging.DEBUG):
+            return
+
+        if action == 'upload' and keys[0] in self.upload_stats:
+            size, elapsed = self.upload_stats[keys[0]]
+            amount = f"{size / 1024 ** 2:.1f} MB" if size >= 1024 ** 2 else f"{size / 1024:.1f} KB"
+            rate = size / elapsed / 1024 ** 2 if elapsed else 0
+            log.debug("Uploaded %s (%s in %.2fs, %.2f MB/s)", keys[0], amount, elapsed, rate)
+        elif action == 'upload':
+            log.debug("Uploaded %s", keys[0])
+        elif action == 'copy':
+            log.debug("Copied %s from %s", keys[0], self.copy_sources[keys[0]])
+        elif action == 'update':
+            log.debug("Updated headers of %s", keys[0])
+        else:
+            log.debug("Deleted %d objects", len(keys))
+
+    def record_applied(self, plan, errors):
+        """Keep the manifest in step with what is now in the bucket after plan was applied."""
+        failed = dict(errors)
+        copied = [key for key, _ in plan.copies]
+        self.changed_keys = [key for key in chain(plan.uploads, copied, plan.updates, plan.deletes)
+                             if key not in failed]
+
+        for key in chain(plan.uploads, copied):
+            if key not in failed:
+                self.manifest[key] = self.local_manifest[key]
+        for key in plan.deletes:
+            if key not in failed:
+                self.manifest.pop(key, None)
+
+        if self.header_policy:
+            fingerprints = self.header_records.fingerprints
+            for key in chain(plan.uploads, copied, plan.updates):
+                if key not in failed:
+                    fingerprints[key] = self.header_fingerprint(key)
+            for key in plan.deletes:
+                fingerprints.pop(key, None)
+            self.header_records.save()
+        elif self.header_records and self.header_records.fingerprints:
+            # objects written without a policy no longer have the headers recorded for them
+            # so the next sync with a policy has to ask S3 what they have rather than trust the record
+            fingerprints = self.header_records.fingerprints
+            stale = [key for key in chain(plan.uploads, copied, plan.deletes) if key in fingerprints]
+            for key in stale:
+                del fingerprints[key]
+            if stale:
+                self.header_records.save()
+
+        # keys whose copy source failed to upload were uploaded themselves
+        uploaded = [key for key in plan.uploads if key not in failed]
+        uploaded += [key for key, source_key in plan.copies if source_key in failed and key not in failed]
+        copied = [key for key, source_key in plan.copies if source_key not in failed and key not in failed]
+        self.metrics.count('files_uploaded', len(uploaded))
+        self.metrics.count('bytes_uploaded', sum(self.file_sizes.get(key, 0) for key in uploaded))
+        self.metrics.count('files_copied', len(copied))
+        self.metrics.count('bytes_copied', sum(self.file_sizes.get(key, 0) for key in copied))
+        self.metrics.count('headers_updated', sum(1 for key in plan.updates if key not in failed))
+        self.metrics.count('objects_deleted', sum(1 for key in plan.deletes if key not in failed))
+        self.metrics.count('failures', len(failed))
+
+    def apply_plan(self, bucket, plan):
+        """Upload and delete the keys in plan. Return a list of (key, error) for keys that failed."""
+        def run(task):
+            """Run a single task, catching the error so a failed file doesn't stop the rest of the sync."""
+            action, keys = task
+            try:
+                if action == 'upload':
+                    self.upload_file(bucket, self.local_files[keys[0]], keys[0], self.local_manifest[keys[0]])
+                    return action, keys, []
+                if action == 'copy':
+                    self.copy_key(bucket, self.copy_sources[keys[0]], keys[0])
+                    return action, keys, []
+                if action == 'update':
+                    self.update_headers(bucket, keys[0])
+                    return action, keys, []
+                return action, keys, self.delete_keys(bucket, keys)
+            except (BotoCoreError, ClientError, S3UploadFailedError, OSError) as err:
+                return action, keys, [(key, err) for key in keys]
+
+        self.copy_sources = dict(plan.copies)
+        errors = []
+
+        # uploads and batches of deletes are handed to a bounded pool of worker threads
+        # results are reported in plan order as the workers finish them
+        # copies of files uploaded by this sync go in a second round, after their source is in the bucket
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for action, keys, failed in util.bounded_map(executor, run, self.plan_tasks(plan), self.workers * 4):
+                self.report_task(action, keys, failed)
+                errors.extend(failed)
+            for action, keys, failed in util.bounded_map(executor, run, self.copy_tasks(plan, list(errors)),
+                                                         self.workers * 4):
+                self.report_task(action, keys, failed)
+                errors.extend(failed)
+
+        self.record_applied(plan, errors)
+        self.report_applied()
+        return errors
+
+    def report_applied(self):
+        """Log the totals of what the sync changed in the bucket."""
+        counters = self.metrics.counters
+        log.info("Uploaded %d file(s) (%.1f MB), updated headers of %d, deleted %d, %d failed",
+                 counters.get('files_uploaded', 0), counters.get('bytes_uploaded', 0) / 1024 ** 2,
+                 counters.get('headers_updated', 0), counters.get('objects_deleted', 0), counters.get('failures', 0))
+        if counters.get('files_copied'):
+            log.info("Copied %d file(s) inside the bucket instead of uploading them, saving %.1f MB of uploads",
+                     counters['files_copied'], counters['bytes_copied'] / 1024 ** 2)
+
+    @staticmethod
+    def report_plan(plan, dry_run=False):
+        """Log a summary of plan, and every change in it for a dry run."""
+        log.info("Plan: %d to upload, %d to copy, %d unchanged (%d needing new headers), %d to delete",
+                 len(plan.uploads), len(plan.copies), len(plan.skips), len(plan.updates), len(plan.deletes))
+        if dry_run:
+            for key in plan.uploads:
+                log.info("Would upload %s", key)
+            for key, source_key in plan.copies:
+                log.info("Would copy %s from %s", key, source_key)
+            for key in plan.updates:
+                log.info("Would update headers of %s", key)
+            for key in plan.deletes:
+                log.info("Would delete %s", key)
+
+    def sync_changes(self, path_name, bucket_name, keys, rules=None):
+        """Upload or delete just keys, after a full sync of path_name. Return a list of (key, error) that failed.
+
+        Only the given keys are hashed and nothing is listed, the manifest the sync loaded is kept up to date instead.
+        """
+        root = Path(path_name).expanduser().resolve()
+        rules = rules or FileRules()
+        self.metrics.reset()
+
+        files, gone, unreadable = [], [], []
+        for key in sorted(keys):
+            if key.startswith(RESERVED_PREFIX) or not rules.selects(key):
+                continue
+
+            # the key may no longer be compressed, or even be a file
+            self.content_encodings.pop(key, None)
+            path = os.path.join(root, *key.split('/'))
+            try:
+                file_stat = os.stat(path)
+            except FileNotFoundError:
+                gone.append(key)
+                continue
+            except OSError as err:
+                # eg its directory can't be read any more, the object is left as it is
+                unreadable.append((key, err))
+                continue
+            if S_ISREG(file_stat.st_mode):
+                self.local_files[key] = path
+                files.append(LocalFile(path, key, file_stat))
+
+        with self.metrics.phase('hash'):
+            manifest, errors = self.hash_files(files)
+        errors = unreadable + errors
+
+        self.local_manifest.update(manifest)
+        for key in gone:
+            self.local_manifest.pop(key, None)
+            self.local_files.pop(key, None)
+            self.file_sizes.pop(key, None)
+
+        # an edit that left the file as it was (eg saving without changes) needs no upload
+        plan = SyncPlan(
+            uploads=sorted(key for key, etag in manifest.items() if self.manifest.get(key) != etag),
+            skips=sorted(key for key, etag in manifest.items() if self.manifest.get(key) == etag),
+            deletes=sorted(key for key in gone if key in self.manifest)
+        )
+        if not (plan.uploads or plan.deletes):
+            self.changed_keys = []
+            return errors
+
+        bucket = self.s3.Bucket(bucket_name)
+        with self.metrics.phase('apply'):
+            # the full sync may have left a marker in place (it had nothing to change)
+            if not self.marker_cleared:
+                self.clear_marker(bucket)
+            return errors + self.apply_plan(bucket, plan)
+
+    def sync(self, path_name, bucket_name, rehash=False, dry_run=False, include=(), exclude=(), snapshot=False,
+             compression=None, header_policy=None):
+        """Sync contents of path_name to bucket. Return a list of (key, error) for files that failed.
+
+        With snapshot=True the bucket's manifest is saved locally after a successful sync
+        and the next sync uses it instead of listing the whole bucket.
+        With compression set to gzip or br, text files are uploaded compressed with a matching Content-Encoding.
+        With a HeaderPolicy, objects get its Cache-Control and other headers, unchanged files included.
+        """
+        bucket = self.s3.Bucket(bucket_name)
+        self.header_policy = header_policy
+        self.upload_stats = {}
+        self.metrics.reset()
+
+        # only files matching the include globs (all files if there are none) and none of the exclude globs are synced
+        rules = FileRules(include, DEFAULT_EXCLUDE + tuple(exclude))
+
+        plan, errors = self.plan_sync(path_name, bucket, rehash, rules, snapshot, compression)
+
+        # a dry run only prints the plan, nothing in the bucket is touched
+        self.report_plan(plan, dry_run)
+        if dry_run:
+            return errors
+
+        # whether or not this sync keeps a snapshot, changing the bucket makes any earlier snapshot stale
+        if plan.uploads or plan.copies or plan.deletes or plan.updates:
+            self.clear_marker(bucket)
+
+        self.journal = UploadJournal(bucket_name)
+        try:
+            with self.metrics.phase('apply'):
+                errors += self.apply_plan(bucket, plan)
+        finally:
+            self.journal.close()
+            self.journal = None
+
+        # a snapshot is only saved when the manifest is known to match the bucket exactly
+        if snapshot and not errors and not self.snapshot_generation:
+            self.save_snapshot(bucket)
+
+        return errors
@@ -0,0 +1,273 @@
+"""Classes for caching local data between webinator runs.
+
+Cached data lives under ~/.cache/webinator so it is never synced up with the website files
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from hashlib import md5
+from pathlib import Path
+
+from manifest import Manifest
+
+CACHE_DIR = Path('~/.cache/webinator').expanduser()
+
+
+class EtagCache:
+    """Cache etags of local website files so unchanged files aren't hashed on every sync."""
+
+    # upper bound on the number of files remembered per website root
+    # once the cache grows past this, the least recently used entries are evicted
+    MAX_ENTRIES = 1000000
+
+    # bump whenever the format of the stored etags changes, older caches are then thrown away
+    SCHEMA_VERSION = 3
+
+    def __init__(self, website_root, transfer_config, max_entries=None, rehash=False):
+        """Open (or create) the etag cache for website_root, holding up to max_entries (MAX_ENTRIES by default)."""
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.rehash = rehash  # when True every lookup is a miss, files get hashed again and the cache is refreshed
+
+        # a file's etag depends on the multipart settings (and so the part size) it is uploaded with
+        # so entries hashed under different settings never count as hits
+        self.transfer = f"{transfer_config.multipart_chunksize}:{transfer_config.multipart_threshold}"
+
+        # one cache file per website root, named after a hash of the root's full path
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self.path = CACHE_DIR / f"etags-{md5(str(website_root).encode()).hexdigest()}.sqlite"
+
+        # sync hashes files from several worker threads, so the connection is shared behind a lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS etags")
+            self.connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS etags (
+                key TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                inode INTEGER,
+                transfer TEXT,
+                etag TEXT,
+                used REAL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS etags_used ON etags (used)")
+
+        # counters reported at the end of a sync
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, stat):
+        """Return the cached etag for key, or None if the file has changed since it was hashed."""
+        with self.lock:
+            row = None
+            if not self.rehash:
+                row = self.connection.execute(
+                    "SELECT etag FROM etags WHERE key = ? AND size = ? AND mtime = ? AND inode = ? AND transfer = ?",
+                    (key, stat.st_size, stat.st_mtime_ns, stat.st_ino, self.transfer)
+                ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            # remember when this entry was last used so eviction drops the stalest entries first
+            self.connection.execute("UPDATE etags SET used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, stat, etag):
+        """Store the etag for key along with the stat values it was generated from."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO etags (key, size, mtime, inode, transfer, etag, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, stat.st_size, stat.st_mtime_ns, stat.st_ino, self.transfer, etag, time.time())
+            )
+
+    def evict(self):
+        """Drop the least recently used entries once the cache is larger than max_entries."""
+        with self.lock:
+            count = self.connection.execute("SELECT COUNT(*) FROM etags").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM etags WHERE key IN (SELECT key FROM etags ORDER BY used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def close(self):
+        """Evict old entries and write the cache to disk."""
+        self.evict()
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class ManifestSnapshot:
+    """Local copy of a bucket's manifest, saved after a sync so the next sync can skip listing the bucket."""
+
+    def __init__(self, bucket_name):
+        """Create a snapshot for bucket_name."""
+        self.path = CACHE_DIR / f"manifest-{bucket_name}.jsonl"
+
+    def load(self, generation):
+        """Return the saved Manifest if it was saved under generation, otherwise None."""
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                # first line is the generation, then one [key, etag] pair per line
+                if json.loads(file.readline() or 'null') != generation:
+                    return None
+
+                manifest = Manifest()
+                for line in file:
+                    key, etag = json.loads(line)
+                    manifest[key] = etag
+                return manifest
+        except FileNotFoundError:
+            return None
+
+    def save(self, generation, manifest):
+        """Save manifest under generation."""
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+        # written to a temporary file first so a crash part way through never leaves half a snapshot behind
+        temporary = self.path.with_suffix('.tmp')
+        with open(temporary, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(generation) + '\n')
+            for key, etag in manifest.items():
+                file.write(json.dumps([key, etag]) + '\n')
+        os.replace(temporary, self.path)
+
+
+class HeaderRecords:
+    """Fingerprints of the headers each object in a bucket was last uploaded with.
+
+    Saves asking S3 for every object's headers on each sync to see if a header policy changed.
+    """
+
+    def __init__(self, bucket_name):
+        """Load the records for bucket_name."""
+        self.path = CACHE_DIR / f"headers-{bucket_name}.json"
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                self.fingerprints = json.load(file)
+        except FileNotFoundError:
+            self.fingerprints = {}
+
+    def save(self):
+        """Write the records to disk."""
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_suffix('.tmp')
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(self.fingerprints, file)
+        os.replace(temporary, self.path)
+
+
+class IndexCache:
+    """An index built from a slow AWS listing (eg every CloudFront distribution), kept on disk for ttl seconds."""
+
+    # indexes older than this are rebuilt, an hour keeps repeated runs fast without missing changes for long
+    TTL = 3600
+
+    def __init__(self, name, ttl=TTL):
+        """Open the cached index called name."""
+        self.path = CACHE_DIR / f"{name}.json"
+        self.ttl = ttl
+
+    def load(self):
+        """Return the cached index, None if there isn't one or it has expired."""
+        try:
+            if time.time() - self.path.stat().st_mtime > self.ttl:
+                return None
+            with open(self.path, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, index):
+        """Write index to disk."""
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_suffix('.tmp')
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(index, file)
+        os.replace(temporary, self.path)
+
+
+class UploadJournal:
+    """Multipart uploads in progress in a bucket and the parts they've finished, so an interrupted sync can resume.
+
+    Every change is committed straight away, the journal is only any use if it survives the process being killed.
+    """
+
+    def __init__(self, bucket_name):
+        """Open (or create) the journal for bucket_name."""
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self.path = CACHE_DIR / f"uploads-{bucket_name}.sqlite"
+
+        # parts are uploaded from several worker threads, so the connection is shared behind a lock
+        # isolation_level None leaves sqlite in autocommit mode
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                key TEXT PRIMARY KEY,
+                upload_id TEXT,
+                etag TEXT,
+                chunk_size INTEGER,
+                started REAL
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS parts (
+                upload_id TEXT,
+                number INTEGER,
+                etag TEXT,
+                PRIMARY KEY (upload_id, number)
+            )
+        """)
+
+    def get(self, key):
+        """Return (upload id, etag of the file being uploaded, chunk size) for key, None if it has no upload."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT upload_id, etag, chunk_size FROM uploads WHERE key = ?", (key,)
+            ).fetchone()
+
+    def parts(self, upload_id):
+        """Return {part number: etag} for the parts of upload_id that have finished."""
+        with self.lock:
+            return dict(self.connection.execute("SELECT number, etag FROM parts WHERE upload_id = ?", (upload_id,)))
+
+    def start(self, key, upload_id, etag, chunk_size):
+        """Record a new multipart upload of the file with etag to key, replacing any earlier one."""
+        with self.lock:
+            self.connection.execute(
+                "DELETE FROM parts WHERE upload_id IN (SELECT upload_id FROM uploads WHERE key = ?)", (key,)
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO uploads (key, upload_id, etag, chunk_size, started) VALUES (?, ?, ?, ?, ?)",
+                (key, upload_id, etag, chunk_size, time.time())
+            )
+
+    def add_part(self, upload_id, number, etag):
+        """Record a finished part."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO parts (upload_id, number, etag) VALUES (?, ?, ?)", (upload_id, number, etag)
+            )
+
+    def finish(self, upload_id):
+        """Forget an upload once it has completed or been aborted."""
+        with self.lock:
+            self.connection.execute("DELETE FROM parts WHERE upload_id = ?", (upload_id,))
+            self.connection.execute("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+
+    def close(self):
+        """Close the journal."""
+        with self.lock:
+            self.connection.close()
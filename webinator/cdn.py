@@ -1,30 +1,158 @@
 """Classes for Cloud Front Distributions."""
 
+import logging
+import posixpath
+import time
 import uuid
-import pprint
+from collections import Counter
+from urllib.parse import quote
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from cache import IndexCache
+
+log = logging.getLogger('webinator')
+
+# every path in an invalidation costs the same whether it is a single file or a wildcard
+# CloudFront allows up to 3000 paths in progress per distribution, but only 15 of them can be wildcards
+MAX_INVALIDATION_PATHS = 3000
+MAX_WILDCARD_PATHS = 15
+
+# a directory with at least this many changed files is invalidated with one wildcard path
+WILDCARD_MIN_FILES = 5
+
+
+def object_paths(key):
+    """Return the CloudFront paths a key is served from."""
+    # keys are url encoded the way CloudFront expects, * is encoded too so it can't act as a wildcard
+    path = '/' + quote(key, safe='/~')
+    if posixpath.basename(key) != 'index.html':
+        return [path]
+    # index.html is also served for its directory
+    return [path, path[:-len('index.html')]]
+
+
+def parent_dir(path):
+    """Return the directory a path or wildcard path is in, without a trailing slash."""
+    # the root directory is ''
+    return posixpath.dirname(path[:-2] if path.endswith('/*') else path.rstrip('/')).rstrip('/')
+
+
+def coalesce_paths(keys, max_paths=MAX_INVALIDATION_PATHS, max_wildcards=MAX_WILDCARD_PATHS,
+                   min_files=WILDCARD_MIN_FILES):
+    """Turn changed keys into at most max_paths invalidation paths, no more than max_wildcards of them wildcards.
+
+    Busy directories become wildcards, other files keep paths of their own.
+    """
+    paths = set()
+    for key in keys:
+        paths.update(object_paths(key))
+
+    def collapse(directory):
+        """Replace every path under directory with a single wildcard."""
+        prefix = directory + '/'
+        return {path for path in paths if not path.startswith(prefix)} | {prefix + '*'}
+
+    # directories with many changed files become wildcards, apart from the root as /* invalidates the whole site
+    counts = Counter(parent_dir(path) for path in paths)
+    for directory in sorted((d for d, count in counts.items() if d and count >= min_files), key=len):
+        if not any(directory.startswith(path[:-1]) for path in paths if path.endswith('*')):
+            paths = collapse(directory)
+
+    # too many wildcards, or too many paths altogether, so directories are merged into a wildcard,
+    # deepest first as that invalidates the least
+    wildcards = sum(1 for path in paths if path.endswith('*'))
+    while len(paths) > max_paths or wildcards > max_wildcards:
+        # number of paths, and of wildcard paths, anywhere under each directory
+        counts = Counter()
+        wildcards_under = Counter()
+        for path in paths:
+            directory = parent_dir(path)
+            while True:
+                counts[directory] += 1
+                wildcards_under[directory] += path.endswith('*')
+                if not directory:
+                    break
+                directory = parent_dir(directory)
+
+        if wildcards > max_wildcards:
+            # only merging the wildcards under a directory into one leaves fewer of them, the root holds them all
+            candidates = [directory for directory in counts if wildcards_under[directory] > 1]
+        else:
+            # the wildcard a merge adds mustn't take them past the limit, merging the root always leaves just /*
+            candidates = [directory for directory, count in counts.items()
+                          if count > 1 and wildcards - wildcards_under[directory] + 1 <= max_wildcards]
+        paths = collapse(max(candidates, key=lambda directory: (directory.count('/'), counts[directory])))
+        wildcards = sum(1 for path in paths if path.endswith('*'))
+
+    return sorted(paths)
 
 
 class DistributionManager:
     """Manage CloudFront distributions."""
 
-    def __init__(self, session):
-        """Create a DistributionManager."""
+    def __init__(self, session, refresh=False):
+        """Create a DistributionManager, refresh=True rebuilds the cached alias index."""
         self.session = session
         self.client = self.session.client('cloudfront')
 
-    def find_matching_dist(self, fqdn):
-        """Find a CF dist matching domain_name."""
+        # alias -> distribution index, built on first use and cached on disk per aws profile
+        self.index_cache = IndexCache(f"distributions-{session.profile_name}")
+        self.alias_index = None
+        self.refresh = refresh
+        self.from_disk = False  # True while alias_index is the one read from disk, which may be missing newer aliases
+
+    @staticmethod
+    def summarize(dist):
+        """Keep the parts of a distribution the webinator uses, in a form that can be cached as JSON."""
+        return {key: dist[key] for key in ('Id', 'ARN', 'DomainName', 'Status')}
+
+    def build_alias_index(self):
+        """List every distribution once and index them by alias."""
+        index = {}
         paginator = self.client.get_paginator('list_distributions')
         for page in paginator.paginate():
-            pprint.pprint(page)
             for dist in page['DistributionList'].get('Items', []):
-                pprint.pprint(dist)
-                exit(1)
-                #for alias in dist['Aliases']['Items']:  # CF distributions can have aliases/CNAMEs assigned to them
-                    #if alias == fqdn:
-                        #return dist
+                # CF distributions can have aliases/CNAMEs assigned to them
+                for alias in dist['Aliases'].get('Items', []):
+                    index[alias.lower()] = self.summarize(dist)
+
+        return index
+
+    def load_alias_index(self):
+        """Return the alias index, from the disk cache unless it has expired or a refresh was asked for."""
+        if self.alias_index is None:
+            self.alias_index = None if self.refresh else self.index_cache.load()
+            self.from_disk = self.alias_index is not None
+            if self.alias_index is None:
+                self.rebuild_alias_index()
+
+        return self.alias_index
+
+    def rebuild_alias_index(self):
+        """List the distributions again and cache the new index. Return it."""
+        self.alias_index = self.build_alias_index()
+        self.index_cache.save(self.alias_index)
+        self.from_disk = False
+        return self.alias_index
+
+    @staticmethod
+    def lookup_alias(index, fqdn):
+        """Return the distribution in index serving fqdn, None if there isn't one."""
+        fqdn = fqdn.lower().rstrip('.')
+
+        # an exact alias wins over a wildcard alias (eg *.example.com) covering fqdn
+        return index.get(fqdn) or index.get('*.' + fqdn.partition('.')[2])
+
+    def find_matching_dist(self, fqdn):
+        """Find a CF dist matching domain_name."""
+        dist = self.lookup_alias(self.load_alias_index(), fqdn)
+
+        # a distribution created since the index was cached isn't in it, and creating another
+        # for the same alias fails with CNAMEAlreadyExists, so the index is rebuilt once before giving up
+        if dist is None and self.from_disk:
+            dist = self.lookup_alias(self.rebuild_alias_index(), fqdn)
 
-        # return None
         return dist
 
     def create_dist(self, fqdn, cert):
@@ -43,6 +171,7 @@ class DistributionManager:
                 'DefaultRootObject': 'index.html',
                 'Comment': 'Created by the Webinator',
                 'Enabled': True,
+                'IsIPV6Enabled': True,  # so the AAAA alias record created for the distribution resolves
                 # specify the bucket/s to use to get content for the CF distribution
                 'Origins': {
                     'Quantity': 1,
@@ -80,7 +209,47 @@ class DistributionManager:
             }
         )
 
-        return result['Distribution']
+        # the new distribution goes straight into the index so it's found without rebuilding it
+        dist = result['Distribution']
+        self.load_alias_index()[fqdn.lower()] = self.summarize(dist)
+        self.index_cache.save(self.alias_index)
+
+        return dist
+
+    def invalidate(self, dist_id, keys, max_paths=MAX_INVALIDATION_PATHS):
+        """Invalidate the changed keys in distribution dist_id. Return the invalidation, None if no keys changed."""
+        if not keys:
+            return None
+
+        paths = coalesce_paths(keys, max_paths)
+        result = self.client.create_invalidation(
+            DistributionId=dist_id,
+            InvalidationBatch={
+                'Paths': {
+                    'Quantity': len(paths),
+                    'Items': paths
+                },
+                # CloudFront treats a repeated reference as the same request, so every sync gets a new one
+                'CallerReference': str(uuid.uuid4())
+            }
+        )
+
+        return result['Invalidation']
+
+    def await_invalidation(self, dist_id, invalidation, max_wait=900, first_delay=2, max_delay=30):
+        """Poll until invalidation has completed, backing off between checks. Return its final status."""
+        # most invalidations finish within a minute or two, so checking often at first
+        # and then less often is quicker than the waiter's fixed 20 second delay
+        deadline = time.monotonic() + max_wait
+        delay = first_delay
+        status = invalidation['Status']
+        while status != 'Completed' and time.monotonic() < deadline:
+            time.sleep(min(delay, max(0, deadline - time.monotonic())))
+            delay = min(delay * 2, max_delay)
+            result = self.client.get_invalidation(DistributionId=dist_id, Id=invalidation['Id'])
+            status = result['Invalidation']['Status']
+
+        return status
 
     def await_deploy(self, dist):
         """Wait for dist to be deployed."""
@@ -89,4 +258,61 @@ class DistributionManager:
         waiter.wait(Id=dist['Id'], WaiterConfig={
             'Delay': 30,  # 30 second delay
             'MaxAttempts': 50
-        })
\ No newline at end of file
+        })
+
+
+class InvalidationQueue:
+    """Changed keys waiting to be invalidated in a distribution, sent in one batch per invalidation in progress.
+
+    Used by watch, which changes files far more often than CloudFront finishes invalidations:
+    while the last invalidation is still in progress new keys are held back,
+    and a failed invalidation keeps its keys for the next try instead of stopping the caller.
+    """
+
+    def __init__(self, dist_manager, dist_id):
+        """Create an InvalidationQueue for distribution dist_id."""
+        self.dist_manager = dist_manager
+        self.dist_id = dist_id
+        self.keys = set()
+        self.in_progress = None  # the last invalidation sent, until it has completed
+
+    def busy(self):
+        """Return True if the last invalidation sent is still in progress."""
+        if self.in_progress is None:
+            return False
+        result = self.dist_manager.client.get_invalidation(DistributionId=self.dist_id, Id=self.in_progress['Id'])
+        if result['Invalidation']['Status'] != 'Completed':
+            return True
+        self.in_progress = None
+        return False
+
+    def add(self, keys):
+        """Queue keys and send them with everything already waiting, unless an invalidation is still in progress.
+
+        Return (invalidation, keys) for an invalidation that was sent, None if nothing was.
+        """
+        self.keys.update(keys)
+        return self.flush()
+
+    def flush(self, wait=True):
+        """Send the waiting keys, unless wait is True and an invalidation is still in progress.
+
+        Return (invalidation, keys) for an invalidation that was sent, None if nothing was.
+        """
+        if not self.keys:
+            return None
+
+        try:
+            if wait and self.busy():
+                log.info("Holding back %d changed file(s) until invalidation %s completes",
+                         len(self.keys), self.in_progress['Id'])
+                return None
+            keys = sorted(self.keys)
+            invalidation = self.dist_manager.invalidate(self.dist_id, keys)
+        except (BotoCoreError, ClientError) as err:
+            log.warning("Failed to invalidate %d changed file(s), will try again: %s", len(self.keys), err)
+            return None
+
+        self.keys.clear()
+        self.in_progress = invalidation
+        return invalidation, keys
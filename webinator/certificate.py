@@ -1,33 +1,109 @@
-import pprint
-
 """Classes for ACM Certificates."""
 
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import IndexCache
+
+
+def cert_names(domain_name):
+    """Return the certificate names that could cover domain_name, most specific first."""
+    domain_name = domain_name.lower().rstrip('.')
+    # a wildcard only covers a single label, *.example.com matches www.example.com but not a.b.example.com
+    return [domain_name, '*.' + domain_name.partition('.')[2]]
+
+
 class CertificateManager:
     """Create a CertificateManager."""
-    def __init__(self, session):
+
+    # describe_certificate calls in flight at once, ACM throttles much beyond this
+    DESCRIBE_WORKERS = 8
+
+    def __init__(self, session, refresh=False):
+        """Create a CertificateManager, refresh=True rebuilds the cached SAN index."""
         self.session = session
         self.client = self.session.client('acm', region_name='us-east-1')
 
+        # Subject Alternative Name -> certificate index, built on first use and cached on disk per aws profile
+        # 'certificates' has the certificate used for each name, 'covering' the arns of every certificate covering it
+        self.index_cache = IndexCache(f"certificates-{session.profile_name}")
+        self.san_index = None
+        self.refresh = refresh
+        self.from_disk = False  # True while san_index is the one read from disk, which may be missing newer certs
+
     # method to pull out all the Subject Alternative Names/Child/Sub Domains assigned to certificate
+    def alt_names(self, cert):
+        """Return the Subject Alternative Names of a certificate summary."""
+        # list_certificates already includes up to 100 names, only certs with more have to be described
+        if 'SubjectAlternativeNameSummaries' in cert and not cert.get('HasAdditionalSubjectAlternativeNames'):
+            return cert['SubjectAlternativeNameSummaries']
+
+        cert_details = self.client.describe_certificate(CertificateArn=cert['CertificateArn'])
+        return cert_details['Certificate']['SubjectAlternativeNames']
+
+    def build_san_index(self):
+        """List every issued certificate once and index them by Subject Alternative Name."""
+        certs = []
+        paginator = self.client.get_paginator('list_certificates')
+        for page in paginator.paginate(CertificateStatuses=['ISSUED']):  # only search for certs that have been issued
+            certs.extend(page['CertificateSummaryList'])
+
+        index = {}
+        covering = {}
+        with ThreadPoolExecutor(max_workers=self.DESCRIBE_WORKERS) as executor:
+            for cert, names in zip(certs, executor.map(self.alt_names, certs)):
+                summary = {'CertificateArn': cert['CertificateArn'], 'DomainName': cert['DomainName']}
+                if 'NotAfter' in cert:
+                    summary['NotAfter'] = cert['NotAfter'].isoformat()
+
+                for name in names:
+                    covering.setdefault(name.lower(), []).append(cert['CertificateArn'])
+                    # when several certs cover a name, the one that expires last is used
+                    current = index.get(name.lower())
+                    if current is None or summary.get('NotAfter', '') > current.get('NotAfter', ''):
+                        index[name.lower()] = summary
+
+        return {'certificates': index, 'covering': covering}
+
+    def load_san_index(self):
+        """Return the SAN index, from the disk cache unless it has expired or a refresh was asked for."""
+        if self.san_index is None:
+            self.san_index = None if self.refresh else self.index_cache.load()
+            self.from_disk = self.san_index is not None
+            # an index cached before it recorded every covering certificate is rebuilt
+            if self.san_index is None or 'covering' not in self.san_index:
+                self.rebuild_san_index()
+
+        return self.san_index
+
+    def rebuild_san_index(self):
+        """List the certificates again and cache the new index. Return it."""
+        self.san_index = self.build_san_index()
+        self.index_cache.save(self.san_index)
+        self.from_disk = False
+        return self.san_index
+
     def cert_matches(self, cert_arn, domain_name):
         """Return True if cert matches domain_name."""
-        cert_details = self.client.describe_certificate(CertificateArn=cert_arn)
-        alt_names = cert_details['Certificate']['SubjectAlternativeNames']
-        for name in alt_names:
-            if name == domain_name:  # if the SAN exactly matches the domain name
-                return True
-            if name[0] == '*' and domain_name.endswith(name[1:]):
-                return True
-        return False
+        # any certificate covering the name matches, not just the one find_matching_cert would pick
+        covering = self.load_san_index()['covering']
+        return any(cert_arn in covering.get(name, ()) for name in cert_names(domain_name))
+
+    @staticmethod
+    def lookup_cert(index, domain_name):
+        """Return the certificate in index used for domain_name, None if there isn't one."""
+        certificates = index['certificates']
+        for name in cert_names(domain_name):  # an exact name wins over a wildcard
+            if name in certificates:
+                return certificates[name]
+
+        return None  # No matching cert found in the index
 
     def find_matching_cert(self, domain_name):
         """Find a certificate matching domain_name."""
-        paginator = self.client.get_paginator('list_certificates')
-        for page in paginator.paginate(CertificateStatuses=['ISSUED']):  # only search for certs that have been issued
-            for cert in page['CertificateSummaryList']:
-                print(cert)
-                if self.cert_matches(cert['CertificateArn'], domain_name):
-                    return cert
+        cert = self.lookup_cert(self.load_san_index(), domain_name)
 
-        return None  # No matching cert found in the loops above
+        # a certificate issued since the index was cached isn't in it, so the index is rebuilt once before giving up
+        if cert is None and self.from_disk:
+            cert = self.lookup_cert(self.rebuild_san_index(), domain_name)
 
+        return cert
@@ -0,0 +1,140 @@
+"""Pre-compress website files before they are uploaded to S3.
+
+S3 serves objects exactly as they were uploaded, so text assets are compressed here
+and uploaded with a Content-Encoding header that tells browsers (and CloudFront) how to decode them.
+"""
+
+import gzip
+import io
+import mimetypes
+import os
+import time
+import uuid
+
+from cache import CACHE_DIR
+
+try:
+    import brotli  # optional, only needed for --Compress br
+except ImportError:
+    brotli = None
+
+# content types worth compressing, images (other than svg), video, fonts etc. are already compressed
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+}
+
+
+class Compressor:
+    """Compress eligible website files, caching the output by the source file's hash."""
+
+    # files smaller than this gain nothing from compression
+    MIN_SIZE = 1024
+
+    # compressed output has to be at least this much smaller than the original to be used
+    MIN_SAVING = 0.1
+
+    # every content revision of every file adds a copy to the cache, so copies no sync has used for this long
+    # are removed, and past MAX_BYTES the least recently used ones go too
+    MAX_AGE_DAYS = 30
+    MAX_BYTES = 1024 ** 3
+
+    def __init__(self, encoding='gzip'):
+        """Create a Compressor for gzip or br (brotli) encoding."""
+        if encoding not in ('gzip', 'br'):
+            raise ValueError(f"Unknown compression {encoding}, use gzip or br")
+        if encoding == 'br' and brotli is None:
+            raise ValueError("brotli compression needs the brotli package (pip install brotli)")
+
+        self.encoding = encoding
+        self.cache_dir = CACHE_DIR / 'compressed'
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # names of the cached copies this Compressor has used, pruning never removes them
+        self.used = set()
+
+    @staticmethod
+    def eligible(key, size):
+        """Return True if the file's content type is worth compressing."""
+        return size >= Compressor.MIN_SIZE and mimetypes.guess_type(key)[0] in COMPRESSIBLE_TYPES
+
+    def compress_data(self, data):
+        """Compress data with this Compressor's encoding."""
+        if self.encoding == 'br':
+            return brotli.compress(data)
+        # mtime=0 keeps the output identical for identical input, so unchanged files keep the same etag
+        # (gzip.compress only takes mtime from python 3.8, so the GzipFile is used directly)
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as file:
+            file.write(data)
+        return buffer.getvalue()
+
+    def compress(self, path, key, size, source_etag):
+        """Return the path of the compressed copy of path, or None if the file isn't worth compressing."""
+        if not self.eligible(key, size):
+            return None
+
+        # the cache is keyed by the source file's etag, so identical files share one compressed copy
+        name = source_etag.strip('"') + '.' + self.encoding
+        compressed = self.cache_dir / name
+        skipped = self.cache_dir / (name + '.skip')  # marks files that didn't compress well enough
+
+        self.used.update((name, name + '.skip'))
+        for cached in (compressed, skipped):
+            try:
+                # the modification time records when a copy was last used, for prune
+                os.utime(cached)
+                return str(compressed) if cached is compressed else None
+            except FileNotFoundError:
+                pass
+
+        with open(path, 'rb') as file:
+            data = self.compress_data(file.read())
+
+        # written under a unique name first as two workers may be compressing identical files at once
+        target = compressed if len(data) <= size * (1 - self.MIN_SAVING) else skipped
+        temporary = self.cache_dir / f"{name}.{uuid.uuid4()}.tmp"
+        temporary.write_bytes(data if target is compressed else b'')
+        os.replace(temporary, target)
+
+        return str(compressed) if target is compressed else None
+
+    def prune(self, max_age_days=MAX_AGE_DAYS, max_bytes=MAX_BYTES):
+        """Remove cached copies unused for max_age_days, then the least recently used past max_bytes.
+
+        Copies this Compressor used are kept, the sync they were made for still has to upload them.
+        Return the number of files removed.
+        """
+        cutoff = time.time() - max_age_days * 24 * 3600
+        entries = []
+        with os.scandir(self.cache_dir) as scan:
+            for entry in scan:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.name in self.used, stat.st_mtime, stat.st_size, entry.name))
+
+        removed = 0
+        total = 0
+        # the copies in use count towards max_bytes first, then the rest from the most recently used
+        for _, mtime, size, name in sorted(entries, reverse=True):
+            total += size
+            # a .tmp file may be another sync's copy being written, only an old one is left over from a crash
+            if name in self.used or (name.endswith('.tmp') and mtime >= cutoff):
+                continue
+            if mtime < cutoff or total > max_bytes:
+                try:
+                    os.remove(self.cache_dir / name)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+
+        return removed
@@ -0,0 +1,204 @@
+"""Deploy many sites in one run.
+
+Sites are listed in a JSON (or YAML, if PyYAML is installed) file:
+
+    {
+        "concurrency": 8,
+        "rate_limits": {"route53": 5, "cloudfront": 5, "acm": 10},
+        "sites": [
+            {"bucket": "www.example.com", "root": "sites/example/dist", "region": "us-west-2",
+             "domain": "example.com", "cdn": true},
+            {"bucket": "docs.example.com", "root": "sites/docs/build", "domain": "example.com"}
+        ]
+    }
+
+Every site's bucket is set up and synced, then its domain points at the bucket,
+or at a CloudFront distribution when "cdn" is true. "domain" is optional, "region" defaults to the command line one.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError, WaiterError
+
+from bucket import BucketManager
+from ratecontrol import DEFAULT_RATES
+import util
+
+try:
+    import yaml  # optional, only needed for YAML site files
+except ImportError:
+    yaml = None
+
+# sites deployed at the same time unless the site file says otherwise
+CONCURRENCY = 8
+
+
+def load_sites(path, region):
+    """Load a site file. Return its settings with defaults filled in."""
+    with open(path, encoding='utf-8') as file:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError("YAML site files need the PyYAML package (pip install pyyaml)")
+            config = yaml.safe_load(file)
+        else:
+            config = json.load(file)
+
+    # a plain list of sites is fine too
+    if isinstance(config, list):
+        config = {'sites': config}
+
+    for index, site in enumerate(config['sites']):
+        missing = {'bucket', 'root'} - set(site)
+        if missing:
+            raise ValueError(f"Site {index + 1} is missing {', '.join(sorted(missing))}")
+        site.setdefault('region', region)
+        site.setdefault('domain', None)
+        site.setdefault('cdn', False)
+
+    config['rate_limits'] = dict(DEFAULT_RATES, **config.get('rate_limits', {}))
+    config.setdefault('concurrency', CONCURRENCY)
+    return config
+
+
+class SiteDeployer:
+    """Deploy sites concurrently, sharing one set of managers (and so one client per service) between them."""
+
+    def __init__(self, bucket_manager, domain_manager, cert_manager, dist_manager, workers=10, hash_workers=None,
+                 concurrency=CONCURRENCY, rate_control=None, rate_limits=None):
+        """Create a SiteDeployer, rate_limits maps service names (eg route53) to requests a second.
+
+        The limits are set on rate_control, the RateControl installed on the managers' session.
+        """
+        self.bucket_manager = bucket_manager
+        self.domain_manager = domain_manager
+        self.cert_manager = cert_manager
+        self.dist_manager = dist_manager
+        self.workers = workers
+        self.hash_workers = hash_workers
+        self.concurrency = concurrency
+
+        # each service's requests wait on its own token bucket, whichever site's request it is
+        if rate_control:
+            for service, rate in (rate_limits or {}).items():
+                rate_control.set_rate(service, rate)
+
+        # finding or creating a zone or distribution has to happen once,
+        # even when several sites need the same one at the same time
+        self.zone_lock = threading.Lock()
+        self.dist_lock = threading.Lock()
+
+    def find_or_create_zone(self, domain_name):
+        """Find the hosted zone for domain_name, creating it if there isn't one."""
+        with self.zone_lock:
+            return self.domain_manager.find_hosted_zone(domain_name) \
+                or self.domain_manager.create_hosted_zone(domain_name)
+
+    def setup_cdn(self, site, changed_keys):
+        """Set up site's CloudFront distribution if needed and queue its dns records. Return a status message."""
+        fqdn = site['bucket']
+        with self.dist_lock:
+            dist = self.dist_manager.find_matching_dist(fqdn)
+            created = not dist
+            if created:
+                cert = self.cert_manager.find_matching_cert(fqdn)
+                if not cert:  # SSL is not optional at this time
+                    raise ValueError(f"No matching cert found for {fqdn}")
+                dist = self.dist_manager.create_dist(fqdn, cert)
+
+        if created:
+            self.dist_manager.await_deploy(dist)
+        elif changed_keys:
+            # an existing distribution is still caching the files the sync just replaced
+            self.dist_manager.invalidate(dist['Id'], changed_keys)
+
+        zone = self.find_or_create_zone(site['domain'])
+        self.domain_manager.create_cf_domain_record(zone, fqdn, dist['DomainName'], defer=True)
+        return f"https://{fqdn}"
+
+    def setup_domain(self, site):
+        """Queue the dns record pointing site's domain at its bucket. Return a status message."""
+        fqdn = site['bucket']
+        zone = self.find_or_create_zone(site['domain'])
+        endpoint = util.get_endpoint(site['region'])
+        self.domain_manager.create_s3_domain_record(zone, fqdn, endpoint, defer=True)
+        return f"http://{fqdn}"
+
+    def deploy_site(self, site):
+        """Set up, sync and point DNS at one site. Return a summary dict of how it went."""
+        result = {'bucket': site['bucket'], 'changed': 0, 'errors': [], 'url': None, 'failed_step': None}
+        start = time.perf_counter()
+        step = 'setup_bucket'
+        try:
+            # every site needs its own BucketManager as sync keeps state, and its own s3 resource
+            # as resources aren't thread safe, but they all share one client
+            site_manager = BucketManager(self.bucket_manager.session, workers=self.workers,
+                                         hash_workers=self.hash_workers, s3=self.bucket_manager.s3,
+                                         bandwidth_limiter=self.bucket_manager.tuner.limiter)
+            s3_bucket = site_manager.initialize_bucket(site['bucket'], site['region'])
+            site_manager.set_policy(s3_bucket)
+            site_manager.configure_website(s3_bucket)
+
+            step = 'sync'
+            result['errors'] = site_manager.sync(site['root'], site['bucket'], include=site.get('include', ()),
+                                                 exclude=site.get('exclude', ()), compression=site.get('compress'))
+            result['changed'] = len(site_manager.changed_keys)
+            result['url'] = site_manager.get_bucket_url(s3_bucket)
+
+            if site['domain'] and site['cdn']:
+                step = 'setup_cdn'
+                result['url'] = self.setup_cdn(site, site_manager.changed_keys)
+            elif site['domain']:
+                step = 'setup_domain'
+                result['url'] = self.setup_domain(site)
+        except (BotoCoreError, ClientError, WaiterError, OSError, ValueError) as err:
+            # one broken site shouldn't stop the rest from deploying
+            result['failed_step'] = f"{step}: {err}"
+
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    def deploy_all(self, sites):
+        """Deploy sites, up to concurrency of them at once. Return their summaries in the order given."""
+        # the indexes are built once up front rather than by whichever sites happen to need them first
+        if any(site['domain'] for site in sites):
+            self.domain_manager.load_zone_trie()
+        if any(site['domain'] and site['cdn'] for site in sites):
+            self.dist_manager.load_alias_index()
+            self.cert_manager.load_san_index()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = list(executor.map(self.deploy_site, sites))
+
+        # every site's dns records were queued, so they go to route53 in a handful of calls
+        # and all of the changes are waited on together
+        change_ids, failed = self.domain_manager.flush_changes()
+        for name, err in failed:
+            for result in results:
+                if result['bucket'] == name.rstrip('.') and not result['failed_step']:
+                    result['failed_step'] = f"dns: {err}"
+
+        print(f"Waiting for {len(change_ids)} dns change(s) to reach every route53 server...")
+        not_in_sync = self.domain_manager.await_changes(change_ids)
+        if not_in_sync:
+            print(f"{len(not_in_sync)} dns change(s) still pending: {', '.join(not_in_sync)}")
+
+        return results
+
+    @staticmethod
+    def report(results):
+        """Print a summary of every site's deployment."""
+        print()
+        print(f"{'site':<40} {'changed':>8} {'errors':>7} {'seconds':>8}  result")
+        print("-" * 90)
+        for result in results:
+            outcome = f"FAILED at {result['failed_step']}" if result['failed_step'] else result['url']
+            print(f"{result['bucket']:<40} {result['changed']:>8} {len(result['errors']):>7} "
+                  f"{result['seconds']:>8.1f}  {outcome}")
+
+        failed = sum(1 for result in results if result['failed_step'] or result['errors'])
+        print("-" * 90)
+        print(f"{len(results)} site(s), {failed} with problems, "
+              f"{sum(result['changed'] for result in results)} file(s) changed")
@@ -1,79 +1,216 @@
+"""Classes for Route 53 Domains."""
+
+import threading
+import time
 import uuid
 
-"""Classes for Route 53 Domains."""
+from botocore.exceptions import ClientError
+
+from cache import IndexCache
+
+# entry in a zone trie node holding the zone for the name the node spells out, can't clash with a dns label
+ZONE = ''
+
+
+def reversed_labels(domain_name):
+    """Split domain_name into its labels, top level domain first (eg www.example.com -> com, example, www)."""
+    return reversed(domain_name.lower().rstrip('.').split('.'))
 
 
 class DomainManager:
     """Manage a Route 53 Domain."""
 
-    def __init__(self, session):
-        """Create Domain Manager Object."""
+    # route53 allows 1000 records per change batch and counts an UPSERT as two
+    MAX_BATCH_CHANGES = 500
+
+    def __init__(self, session, refresh=False):
+        """Create Domain Manager Object, refresh=True rebuilds the cached zone trie."""
         self.session = session
         self.route53_client = self.session.client('route53')
 
+        # trie of hosted zones keyed by reversed labels, built on first use and cached on disk per aws profile
+        self.index_cache = IndexCache(f"zones-{session.profile_name}")
+        self.zone_trie = None
+        self.refresh = refresh
+        self.from_disk = False  # True while zone_trie is the one read from disk, which may be missing newer zones
+
+        # changes queued by zone id, then by (record name, type), until flush_changes sends them
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def add_zone(trie, zone):
+        """Add zone to trie, a public zone wins over a private zone with the same name."""
+        node = trie
+        for label in reversed_labels(zone['Name']):
+            node = node.setdefault(label, {})
+
+        private = zone.get('Config', {}).get('PrivateZone', False)
+        if ZONE not in node or not private:
+            node[ZONE] = {'Id': zone['Id'], 'Name': zone['Name'], 'Config': {'PrivateZone': private}}
+
     # getting a list of all Route53 DNS Zones in account
-    def find_hosted_zone(self, domain_name):
-        """Find zone matching domain_name."""
+    def build_zone_trie(self):
+        """List every hosted zone once and index them in a trie of reversed labels."""
+        trie = {}
         paginator = self.route53_client.get_paginator('list_hosted_zones')
         for page in paginator.paginate():
             for zone in page['HostedZones']:
-                if domain_name.endswith(zone['Name'][:-1]):  # not including final . in domain
-                    return zone
+                self.add_zone(trie, zone)
+
+        return trie
+
+    def load_zone_trie(self):
+        """Return the zone trie, from the disk cache unless it has expired or a refresh was asked for."""
+        if self.zone_trie is None:
+            self.zone_trie = None if self.refresh else self.index_cache.load()
+            self.from_disk = self.zone_trie is not None
+            if self.zone_trie is None:
+                self.rebuild_zone_trie()
+
+        return self.zone_trie
+
+    def rebuild_zone_trie(self):
+        """List the hosted zones again and cache the new trie. Return it."""
+        self.zone_trie = self.build_zone_trie()
+        self.index_cache.save(self.zone_trie)
+        self.from_disk = False
+        return self.zone_trie
+
+    @staticmethod
+    def lookup_zone(trie, domain_name):
+        """Return the longest zone in trie containing domain_name, None if there isn't one."""
+        # walking the trie a label at a time only matches whole labels (example.com isn't in zone ample.com)
+        # and the last zone passed is the longest one containing domain_name
+        zone = None
+        node = trie
+        for label in reversed_labels(domain_name):
+            node = node.get(label)
+            if node is None:
+                break
+            zone = node.get(ZONE, zone)
+
+        return zone
+
+    def find_hosted_zone(self, domain_name):
+        """Find zone matching domain_name."""
+        zone = self.lookup_zone(self.load_zone_trie(), domain_name)
+
+        # a zone created since the trie was cached (by another run, or in the console) isn't in it,
+        # and callers create a zone when none is found, so the trie is rebuilt once before giving up
+        if zone is None and self.from_disk:
+            zone = self.lookup_zone(self.rebuild_zone_trie(), domain_name)
 
         # we'll either get a zone matching our domain or None
-        return None  # of no matching zone/domain_names found
+        return zone
 
     def create_hosted_zone(self, domain_name):
         """Create a hosted zone to match domain_name."""
         # Get last two elements of split list to get the zone/domain name (eg eureka software)
         zone_name = '.'.join(domain_name.split('.')[-2:]) + '.'  # be sure to end with a .
-        return self.route53_client.create_hosted_zone(
+        zone = self.route53_client.create_hosted_zone(
             Name=zone_name,
             # unique string created by the caller
             # intended to avoid sending the same request multiple times
             CallerReference=str(uuid.uuid4())  # using uuid to generate random unique id
-        )
+        )['HostedZone']
+
+        # the new zone goes straight into the trie so it's found without rebuilding it
+        self.add_zone(self.load_zone_trie(), zone)
+        self.index_cache.save(self.zone_trie)
+
+        return zone
+
+    @staticmethod
+    def alias_change(domain_name, record_type, zone_id, dns_name):
+        """Build an UPSERT of an alias record."""
+        return {
+            'Action': 'UPSERT',  # if it exists update, if not insert
+            'ResourceRecordSet': {
+                'Name': domain_name,
+                'Type': record_type,
+                'AliasTarget': {
+                    'HostedZoneId': zone_id,
+                    'DNSName': dns_name,
+                    'EvaluateTargetHealth': False
+                }
+            }
+        }
+
+    def change_records(self, zone, changes, defer=False):
+        """Send changes to zone in one call, or queue them for flush_changes when defer is True."""
+        if defer:
+            with self.lock:
+                for change in changes:
+                    # a batch can't change the same record twice, so a later change to it replaces the queued one
+                    record = change['ResourceRecordSet']
+                    name = record['Name'].rstrip('.').lower()
+                    self.pending.setdefault(zone['Id'], {})[(name, record['Type'])] = change
+            return None
 
-    def create_s3_domain_record(self, zone, domain_name, endpoint):
-        """Create a dns record in zone for domain_name."""
         return self.route53_client.change_resource_record_sets(
             HostedZoneId=zone['Id'],
             ChangeBatch={
                 'Comment': 'Created by The Webinator',
-                'Changes': [{
-                        'Action': 'UPSERT',  # if it exists update, if not insert
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'HostedZoneId': endpoint.dns_zone,
-                                'DNSName': endpoint.host,
-                                'EvaluateTargetHealth': False
-                            }
-                        }
-                    }
-                ]
+                'Changes': changes
             }
         )
 
-    def create_cf_domain_record(self, zone, domain_name, cf_domain):
+    def create_s3_domain_record(self, zone, domain_name, endpoint, defer=False):
         """Create a dns record in zone for domain_name."""
-        return self.route53_client.change_resource_record_sets(
-            HostedZoneId=zone['Id'],
-            ChangeBatch={
-                'Comment': 'Created by The Webinator',
-                'Changes': [{
-                        'Action': 'UPSERT',  # if it exists update, if not insert
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'HostedZoneId': 'Z2FDTNDATAQYW2',  # this id is the same for all CF distributions
-                                'DNSName': cf_domain,
-                                'EvaluateTargetHealth': False
-                            }
+        return self.change_records(zone, [
+            self.alias_change(domain_name, 'A', endpoint.dns_zone, endpoint.host)
+        ], defer)
+
+    def create_cf_domain_record(self, zone, domain_name, cf_domain, defer=False):
+        """Create dns records in zone for domain_name."""
+        # this id is the same for all CF distributions
+        # an AAAA record alongside the A record lets clients reach the distribution over IPv6
+        return self.change_records(zone, [
+            self.alias_change(domain_name, 'A', 'Z2FDTNDATAQYW2', cf_domain),
+            self.alias_change(domain_name, 'AAAA', 'Z2FDTNDATAQYW2', cf_domain)
+        ], defer)
+
+    def flush_changes(self):
+        """Send every queued change, a zone's changes in as few calls as allowed.
+
+        Return the ids of the changes sent and a list of (record name, error) for records that failed.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        change_ids = []
+        failed = []
+        for zone_id, changes in pending.items():
+            changes = list(changes.values())
+            for start in range(0, len(changes), self.MAX_BATCH_CHANGES):
+                batch = changes[start:start + self.MAX_BATCH_CHANGES]
+                try:
+                    response = self.route53_client.change_resource_record_sets(
+                        HostedZoneId=zone_id,
+                        ChangeBatch={
+                            'Comment': 'Created by The Webinator',
+                            'Changes': batch
                         }
-                    }
-                ]
-            }
-        )
+                    )
+                    change_ids.append(response['ChangeInfo']['Id'])
+                except ClientError as err:
+                    # the whole batch is rejected together, other zones and batches still go ahead
+                    failed.extend((change['ResourceRecordSet']['Name'], err) for change in batch)
+
+        return change_ids, failed
+
+    def await_changes(self, change_ids, max_wait=600, first_delay=2, max_delay=30):
+        """Poll until every change in change_ids is INSYNC, backing off between rounds. Return those that aren't."""
+        # all of the changes are checked each round rather than waiting on them one after another
+        deadline = time.monotonic() + max_wait
+        delay = first_delay
+        pending = list(change_ids)
+        while pending and time.monotonic() < deadline:
+            pending = [change_id for change_id in pending
+                       if self.route53_client.get_change(Id=change_id)['ChangeInfo']['Status'] != 'INSYNC']
+            if pending:
+                time.sleep(min(delay, max(0, deadline - time.monotonic())))
+                delay = min(delay * 2, max_delay)
+
+        return pending
@@ -0,0 +1,89 @@
+"""Generate S3 etags for local files.
+
+The way AWS works is that it takes a hash of each chunk (part) of the data
+and then takes a hash of those hashes - this becomes the etag of the file.
+Files uploaded in a single request just get the md5 hash of the whole file.
+"""
+
+import math
+from hashlib import md5
+
+# limits s3transfer applies to the multipart chunk size it is given
+# (see s3transfer.utils.ChunksizeAdjuster), we apply the same limits so our etags match
+MIN_CHUNK_SIZE = 5 * 1024 ** 2
+MAX_CHUNK_SIZE = 5 * 1024 ** 3
+MAX_PARTS = 10000
+
+# size of the single buffer every file is read through
+READ_SIZE = 1024 ** 2
+
+
+def adjust_chunk_size(chunk_size, file_size):
+    """Get the part size s3transfer will really use for a file of file_size bytes."""
+    # every upload, resumed and async ones included, uses this part size, so a file always gets the same etag
+    # and objects uploaded by plain s3transfer (or an older webinator) aren't uploaded again just to change it
+    chunk_size = min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+    # s3 allows at most 10000 parts, s3transfer doubles the chunk size until the file fits
+    while math.ceil(file_size / chunk_size) > MAX_PARTS:
+        chunk_size *= 2
+
+    return chunk_size
+
+
+def file_etag(path, chunk_size, threshold):
+    """Generate the etag S3 will give path when uploaded with this chunk size and multipart threshold."""
+    # one buffer per file, every read goes into it instead of allocating a new bytes object per read
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+
+    with open(path, 'rb') as file:
+        file.seek(0, 2)  # jump to the end of the file to find its size
+        size = file.tell()
+        file.seek(0)
+
+        # s3transfer only uses a multipart upload when the file is at least multipart_threshold bytes
+        if size < threshold:
+            file_hash = md5()
+            while True:
+                count = file.readinto(buffer)
+                if not count:
+                    break
+                file_hash.update(view[:count])
+
+            # note the etag uses a double quote. So the etag string also includes double quotes in the string
+            return f'"{file_hash.hexdigest()}"'
+
+        chunk_size = adjust_chunk_size(chunk_size, size)
+
+        # each part's digest is folded into the etag hash as soon as the part is done
+        # so only the hash of the current part is kept around, never a list of them
+        etag_hash = md5()
+        parts = 0
+        while True:
+            part_hash = md5()
+            remaining = chunk_size
+            while remaining:
+                count = file.readinto(view[:min(remaining, READ_SIZE)])
+                if not count:
+                    break
+                part_hash.update(view[:count])
+                remaining -= count
+
+            if remaining == chunk_size:  # nothing was read, we're past the last part
+                break
+
+            etag_hash.update(part_hash.digest())
+            parts += 1
+
+    return f'"{etag_hash.hexdigest()}-{parts}"'
+
+
+def parts_etag(part_etags):
+    """Combine the etags S3 gave each part of a multipart upload (in part order) into the etag of the object."""
+    # a part's etag is the md5 of that part, so this is the same hash file_etag builds from the file itself
+    etag_hash = md5()
+    for part_etag in part_etags:
+        etag_hash.update(bytes.fromhex(part_etag.strip('"')))
+
+    return f'"{etag_hash.hexdigest()}-{len(part_etags)}"'
@@ -0,0 +1,162 @@
+"""Compact in-memory manifest of the objects in an S3 bucket.
+
+A plain dict of key -> etag string costs well over 150 bytes per object, which adds up to gigabytes
+for buckets with tens of millions of objects. Manifest keeps the same dict style interface but stores:
+
+- each key prefix (the "directory" part of the key) once, shared by every key under it
+- the rest of each key in a sorted list per prefix, looked up with a binary search
+- each etag as a 20 byte record (16 byte md5 digest + part count) in one bytearray per prefix
+"""
+
+import struct
+from bisect import bisect_left
+
+# md5 digest followed by the number of parts (0 for an object uploaded in a single part)
+RECORD = struct.Struct('<16sI')
+
+
+def pack_etag(etag):
+    """Pack an S3 etag string into a 20 byte record, or return None if it isn't an md5 style etag."""
+    digest, _, parts = etag.strip('"').partition('-')
+    try:
+        return RECORD.pack(bytes.fromhex(digest), int(parts or 0)) if len(digest) == 32 else None
+    except ValueError:
+        return None
+
+
+def unpack_etag(records, index=0):
+    """Turn the index'th 20 byte record in records back into the etag string S3 would report."""
+    digest, parts = RECORD.unpack_from(records, index * RECORD.size)
+    return f'"{digest.hex()}-{parts}"' if parts else f'"{digest.hex()}"'
+
+
+class _Prefix:
+    """The keys and etag records under one key prefix."""
+
+    __slots__ = ('names', 'records')
+
+    def __init__(self):
+        """Create an empty prefix."""
+        self.names = []
+        self.records = bytearray()
+
+    def find(self, name):
+        """Return the index of name, or None if it isn't under this prefix."""
+        index = bisect_left(self.names, name)
+        if index < len(self.names) and self.names[index] == name:
+            return index
+        return None
+
+
+class Manifest:
+    """Map of S3 key -> etag for a bucket, stored compactly."""
+
+    __slots__ = ('prefixes', 'other')
+
+    def __init__(self):
+        """Create an empty manifest."""
+        self.prefixes = {}
+
+        # the odd etag that isn't an md5 (eg objects encrypted with KMS) is kept as a plain string
+        self.other = {}
+
+    @staticmethod
+    def split(key):
+        """Split key into its prefix (including the final /) and name."""
+        prefix, separator, name = key.rpartition('/')
+        return prefix + separator, name
+
+    def __setitem__(self, key, etag):
+        """Set the etag for key."""
+        record = pack_etag(etag)
+        if record is None:
+            self.pop(key, None)
+            self.other[key] = etag
+            return
+        self.other.pop(key, None)
+
+        prefix, name = self.split(key)
+        entries = self.prefixes.get(prefix)
+        if entries is None:
+            entries = self.prefixes[prefix] = _Prefix()
+
+        # bucket listings come back in key order, so most keys are simply appended to the end
+        if not entries.names or name > entries.names[-1]:
+            entries.names.append(name)
+            entries.records += record
+            return
+
+        index = bisect_left(entries.names, name)
+        offset = index * RECORD.size
+        if index < len(entries.names) and entries.names[index] == name:
+            entries.records[offset:offset + RECORD.size] = record
+        else:
+            entries.names.insert(index, name)
+            entries.records[offset:offset] = record
+
+    def get(self, key, default=None):
+        """Return the etag for key, or default if key isn't in the manifest."""
+        prefix, name = self.split(key)
+        entries = self.prefixes.get(prefix)
+        index = entries.find(name) if entries else None
+        if index is None:
+            return self.other.get(key, default)
+
+        return unpack_etag(entries.records, index)
+
+    def __getitem__(self, key):
+        """Return the etag for key."""
+        etag = self.get(key)
+        if etag is None:
+            raise KeyError(key)
+        return etag
+
+    def __contains__(self, key):
+        """Return True if key is in the manifest."""
+        return self.get(key) is not None
+
+    def pop(self, key, default=None):
+        """Remove key from the manifest and return its etag, or default if it wasn't there."""
+        if key in self.other:
+            return self.other.pop(key)
+
+        prefix, name = self.split(key)
+        entries = self.prefixes.get(prefix)
+        index = entries.find(name) if entries else None
+        if index is None:
+            return default
+
+        etag = unpack_etag(entries.records, index)
+        offset = index * RECORD.size
+        del entries.names[index]
+        del entries.records[offset:offset + RECORD.size]
+        if not entries.names:
+            del self.prefixes[prefix]
+        return etag
+
+    def __delitem__(self, key):
+        """Remove key from the manifest."""
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+    def __len__(self):
+        """Return the number of keys in the manifest."""
+        return sum(len(entries.names) for entries in self.prefixes.values()) + len(self.other)
+
+    def items(self):
+        """Generate (key, etag) pairs."""
+        for prefix, entries in self.prefixes.items():
+            for index, name in enumerate(entries.names):
+                yield prefix + name, unpack_etag(entries.records, index)
+        yield from self.other.items()
+
+    def keys(self):
+        """Generate every key in the manifest."""
+        for prefix, entries in self.prefixes.items():
+            for name in entries.names:
+                yield prefix + name
+        yield from self.other
+
+    def __iter__(self):
+        """Iterate over the keys in the manifest."""
+        return self.keys()
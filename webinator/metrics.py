@@ -0,0 +1,179 @@
+"""Timers, counters and request latencies of a sync.
+
+A SyncMetrics is filled in while a sync runs (phase timers, byte and object counters)
+and by botocore event hooks on the S3 client (per request latency, retries and throttling).
+It can be written out as a JSON report or as a Prometheus textfile for node_exporter's textfile collector.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the request latency histogram buckets, the last one catches everything else
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# error codes AWS answers with when it is throttling requests
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                  'TooManyRequestsException', 'RequestThrottled', 'ProvisionedThroughputExceededException'}
+
+
+class Histogram:
+    """Count of observations falling into each of the LATENCY_BUCKETS, with their total."""
+
+    def __init__(self):
+        """Create an empty Histogram."""
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add an observation."""
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def percentile(self, fraction):
+        """Estimate the percentile at fraction (between 0 and 1) as the upper bound of the bucket it falls in."""
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= wanted:
+                # the last bucket has no upper bound, the largest finite one is as close as we can get
+                return bound if bound != float('inf') else LATENCY_BUCKETS[-2]
+        return 0.0
+
+
+class SyncMetrics:
+    """Collect the timings and counts of a sync, from any number of threads."""
+
+    def __init__(self):
+        """Create an empty SyncMetrics."""
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything collected so far, eg at the start of another sync."""
+        with self.lock:
+            self.started = time.time()
+            self.phases = {}  # phase name -> seconds spent in it
+            self.counters = {}  # counter name -> value
+            self.latencies = {}  # operation name (eg PutObject) -> Histogram
+            self.retries = {}  # operation name -> requests that were retries
+            self.throttles = {}  # operation name -> requests AWS throttled
+
+    @contextmanager
+    def phase(self, name):
+        """Time the code inside the with block as phase name, adding to any earlier time in the same phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        """Add amount to the counter name."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def attach(self, client):
+        """Time every request a boto3 (or aiobotocore) client sends and count its retries and throttled requests."""
+        def request_sent(request, **kwargs):
+            """Note when the request went out (returning None lets it carry on)."""
+            # the context is shared by every attempt of one API call, and belongs to that call alone
+            request.context['metrics_sent'] = time.perf_counter()
+
+        def response_received(context, parsed_response=None, event_name='', **kwargs):
+            """Record the latency of the attempt that just finished."""
+            sent = context.pop('metrics_sent', None)
+            if sent is None:
+                return
+            elapsed = time.perf_counter() - sent
+            operation = event_name.rpartition('.')[2]
+            error_code = (parsed_response or {}).get('Error', {}).get('Code')
+
+            with self.lock:
+                self.latencies.setdefault(operation, Histogram()).observe(elapsed)
+                if context.get('retries', {}).get('attempt', 1) > 1:
+                    self.retries[operation] = self.retries.get(operation, 0) + 1
+                if error_code in THROTTLE_CODES:
+                    self.throttles[operation] = self.throttles.get(operation, 0) + 1
+
+        # registered last so time spent waiting on a rate limiter doesn't count as latency
+        client.meta.events.register_last('before-send', request_sent)
+        client.meta.events.register('response-received', response_received)
+
+    def report(self):
+        """Return everything collected as a dict, ready for json."""
+        with self.lock:
+            requests = {}
+            for operation, histogram in sorted(self.latencies.items()):
+                requests[operation] = {
+                    'count': histogram.count,
+                    'seconds': round(histogram.total, 6),
+                    'p50': histogram.percentile(0.5),
+                    'p90': histogram.percentile(0.9),
+                    'p99': histogram.percentile(0.99),
+                    'retries': self.retries.get(operation, 0),
+                    'throttles': self.throttles.get(operation, 0),
+                }
+
+            return {
+                'started': self.started,
+                'phases': {name: round(seconds, 6) for name, seconds in self.phases.items()},
+                'counters': dict(self.counters),
+                'requests': requests,
+            }
+
+    def save_json(self, path):
+        """Write the report to path as JSON."""
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.report(), file, indent=2)
+
+    def save_prometheus(self, path, labels=None):
+        """Write the metrics to path in the Prometheus text format, labels (a dict) is added to every sample."""
+        base = ','.join(f'{name}="{value}"' for name, value in sorted((labels or {}).items()))
+
+        def sample(metric, value, **extra):
+            """Format one sample line."""
+            pairs = ','.join(filter(None, [base] + [f'{label}="{text}"' for label, text in extra.items()]))
+            return f"{metric}{{{pairs}}} {value}" if pairs else f"{metric} {value}"
+
+        with self.lock:
+            lines = ['# TYPE webinator_sync_phase_seconds gauge']
+            lines += [sample('webinator_sync_phase_seconds', seconds, phase=name)
+                      for name, seconds in sorted(self.phases.items())]
+
+            lines.append('# TYPE webinator_sync_total gauge')
+            lines += [sample('webinator_sync_total', value, counter=name)
+                      for name, value in sorted(self.counters.items())]
+
+            lines.append('# TYPE webinator_request_seconds histogram')
+            for operation, histogram in sorted(self.latencies.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(sample('webinator_request_seconds_bucket', cumulative, operation=operation, le=le))
+                lines.append(sample('webinator_request_seconds_sum', histogram.total, operation=operation))
+                lines.append(sample('webinator_request_seconds_count', histogram.count, operation=operation))
+
+            lines.append('# TYPE webinator_request_retries_total counter')
+            lines += [sample('webinator_request_retries_total', count, operation=operation)
+                      for operation, count in sorted(self.retries.items())]
+            lines.append('# TYPE webinator_request_throttles_total counter')
+            lines += [sample('webinator_request_throttles_total', count, operation=operation)
+                      for operation, count in sorted(self.throttles.items())]
+
+        # the textfile collector may read the file at any moment, so it is replaced in one go
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temporary, path)
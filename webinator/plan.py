@@ -0,0 +1,34 @@
+"""Work out what a sync has to do by comparing the local and remote manifests.
+
+Both manifests map an S3 key to its etag. The local one is built by hashing the website files,
+the remote one is loaded from the bucket listing.
+"""
+
+from collections import namedtuple
+
+# uploads - keys that are new or whose local etag differs from the one in the bucket
+# skips   - keys whose etags already match, nothing to do
+# deletes - keys in the bucket that no longer exist locally
+# updates - unchanged keys whose headers need updating (filled in later, only when a header policy is used)
+# copies  - (key, source key) pairs for new keys whose content is already in the bucket, or is being uploaded
+#           under another key, so they are copied server side rather than uploaded (filled in later)
+# each is a sorted list of keys, or of (key, source key) pairs
+SyncPlan = namedtuple('SyncPlan', ['uploads', 'skips', 'deletes', 'updates', 'copies'], defaults=[(), ()])
+
+
+def diff_manifests(local_manifest, remote_manifest, selects=None):
+    """Build a SyncPlan that makes remote_manifest match local_manifest.
+
+    Remote keys that selects returns False for are left alone rather than deleted.
+    """
+    # remote manifests can hold tens of millions of keys, so they are only ever streamed through
+    # and looked up one key at a time, never copied into a set
+    skips = {key for key, etag in local_manifest.items() if remote_manifest.get(key) == etag}
+    deletes = [key for key in remote_manifest.keys()
+               if key not in local_manifest and (selects is None or selects(key))]
+
+    return SyncPlan(
+        uploads=sorted(local_manifest.keys() - skips),
+        skips=sorted(skips),
+        deletes=sorted(deletes)
+    )
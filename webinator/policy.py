@@ -0,0 +1,95 @@
+r"""Rules for the Cache-Control and other headers objects are uploaded with.
+
+Rules live in a JSON file and are checked in order, the first rule matching a key wins:
+
+    {
+        "rules": [
+            {"match": "*.html", "headers": {"CacheControl": "no-cache"}},
+            {"regex": "\\.[0-9a-f]{8,}\\.(js|css)$",
+             "headers": {"CacheControl": "public, max-age=31536000, immutable"}},
+            {"match": "*", "headers": {"CacheControl": "public, max-age=3600"}}
+        ]
+    }
+
+"match" is a glob matched against the whole key, "regex" is a regular expression searched for in the key.
+Header names are the ones boto3 uses in ExtraArgs.
+"""
+
+import json
+import re
+from fnmatch import translate
+from hashlib import md5
+
+# headers a rule is allowed to set, all of them can be changed later with a copy in place
+ALLOWED_HEADERS = {
+    'CacheControl',
+    'ContentDisposition',
+    'ContentLanguage',
+    'Expires',
+    'Metadata',
+    'WebsiteRedirectLocation',
+}
+
+# user metadata entry holding a fingerprint of the headers an object was uploaded with
+FINGERPRINT_METADATA = 'webinator-headers'
+
+
+def fingerprint(extra_args):
+    """Get a short fingerprint of a set of upload headers."""
+    return md5(json.dumps(extra_args, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class HeaderPolicy:
+    """Ordered rules matching S3 keys to the headers they are uploaded with."""
+
+    def __init__(self, rules):
+        """Compile rules (a list of {"match" or "regex": ..., "headers": {...}} dicts)."""
+        self.headers = []
+        patterns = []
+        grouped = False
+        for index, rule in enumerate(rules):
+            unknown = set(rule['headers']) - ALLOWED_HEADERS
+            if unknown:
+                raise ValueError(f"Rule {index + 1} sets unsupported headers: {', '.join(sorted(unknown))}")
+
+            if 'match' in rule:
+                pattern = translate(rule['match'])
+            else:
+                try:
+                    grouped = grouped or re.compile(rule['regex']).groups > 0
+                except re.error as err:
+                    raise ValueError(f"Rule {index + 1} has an invalid regex: {err}") from err
+                pattern = '.*?(?:' + rule['regex'] + ')'
+            patterns.append(pattern)
+            self.headers.append(rule['headers'])
+
+        if grouped:
+            # group numbers and backreferences (eg \1) in a rule's regex would change meaning once folded into
+            # one regex with the other rules, so each rule is matched on its own instead
+            self.regex = None
+            self.rules = [re.compile(pattern) for pattern in patterns]
+        else:
+            # every rule is folded into one regex with a named group per rule
+            # the regex engine tries the alternatives in order, so a single match per key finds the first matching rule
+            self.regex = re.compile('|'.join(f"(?P<rule{index}>{pattern})"
+                                             for index, pattern in enumerate(patterns))) if patterns else None
+            self.rules = []
+
+    @classmethod
+    def load(cls, path):
+        """Load a HeaderPolicy from a JSON config file."""
+        with open(path, encoding='utf-8') as file:
+            return cls(json.load(file)['rules'])
+
+    def headers_for(self, key):
+        """Return the headers for key, an empty dict if no rule matches."""
+        if self.regex is None:
+            for index, regex in enumerate(self.rules):
+                if regex.match(key):
+                    return self.headers[index]
+            return {}
+
+        match = self.regex.match(key)
+        if match is None:
+            return {}
+        return self.headers[int(match.lastgroup[len('rule'):])]
@@ -0,0 +1,242 @@
+"""Rate control shared by every AWS client webinator creates.
+
+RateControl is installed on the botocore session before any client is made, so every manager's client inherits it:
+
+- requests wait on a token bucket per service, and per operation when one is configured (eg route53.GetChange)
+- the requests in flight to each service are capped by a limit that halves when the service throttles
+  (S3 SlowDown, Route53 Throttling, any 429 or 503) and grows back by one a round trip as requests succeed
+- retries use botocore's standard mode, which waits an exponential backoff with random jitter between attempts,
+  unless AWS_RETRY_MODE or the profile's retry_mode picks another one
+
+Async clients (eg AsyncBucketManager's aiobotocore client) are attached to the same buckets and limits one by one,
+waiting for them with asyncio.sleep rather than blocking the event loop.
+
+It counts how many requests each service throttled, and how long requests waited to be let through.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+from botocore.config import Config
+
+from metrics import THROTTLE_CODES
+from util import RateLimiter
+
+# requests a second allowed per service (or service.Operation) unless told otherwise
+# route53 allows 5 a second per account, the other services throttle not far beyond these
+DEFAULT_RATES = {
+    'route53': 5,
+    'cloudfront': 5,
+    'acm': 10,
+}
+
+# requests in flight to one service before any throttling has been seen
+MAX_IN_FLIGHT = 256
+
+# attempts per request (the first one included) before botocore gives up
+MAX_ATTEMPTS = 8
+
+# http statuses that mean the service is shedding load
+THROTTLE_STATUSES = {429, 503}
+
+
+def retry_settings(botocore_session, max_attempts=None):
+    """Get the retries client config for botocore_session, leaving alone whatever the user has configured.
+
+    max_attempts (eg from --Max_Attempts) overrides the user's setting, otherwise MAX_ATTEMPTS is only used
+    when neither AWS_MAX_ATTEMPTS nor the profile sets max_attempts.
+    """
+    retries = {}
+    if max_attempts:
+        retries['total_max_attempts'] = max_attempts
+    elif botocore_session.get_config_variable('max_attempts') is None:
+        retries['total_max_attempts'] = MAX_ATTEMPTS
+
+    # retry_mode defaults to legacy rather than None, so where it came from has to be checked directly
+    if not os.environ.get('AWS_RETRY_MODE') and 'retry_mode' not in botocore_session.get_scoped_config():
+        retries['mode'] = 'standard'
+    return retries
+
+
+class AdaptiveLimit:
+    """Limit on requests in flight that halves when the service throttles and grows back as requests succeed."""
+
+    # fraction of the requests in flight the limit drops to on throttling
+    BACKOFF = 0.5
+
+    # seconds after a decrease before the next one, a burst of throttled requests is a single signal
+    COOLDOWN = 1.0
+
+    def __init__(self, maximum, minimum=1):
+        """Create an AdaptiveLimit starting at maximum."""
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.lowest = self.limit
+        self.in_flight = 0
+        self.decreased = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot. Return the seconds waited."""
+        start = time.monotonic()
+        with self.condition:
+            while self.in_flight >= max(self.minimum, int(self.limit)):
+                self.condition.wait()
+            self.in_flight += 1
+        return time.monotonic() - start
+
+    def try_acquire(self):
+        """Take a free slot if there is one, without waiting. Return True if one was taken."""
+        with self.condition:
+            if self.in_flight >= max(self.minimum, int(self.limit)):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, throttled):
+        """Give a slot back, throttled is True or False, or None when the request failed for some other reason."""
+        with self.condition:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+
+            now = time.monotonic()
+            if throttled and now - self.decreased >= self.COOLDOWN:
+                # what was really in flight is halved, halving a limit far above it wouldn't slow anything down
+                self.limit = max(self.minimum, min(self.limit, in_flight) * self.BACKOFF)
+                self.lowest = min(self.lowest, self.limit)
+                self.decreased = now
+            elif throttled is False:
+                # one more slot for every limit's worth of successes, so roughly one a round trip
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+
+class RateControl:
+    """Token buckets and adaptive concurrency limits shared by every client of a botocore session."""
+
+    # seconds an async request waits between checks for a free slot
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, rates=None, max_in_flight=MAX_IN_FLIGHT, max_attempts=None):
+        """Create a RateControl, rates maps service names (eg route53) or service.Operation to requests a second.
+
+        max_attempts overrides the attempts per request the user has configured, see retry_settings.
+        """
+        self.rates = dict(DEFAULT_RATES, **(rates or {}))
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+
+        self.lock = threading.Lock()
+        self.buckets = {}  # service or service.Operation -> RateLimiter, made on first use
+        self.limits = {}  # service -> AdaptiveLimit, made on first use
+        self.stats = {}  # service -> {'requests': ..., 'throttled': ..., 'waited': ...}
+
+    def set_rate(self, name, rate):
+        """Allow rate requests a second to a service or service.Operation, a rate of None (or 0) lifts the limit."""
+        with self.lock:
+            self.rates[name] = rate
+            self.buckets.pop(name, None)
+
+    def install(self, botocore_session):
+        """Put every client created from botocore_session from now on under this RateControl.
+
+        Install it once the session's profile is set, so the retry settings in the profile are respected.
+        """
+        # clients made with a config of their own (eg a bigger connection pool) get these retries merged in
+        retries = retry_settings(botocore_session, self.max_attempts)
+        if retries:
+            config = Config(retries=retries)
+            current = botocore_session.get_default_client_config()
+            botocore_session.set_default_client_config(current.merge(config) if current else config)
+
+        botocore_session.register('before-send', self.before_send)
+        # needs-retry follows every attempt, whatever its outcome, so the slot taken in before-send is always returned
+        botocore_session.register('needs-retry', self.after_attempt)
+
+    def attach_async(self, client):
+        """Put an async client (eg from aiobotocore) under this RateControl."""
+        # aiobotocore awaits handlers returning a coroutine, so only before-send needs an async version
+        client.meta.events.register('before-send', self.before_send_async)
+        client.meta.events.register('needs-retry', self.after_attempt)
+
+    @staticmethod
+    def names(event_name):
+        """Split an event name (eg before-send.route-53.ChangeResourceRecordSets) into service and operation."""
+        _, service, operation = event_name.split('.', 2)
+        return service.replace('-', ''), operation
+
+    def state_for(self, service, operation):
+        """Get the token buckets and the AdaptiveLimit a request to service.operation waits on."""
+        with self.lock:
+            buckets = []
+            for name in (service, f"{service}.{operation}"):
+                if self.rates.get(name):
+                    if name not in self.buckets:
+                        self.buckets[name] = RateLimiter(self.rates[name])
+                    buckets.append(self.buckets[name])
+
+            if service not in self.limits:
+                self.limits[service] = AdaptiveLimit(self.max_in_flight)
+                self.stats[service] = {'requests': 0, 'throttled': 0, 'waited': 0.0}
+
+            return buckets, self.limits[service]
+
+    def before_send(self, request, event_name, **kwargs):
+        """Hold an attempt until its service lets it through (returning None lets it carry on)."""
+        service, operation = self.names(event_name)
+        buckets, limit = self.state_for(service, operation)
+
+        waited = sum(bucket.acquire() for bucket in buckets)
+        waited += limit.acquire()
+        request.context['rate_control'] = service
+
+        with self.lock:
+            self.stats[service]['requests'] += 1
+            self.stats[service]['waited'] += waited
+
+    async def before_send_async(self, request, event_name, **kwargs):
+        """Hold an async client's attempt until its service lets it through, without blocking the event loop."""
+        service, operation = self.names(event_name)
+        buckets, limit = self.state_for(service, operation)
+
+        start = time.monotonic()
+        for bucket in buckets:
+            await asyncio.sleep(bucket.reserve())
+        # the limit is shared with threads, so a slot freed by one of them can't wake a coroutine up
+        while not limit.try_acquire():
+            await asyncio.sleep(self.POLL_INTERVAL)
+        request.context['rate_control'] = service
+
+        with self.lock:
+            self.stats[service]['requests'] += 1
+            self.stats[service]['waited'] += time.monotonic() - start
+
+    def after_attempt(self, request_dict, response=None, caught_exception=None, **kwargs):
+        """Return the attempt's slot, telling the limit whether the service throttled it."""
+        # attempts another handler answered before ours ran (eg a stubbed client) never took a slot
+        service = request_dict['context'].pop('rate_control', None)
+        if service is None:
+            return
+
+        throttled = None
+        if response is not None:
+            http_response, parsed = response
+            code = parsed.get('Error', {}).get('Code')
+            throttled = http_response.status_code in THROTTLE_STATUSES or code in THROTTLE_CODES
+
+        self.limits[service].release(throttled)
+        if throttled:
+            with self.lock:
+                self.stats[service]['throttled'] += 1
+
+    def report(self):
+        """Return {service: stats} for every service requests were sent to."""
+        with self.lock:
+            return {
+                service: dict(stats, limit=int(self.limits[service].limit), lowest=int(self.limits[service].lowest))
+                for service, stats in sorted(self.stats.items())
+            }
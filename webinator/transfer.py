@@ -0,0 +1,86 @@
+"""Per-file transfer settings for uploads, and a bandwidth cap shared by all of them."""
+
+import math
+import threading
+import time
+
+from boto3.s3.transfer import TransferConfig
+
+from etag import adjust_chunk_size
+
+
+class TransferTuner:
+    """Choose the TransferConfig each upload uses and measure how fast uploads go.
+
+    The part size only depends on the file's size (it decides the object's etag),
+    the number of parts uploaded at once adapts to how many uploads share the connection pool
+    and, under a bandwidth cap, to how fast a single connection has been going.
+    """
+
+    # weight of the newest upload in the running average of per-connection throughput
+    SMOOTHING = 0.2
+
+    def __init__(self, chunk_size, threshold, connections, limiter=None):
+        """Create a TransferTuner for a client with a pool of connections, limiter caps the bytes per second."""
+        self.chunk_size = chunk_size
+        self.threshold = threshold
+        self.connections = connections
+        self.limiter = limiter
+
+        self.lock = threading.Lock()
+        self.active = 0  # uploads in progress
+        self.stream_rate = None  # average bytes per second of a single connection
+
+    def part_size(self, size):
+        """Get the part size for a file of size bytes."""
+        return adjust_chunk_size(self.chunk_size, size)
+
+    def concurrency(self, size):
+        """Get the number of parts of a file of size bytes to upload at once."""
+        if size < self.threshold:
+            return 1
+
+        # the connection pool is shared out between the uploads in progress,
+        # so the last big file of a sync gets every connection to itself
+        with self.lock:
+            concurrency = max(1, self.connections // max(1, self.active))
+            stream_rate = self.stream_rate
+
+        # under a bandwidth cap, more connections than it takes to fill it only add overhead
+        if self.limiter and stream_rate:
+            concurrency = min(concurrency, math.ceil(self.limiter.rate / stream_rate))
+
+        return max(1, min(concurrency, math.ceil(size / self.part_size(size))))
+
+    def config_for(self, size):
+        """Get the TransferConfig for a file of size bytes."""
+        return TransferConfig(
+            multipart_threshold=self.threshold,
+            multipart_chunksize=self.part_size(size),
+            max_concurrency=self.concurrency(size)
+        )
+
+    def throttle(self, count):
+        """Wait until count more bytes fit under the bandwidth cap (used as an s3transfer progress callback)."""
+        # s3transfer calls this from the thread sending the data, so waiting here slows the upload down
+        if self.limiter:
+            self.limiter.acquire(count)
+
+    def start(self):
+        """Note an upload starting. Return its start time for finish."""
+        with self.lock:
+            self.active += 1
+        return time.perf_counter()
+
+    def finish(self, start, size, streams):
+        """Note an upload of size bytes over streams connections finishing. Return the seconds it took."""
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.active -= 1
+            # small files are mostly request overhead, they'd drag the average down
+            if size >= self.threshold and elapsed:
+                rate = size / elapsed / streams
+                self.stream_rate = rate if self.stream_rate is None else \
+                    self.SMOOTHING * rate + (1 - self.SMOOTHING) * self.stream_rate
+
+        return elapsed
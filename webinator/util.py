@@ -10,7 +10,9 @@
 # you can do something like ep1.region_name or ep1.dns_zone after creating the ep1 object
 # ep1 = Endpoint('US East (Ohio)', 's3-website.us-east-2.amazonaws.com', 'Z2O1EMRO9K5GLX')
 
-from collections import namedtuple
+import threading
+import time
+from collections import deque, namedtuple
 
 Endpoint = namedtuple('Endpoint', ['region_name', 'host', 'dns_zone'])
 
@@ -47,3 +49,46 @@ def known_region(region_name):  # Determine if region exists. Return True if reg
 def get_endpoint(region_name):
     """Get the s3 website hosting endpoint for this region."""
     return region_to_endpoint[region_name]
+
+
+def bounded_map(executor, function, items, window):
+    """Run function over items in executor with at most window calls queued, yielding results in order."""
+    # executor.map would submit every item up front, this keeps only a window of them in flight
+    # so items can come from a generator without the whole lot ending up in memory
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+class RateLimiter:
+    """Token bucket letting through rate calls a second on average, in bursts of up to burst calls."""
+
+    def __init__(self, rate, burst=None):
+        """Create a RateLimiter, burst defaults to one second's worth of calls."""
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, count=1):
+        """Take count calls (or eg bytes) from the bucket. Return the seconds to wait before making them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # tokens go negative while callers are queued, each one waits for the tokens ahead of it to refill
+            self.tokens -= count
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self, count=1):
+        """Wait until count calls (or eg bytes) are allowed. Return the seconds waited."""
+        wait = self.reserve(count)
+        # sleeping outside the lock lets the other callers take their place in the queue
+        time.sleep(wait)
+        return wait
@@ -0,0 +1,96 @@
+"""Walk the website files to be synced to S3.
+
+Files are produced lazily by a generator so that a sync never has to hold the whole
+directory tree in memory, and os.scandir is used so the file type comes straight from the directory
+listing instead of separate is_dir()/is_file() stat calls.
+"""
+
+import logging
+import os
+import re
+from collections import namedtuple
+from fnmatch import translate
+
+log = logging.getLogger('webinator')
+
+# path - full path to the local file
+# key  - the S3 key for the file, its path relative to the website root using / separators
+# stat - os.stat_result for the file, reused by the etag cache so the file isn't stat'ed twice
+LocalFile = namedtuple('LocalFile', ['path', 'key', 'stat'])
+
+# the bucket keeps the webinator's own objects (eg the snapshot marker) under this prefix,
+# the bucket policy doesn't make them public and syncs never upload to or delete from it
+RESERVED_PREFIX = '.webinator/'
+
+# skip mac index files unless told otherwise, and anything that would land in the reserved prefix
+DEFAULT_EXCLUDE = ('.DS_Store', RESERVED_PREFIX + '*')
+
+
+class FileRules:
+    """Include/exclude glob rules for website files."""
+
+    def __init__(self, include=(), exclude=DEFAULT_EXCLUDE):
+        """Compile the glob patterns once, they get checked against every file in the tree."""
+        self.include = self.compile(include)
+        self.exclude = self.compile(exclude)
+
+    @staticmethod
+    def compile(patterns):
+        """Compile glob patterns into (matches_full_key, regex) pairs."""
+        # a pattern containing a / is matched against the whole key (eg css/*.css)
+        # anything else is matched against just the file or directory name (eg *.map)
+        return [('/' in pattern, re.compile(translate(pattern))) for pattern in patterns]
+
+    @staticmethod
+    def matches(rules, key, name):
+        """Return True if any of the compiled rules match key/name."""
+        return any(regex.match(key if full_key else name) for full_key, regex in rules)
+
+    def wanted(self, key, name):
+        """Return True if the file should be synced."""
+        if self.include and not self.matches(self.include, key, name):
+            return False
+        return not self.matches(self.exclude, key, name)
+
+    def excluded(self, key, name):
+        """Return True if the directory should be skipped along with everything in it."""
+        return self.matches(self.exclude, key, name)
+
+    def selects(self, key):
+        """Return True if walk_files would produce key, used to leave other objects in the bucket alone."""
+        parts = key.split('/')
+        for depth in range(1, len(parts)):
+            if self.excluded('/'.join(parts[:depth]), parts[depth - 1]):
+                return False
+        return self.wanted(key, parts[-1])
+
+
+def walk_files(root, rules=None, errors=None):
+    """Generate a LocalFile for every file under root that passes the rules.
+
+    Symlinked directories aren't followed, so a link back up the tree can't make the walk go round forever.
+    A directory that can't be read is logged and skipped, and (its key prefix, error) appended to errors
+    so the files in it aren't mistaken for deleted ones.
+    """
+    rules = rules or FileRules()
+    root = os.fspath(root)
+
+    # directories still to be walked, a list used as a stack rather than recursion
+    # so very deep trees can't hit python's recursion limit
+    pending = [(root, '')]
+    while pending:
+        directory, prefix = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    key = prefix + entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if not rules.excluded(key, entry.name):
+                            pending.append((entry.path, key + '/'))
+                    elif entry.is_file() and rules.wanted(key, entry.name):
+                        yield LocalFile(entry.path, key, entry.stat())
+        except OSError as err:
+            # one unreadable directory shouldn't stop the rest of the tree from syncing
+            log.warning("Skipping unreadable directory %s: %s", directory, err)
+            if errors is not None:
+                errors.append((prefix, err))
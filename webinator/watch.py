@@ -0,0 +1,292 @@
+"""Keep a bucket in sync with a website directory as files are edited.
+
+After one full sync, only the files that change are hashed and uploaded (or deleted),
+so an edit is live in well under a second instead of waiting for a walk, hash and listing of everything.
+Changes come from inotify on Linux, or from rescanning the tree every few seconds anywhere else.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from cache import UploadJournal
+from walker import DEFAULT_EXCLUDE, FileRules, walk_files
+
+log = logging.getLogger('webinator')
+
+# inotify event flags, from <sys/inotify.h>
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+# a file is only picked up once it has been closed after writing, not on every write while it's being saved
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+# wd, mask, cookie and length of the name that follows, at the start of every inotify event
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def load_inotify():
+    """Return libc if it has inotify, None otherwise (eg on macOS)."""
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return libc if hasattr(libc, 'inotify_init') else None
+
+
+class PollingWatcher:
+    """Find changed files by comparing the size, mtime and inode of every file in the tree every interval seconds."""
+
+    # seconds between scans when inotify isn't available
+    INTERVAL = 1.0
+
+    def __init__(self, root, rules, interval=INTERVAL):
+        """Create a PollingWatcher of the tree at root."""
+        self.root = root
+        self.rules = rules
+        self.interval = interval
+        self.files = self.scan()
+
+    def scan(self):
+        """Return {key: (size, mtime, inode)} for every file under root that passes the rules."""
+        return {file.key: (file.stat.st_size, file.stat.st_mtime_ns, file.stat.st_ino)
+                for file in walk_files(self.root, self.rules)}
+
+    def changes(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for changes. Return the keys that changed."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+
+            files = self.scan()
+            changed = {key for key in files.keys() | self.files.keys() if files.get(key) != self.files.get(key)}
+            self.files = files
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        """Stop watching."""
+
+
+class InotifyWatcher:
+    """Find changed files as the kernel reports them through inotify, with a watch on every directory in the tree."""
+
+    # bytes read from the inotify descriptor at once, room for a few hundred events
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, root, rules, libc):
+        """Create an InotifyWatcher of the tree at root."""
+        self.root = root
+        self.rules = rules
+        self.libc = libc
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+        self.directories = {}  # watch descriptor -> key prefix of its directory ('' for the root)
+        self.add_tree(root, '')
+
+    def add_tree(self, path, prefix):
+        """Watch the directory at path and every directory under it that the rules don't exclude."""
+        pending = [(path, prefix)]
+        while pending:
+            directory, prefix = pending.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                continue  # removed again before we got to it
+            self.directories[wd] = prefix
+
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        key = prefix + entry.name
+                        if entry.is_dir(follow_symlinks=False) and not self.rules.excluded(key, entry.name):
+                            pending.append((entry.path, key + '/'))
+            except FileNotFoundError:
+                continue
+
+    def remove_tree(self, prefix):
+        """Stop watching the directory with key prefix and everything under it (it was moved away)."""
+        for wd, watched in list(self.directories.items()):
+            if watched.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.directories[wd]
+
+    def changes(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for changes. Return the keys that changed.
+
+        A key can be a directory that appeared or went away, '' means anything in the tree may have changed.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = os.read(self.fd, self.READ_SIZE)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # the kernel dropped events, there's no telling what changed
+                changed.add('')
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            if wd not in self.directories or not name:
+                continue
+
+            key = self.directories[wd] + name
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.remove_tree(key + '/')
+                elif mask & (IN_CREATE | IN_MOVED_TO) and not self.rules.excluded(key, name):
+                    # files can land in a new directory before its watch is added, so it's walked as a whole
+                    self.add_tree(os.path.join(self.root, *key.split('/')), key + '/')
+                elif mask & IN_DELETE:
+                    continue  # its files were already reported one by one
+            changed.add(key)
+
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        os.close(self.fd)
+
+
+class SiteWatcher:
+    """Sync a website directory to a bucket, then keep syncing the files that change."""
+
+    # seconds without new changes before a batch of them is synced, editors and builds write files in bursts
+    DEBOUNCE = 0.2
+
+    # longest a change waits while others keep arriving
+    MAX_DELAY = 2.0
+
+    # seconds between calls to on_change while it has work left over (eg an invalidation held back),
+    # and before a batch that failed to sync is tried again if nothing else changes first
+    RETRY_INTERVAL = 10.0
+
+    def __init__(self, bucket_manager, path_name, bucket_name, include=(), exclude=(), poll_interval=None):
+        """Create a SiteWatcher, poll_interval forces polling every that many seconds instead of inotify."""
+        self.bucket_manager = bucket_manager
+        self.root = os.path.realpath(os.path.expanduser(path_name))
+        self.bucket_name = bucket_name
+        # the same rules sync uses, so a change is only synced if a full sync would have picked the file up
+        self.rules = FileRules(include, DEFAULT_EXCLUDE + tuple(exclude))
+        self.include = include
+        self.exclude = exclude
+        self.poll_interval = poll_interval
+
+    def make_watcher(self):
+        """Return an InotifyWatcher if the platform has inotify, a PollingWatcher otherwise."""
+        libc = None if self.poll_interval else load_inotify()
+        if libc:
+            return InotifyWatcher(self.root, self.rules, libc)
+
+        interval = self.poll_interval or PollingWatcher.INTERVAL
+        log.info("Polling for changes every %.1fs", interval)
+        return PollingWatcher(self.root, self.rules, interval)
+
+    def expand(self, keys):
+        """Turn directory keys (and '' for everything) into the keys of the files in, or formerly in, them."""
+        expanded = set()
+        for key in keys:
+            path = os.path.join(self.root, *key.split('/')) if key else self.root
+            if os.path.isdir(path):
+                prefix = key + '/' if key else ''
+                expanded.update(prefix + file.key for file in walk_files(path, self.rules))
+                # files that were in the directory before and aren't any more
+                expanded.update(known for known in self.bucket_manager.local_manifest if known.startswith(prefix))
+            else:
+                expanded.add(key)
+                expanded.update(known for known in self.bucket_manager.local_manifest if known.startswith(key + '/'))
+        return expanded
+
+    def run(self, on_change=None, **sync_options):
+        """Sync once and then on every change until interrupted. on_change(changed_keys) is called after each sync.
+
+        If on_change returns True it has work left over, and is called again with no keys
+        every RETRY_INTERVAL seconds until it returns False (or the next sync calls it anyway).
+        sync_options are passed on to BucketManager.sync (eg compression, header_policy).
+        """
+        # watching starts before the first sync, so edits made while it runs aren't missed
+        watcher = self.make_watcher()
+        try:
+            errors = self.bucket_manager.sync(self.root, self.bucket_name, include=self.include,
+                                              exclude=self.exclude, **sync_options)
+            for key, error in errors:
+                log.warning("Failed to sync %s: %s", key, error)
+            retry = False
+            if on_change and self.bucket_manager.changed_keys:
+                retry = bool(on_change(self.bucket_manager.changed_keys))
+
+            log.info("Watching %s for changes (Ctrl-C to stop)", self.root)
+            self.bucket_manager.journal = UploadJournal(self.bucket_name)
+            self.watch(watcher, on_change, retry)
+        except KeyboardInterrupt:
+            log.info("Stopped watching %s", self.root)
+        finally:
+            watcher.close()
+            if self.bucket_manager.journal:
+                self.bucket_manager.journal.close()
+                self.bucket_manager.journal = None
+
+    def watch(self, watcher, on_change=None, retry=False):
+        """Sync each debounced batch of changes from watcher, forever. retry is True if on_change has work left."""
+        pending = set()
+        first_seen = None
+        # a batch failed to sync, its keys are pending and tried again after RETRY_INTERVAL, or with the next change
+        failed = False
+        while True:
+            if pending:
+                timeout = self.RETRY_INTERVAL if failed else self.DEBOUNCE
+            else:
+                timeout = self.RETRY_INTERVAL if retry else None
+            changed = watcher.changes(timeout)
+            if changed:
+                pending |= changed
+                failed = False
+                first_seen = first_seen or time.monotonic()
+                if time.monotonic() - first_seen < self.MAX_DELAY:
+                    continue
+            if not pending:
+                # nothing changed for a while, a good time for on_change to finish what it held back
+                if retry:
+                    retry = bool(on_change([]))
+                continue
+
+            start = time.perf_counter()
+            keys = self.expand(pending)
+            pending, first_seen = set(), None
+
+            try:
+                errors = self.bucket_manager.sync_changes(self.root, self.bucket_name, keys, self.rules)
+                changed_keys = self.bucket_manager.changed_keys
+            except (BotoCoreError, ClientError, OSError) as err:
+                # eg a file removed as soon as it was uploaded, keep watching and try the whole batch again
+                log.warning("Failed to sync %d change(s), will try again: %s", len(keys), err)
+                pending, failed = pending | keys, True
+                errors, changed_keys = [], []
+            for key, error in errors:
+                log.warning("Failed to sync %s: %s", key, error)
+
+            if changed_keys:
+                log.info("Synced %d change(s) in %.2fs: %s", len(changed_keys), time.perf_counter() - start,
+                         ', '.join(changed_keys[:5]) + (' ...' if len(changed_keys) > 5 else ''))
+            if on_change and (changed_keys or retry):
+                retry = bool(on_change(changed_keys))
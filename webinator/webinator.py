@@ -11,22 +11,30 @@ The Webinator automates the process of deploying static websites to AWS.
 - Configuring a Content Delivery Network (CDN) with SSL using AWS CloudFront
 """
 
+import asyncio
+import logging
+import sys
 from argparse import ArgumentParser
+from functools import lru_cache
 
 import boto3
+import botocore.session
 import pprint
 
 from bucket import BucketManager
+from policy import HeaderPolicy
 from dns import DomainManager
 from certificate import CertificateManager
-from cdn import DistributionManager
+from cdn import DistributionManager, InvalidationQueue
+from ratecontrol import MAX_ATTEMPTS, RateControl
 
 import util
 
 
 parser = ArgumentParser(description='Arguments for the S3 Boto3 Session')
 parser.add_argument('Command', help='Command can be: "list_buckets", "list_bucket_objects", '
-                                    '"setup_bucket", "sync_s3", "setup_domain", "find_cert", "setup_cdn"')
+                                    '"setup_bucket", "sync_s3", "setup_domain", "find_cert", "setup_cdn", '
+                                    '"deploy_many", "abort_uploads", "watch"')
 parser.add_argument('Region', help='Specify the AWS Region you are working in eg us-west-2')
 parser.add_argument('--Bucket_Name', help='Type in the name of an S3 bucket')
 parser.add_argument('--Website_Root', help='Type in the full path to the website files that you want to sync '
@@ -35,38 +43,112 @@ parser.add_argument('--AWS_Profile', help='Type in the AWS Profile you wish to u
 parser.add_argument('--Site_DNS', help="Type in the FQDN for the hosted site."
                                        "This should match your bucket name.")
 parser.add_argument('--Domain', help="Type in the Domain Name for your site. eg eureka.software")
+parser.add_argument('--Workers', type=int, default=10, help="Number of files to upload at the same time "
+                                                            "when running sync_s3 (default 10)")
+parser.add_argument('--Hash_Workers', type=int, help="Number of files to hash at the same time "
+                                                     "when running sync_s3 (default is one per cpu core)")
+parser.add_argument('--Dry_Run', action='store_true', help="Print what sync_s3 would upload and delete "
+                                                           "without changing the bucket")
+parser.add_argument('--Include', action='append', default=[], help="Only sync files matching this glob "
+                                                                   "(eg *.html or css/*), can be given more than once")
+parser.add_argument('--Exclude', action='append', default=[], help="Don't sync files or directories matching this "
+                                                                   "glob (eg *.map), can be given more than once")
+parser.add_argument('--Snapshot', action='store_true', help="Save the bucket's manifest after sync_s3 and use it "
+                                                            "next time instead of listing the whole bucket")
+parser.add_argument('--Async', action='store_true', help="Run sync_s3 on asyncio instead of threads, for sites with "
+                                                         "very large numbers of small files (needs aiobotocore)")
+parser.add_argument('--Concurrency', type=int, default=200, help="Number of requests in flight at once "
+                                                                 "when running sync_s3 with --Async (default 200)")
+parser.add_argument('--Compress', choices=['gzip', 'br'], help="Upload html, css, js, svg and other text "
+                                                               "files compressed when running sync_s3")
+parser.add_argument('--Rehash', action='store_true', help="Ignore cached etags and hash every local file again "
+                                                          "when running sync_s3")
+parser.add_argument('--Header_Policy', help="JSON file of rules giving files their Cache-Control and other headers "
+                                            "when running sync_s3")
+parser.add_argument('--Distribution_Id', help="CloudFront distribution to invalidate the files sync_s3 changed in")
+parser.add_argument('--Wait_Invalidation', action='store_true', help="Wait for the CloudFront invalidation "
+                                                                     "to complete after sync_s3")
+parser.add_argument('--Refresh', action='store_true', help="Rebuild the cached indexes of CloudFront distributions, "
+                                                           "Route53 zones and ACM certificates instead of using them")
+parser.add_argument('--Sites', help="JSON or YAML file listing the sites to set up and sync with deploy_many")
+parser.add_argument('--Max_Age_Hours', type=int, default=24, help="abort_uploads aborts multipart uploads started "
+                                                                  "longer ago than this (default 24)")
+parser.add_argument('--Max_Bandwidth_MB', type=float, help="Cap on the MB per second uploaded by sync_s3 and "
+                                                           "deploy_many, shared by every file being uploaded")
+parser.add_argument('--Metrics_File', help="Write a JSON report of sync_s3's phase timings, counters and "
+                                           "request latencies to this file")
+parser.add_argument('--Prometheus_File', help="Write sync_s3's metrics to this file in the Prometheus text format "
+                                              "(eg for node_exporter's textfile collector)")
+parser.add_argument('--Max_Attempts', type=int, help="Attempts at each AWS request before giving up (default "
+                                                     f"{MAX_ATTEMPTS}, unless AWS_MAX_ATTEMPTS or the profile sets "
+                                                     "max_attempts)")
+parser.add_argument('--Poll_Interval', type=float, help="Poll for changes every this many seconds when running "
+                                                        "watch, instead of using inotify")
+parser.add_argument('--Log_Level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                    help="How much to log, DEBUG adds a line for every file synced (default INFO)")
 
 # need to add some error handling for the above commands
 
-args = parser.parse_args()
-
-if args.Bucket_Name:
-    bucket_name = args.Bucket_Name
-if args.Region:
-    aws_region = args.Region
-if args.Website_Root:
-    website_root_path = args.Website_Root
-if args.AWS_Profile:
-    aws_profile = args.AWS_Profile
-if args.Site_DNS:
-    site_dns = args.Site_DNS
-if args.Domain:
-    domain_name = args.Domain
+# parsed command line arguments, set by main()
+args = None
 
 
 # Setting Boto3 session
 # programmatically authenticate to AWS via boto3
-session = boto3.Session(profile_name=aws_profile, region_name='us-west-2')
+# the session and the managers below are only created when a command first needs them,
+# so eg list_buckets doesn't pay for loading the route53, acm and cloudfront service models
+@lru_cache(maxsize=None)
+def get_session():
+    """Get the boto3 session shared by every manager."""
+    # rate control goes on the botocore session before any client is made, so every client the managers create
+    # is under it, and after the profile is set, so the retry settings in the profile are kept
+    core_session = botocore.session.get_session()
+    session = boto3.Session(profile_name=args.AWS_Profile, region_name='us-west-2', botocore_session=core_session)
+    get_rate_control().install(core_session)
+    return session
+
+
+@lru_cache(maxsize=None)
+def get_rate_control():
+    """Get the token buckets, adaptive concurrency limits and retry settings shared by every client."""
+    return RateControl(max_attempts=args.Max_Attempts)
+
+
+@lru_cache(maxsize=None)
+def get_bandwidth_limiter():
+    """Get the limiter every upload waits on to stay under --Max_Bandwidth_MB, None if there's no cap."""
+    return util.RateLimiter(args.Max_Bandwidth_MB * 1024 ** 2) if args.Max_Bandwidth_MB else None
+
 
 # Various service objects using their respective classes
-bucket_manager = BucketManager(session)  # creating an S3 bucket_manager object from BucketManager class
-domain_manager = DomainManager(session)  # creating a route53 domain_manager object
-cert_manager = CertificateManager(session)  # creating a certificate manager object
-dist_manager = DistributionManager(session)
+@lru_cache(maxsize=None)
+def get_bucket_manager():
+    """Get the S3 bucket manager."""
+    return BucketManager(get_session(), workers=args.Workers, hash_workers=args.Hash_Workers,
+                         bandwidth_limiter=get_bandwidth_limiter())
+
+
+@lru_cache(maxsize=None)
+def get_domain_manager():
+    """Get the route53 domain manager."""
+    return DomainManager(get_session(), refresh=args.Refresh)
+
+
+@lru_cache(maxsize=None)
+def get_cert_manager():
+    """Get the certificate manager."""
+    return CertificateManager(get_session(), refresh=args.Refresh)
+
+
+@lru_cache(maxsize=None)
+def get_dist_manager():
+    """Get the CloudFront distribution manager."""
+    return DistributionManager(get_session(), refresh=args.Refresh)
+
 
 def list_buckets():
     """List all S3 Buckets."""
-    for bucket in bucket_manager.all_buckets():  # calling the all_buckets method
+    for bucket in get_bucket_manager().all_buckets():  # calling the all_buckets method
         print(bucket)
 
 
@@ -74,25 +156,123 @@ def list_bucket_objects(bucket):
     """List Objects in an S3 Bucket."""
     print(f"Objects in Bucket {bucket}")
     print("-" * 45)
-    for obj in bucket_manager.all_objects(bucket):
-        print(obj)
+    # objects are printed as they are listed rather than after the whole bucket has been listed
+    for obj in get_bucket_manager().iter_objects(bucket):
+        print(f"{obj['Key']}  ({obj['Size']} bytes, last modified {obj['LastModified']})")
 
 
 def setup_bucket(bucket):
     """Create and configure an S3 Bucket."""
-    s3_bucket = bucket_manager.initialize_bucket(bucket, aws_region)
+    bucket_manager = get_bucket_manager()
+    s3_bucket = bucket_manager.initialize_bucket(bucket, args.Region)
     bucket_manager.set_policy(s3_bucket)
     bucket_manager.configure_website(s3_bucket)
 
 
+async def async_sync(path_name, bucket, header_policy):
+    """Sync contents of PATHNAME to S3 Bucket using asyncio."""
+    # only imported here so aiobotocore is only needed when --Async is used
+    from async_bucket import AsyncBucketManager
+
+    async with AsyncBucketManager(get_session(), concurrency=args.Concurrency, hash_workers=args.Hash_Workers,
+                                  bandwidth_limiter=get_bandwidth_limiter(),
+                                  rate_control=get_rate_control()) as async_bucket_manager:
+        errors = await async_bucket_manager.sync(path_name, bucket, rehash=args.Rehash, dry_run=args.Dry_Run,
+                                                 include=args.Include, exclude=args.Exclude, snapshot=args.Snapshot,
+                                                 compression=args.Compress, header_policy=header_policy)
+        return errors, async_bucket_manager.changed_keys, async_bucket_manager.metrics
+
+
 def sync(path_name, bucket):
     """Sync contents of PATHNAME to S3 Bucket."""
-    bucket_manager.sync(path_name, bucket)
-    print(bucket_manager.get_bucket_url(bucket_manager.s3.Bucket(bucket_name)))
+    bucket_manager = get_bucket_manager()
+
+    # the header policy is loaded up front so a broken rules file is reported before anything is synced
+    header_policy = HeaderPolicy.load(args.Header_Policy) if args.Header_Policy else None
+
+    if args.Async:
+        errors, changed_keys, metrics = asyncio.run(async_sync(path_name, bucket, header_policy))
+    else:
+        errors = bucket_manager.sync(path_name, bucket, rehash=args.Rehash, dry_run=args.Dry_Run,
+                                     include=args.Include, exclude=args.Exclude, snapshot=args.Snapshot,
+                                     compression=args.Compress, header_policy=header_policy)
+        changed_keys, metrics = bucket_manager.changed_keys, bucket_manager.metrics
+
+    if args.Metrics_File:
+        metrics.save_json(args.Metrics_File)
+    if args.Prometheus_File:
+        metrics.save_prometheus(args.Prometheus_File, {'bucket': bucket})
+    if not args.Dry_Run:
+        print(bucket_manager.get_bucket_url(bucket_manager.s3.Bucket(bucket)))
+
+    if args.Distribution_Id and not args.Dry_Run:
+        invalidate(args.Distribution_Id, changed_keys)
+
+    if errors:
+        print(f"{len(errors)} file(s) failed to upload:")
+        for key, error in errors:
+            print(f"  {key}: {error}")
+
+
+def watch(path_name, bucket):
+    """Sync contents of PATHNAME to S3 Bucket, then keep syncing the files that change."""
+    # only imported here so the other commands don't load ctypes and select
+    from watch import SiteWatcher
+
+    header_policy = HeaderPolicy.load(args.Header_Policy) if args.Header_Policy else None
+    site_watcher = SiteWatcher(get_bucket_manager(), path_name, bucket, include=args.Include, exclude=args.Exclude,
+                               poll_interval=args.Poll_Interval)
+
+    # watch changes files far more often than CloudFront finishes invalidations,
+    # so changes are batched up while the last invalidation is in progress
+    queue = InvalidationQueue(get_dist_manager(), args.Distribution_Id) if args.Distribution_Id else None
+
+    def changed(keys):
+        """Invalidate what each sync changed. Return True if some of it is still waiting to be invalidated."""
+        if queue is None:
+            return False
+        sent = queue.add(keys)
+        if sent:
+            report_invalidation(*sent)
+        return bool(queue.keys)
+
+    site_watcher.run(changed, rehash=args.Rehash, compression=args.Compress, header_policy=header_policy)
+
+    # whatever was held back goes out before stopping, rather than being left cached
+    if queue and queue.keys:
+        sent = queue.flush(wait=False)
+        if sent:
+            report_invalidation(*sent)
+
+
+def report_invalidation(invalidation, keys):
+    """Print the paths an invalidation of keys was created with."""
+    paths = invalidation['InvalidationBatch']['Paths']['Items']
+    print(f"Invalidation {invalidation['Id']} created for {len(keys)} changed file(s) as {len(paths)} path(s):")
+    for path in paths:
+        print(f"  {path}")
+
+
+def invalidate(dist_id, keys):
+    """Invalidate changed keys in a CloudFront distribution."""
+    dist_manager = get_dist_manager()
+    invalidation = dist_manager.invalidate(dist_id, keys)
+    if not invalidation:
+        print("Nothing changed, no invalidation needed")
+        return
+
+    report_invalidation(invalidation, keys)
+
+    if args.Wait_Invalidation:
+        print("Waiting for invalidation to complete...")
+        print(f"Invalidation {dist_manager.await_invalidation(dist_id, invalidation)}")
 
 
 def setup_domain(fqdn):
     """Configure Domain to point to Bucket."""
+    bucket_manager = get_bucket_manager()
+    domain_manager = get_domain_manager()
+
     # zone is the Route53 zone we find or the one we create if it doesn't exist
     # reminder, for s3 bucket websites, the fqdn and the bucket must be the same name
     bucket = bucket_manager.get_bucket(fqdn)
@@ -108,17 +288,20 @@ def setup_domain(fqdn):
 
 def find_cert(domain):
     """Find a certificate for the supplied domain."""
-    pprint.pprint(cert_manager.find_matching_cert(domain))
+    pprint.pprint(get_cert_manager().find_matching_cert(domain))
 
 
 def setup_cdn(fqdn, domain_name):
     """Set up CloudFront CDN for the specified domain pointing to specified bucket."""
+    domain_manager = get_domain_manager()
+    dist_manager = get_dist_manager()
+
     # searching to see if we already have a CF Distribution setup for this domain
     dist = dist_manager.find_matching_dist(fqdn)
 
     # if we don't find a CF distribution for this domain, create it
     if not dist:
-        cert = cert_manager.find_matching_cert(fqdn)
+        cert = get_cert_manager().find_matching_cert(fqdn)
         if not cert:  # SSL is not optional at this time
             print("Error: No matching cert found.")
             return
@@ -138,22 +321,80 @@ def setup_cdn(fqdn, domain_name):
     return
 
 
-if args.Command == "list_buckets":
-    list_buckets()
-elif args.Command == "list_bucket_objects":
-    list_bucket_objects(bucket_name)
-elif args.Command == "setup_bucket":
-    setup_bucket(bucket_name)
-elif args.Command == "sync_s3":
-    sync(website_root_path, bucket_name)
-elif args.Command == "setup_domain":
-    setup_domain(site_dns)
-elif args.Command == "find_cert":
-    find_cert(domain_name)
-elif args.Command == "setup_cdn":
-    setup_cdn(site_dns, domain_name)
-else:
-    print("Please enter a valid command")
+def abort_uploads(bucket):
+    """Abort stale multipart uploads left behind in an S3 Bucket."""
+    aborted = get_bucket_manager().abort_stale_uploads(bucket, args.Max_Age_Hours)
+    for key, initiated in aborted:
+        print(f"Aborted upload of {key} started {initiated}")
+    print(f"Aborted {len(aborted)} upload(s) older than {args.Max_Age_Hours} hour(s)")
+
+
+def deploy_many(sites_path):
+    """Set up, sync and configure DNS/CDN for every site in a site file."""
+    # only imported here so other commands don't pay for loading it (and PyYAML)
+    from deploy import SiteDeployer, load_sites
+
+    config = load_sites(sites_path, args.Region)
+
+    # one s3 client is shared by every site, so its connection pool has room for all of their uploads at once
+    shared_bucket_manager = BucketManager(get_session(), workers=args.Workers * config['concurrency'],
+                                          bandwidth_limiter=get_bandwidth_limiter())
+    deployer = SiteDeployer(shared_bucket_manager, get_domain_manager(), get_cert_manager(), get_dist_manager(),
+                            workers=args.Workers, hash_workers=args.Hash_Workers,
+                            concurrency=config['concurrency'], rate_control=get_rate_control(),
+                            rate_limits=config['rate_limits'])
+    deployer.report(deployer.deploy_all(config['sites']))
+
+
+def report_throttling():
+    """Print how often AWS throttled the command's requests and how long they waited on rate limits."""
+    if not get_session.cache_info().currsize:
+        return  # the command never talked to AWS
+
+    for service, stats in get_rate_control().report().items():
+        # requests that sailed through aren't worth a line
+        if stats['throttled'] or stats['waited'] >= 1:
+            print(f"{service}: {stats['throttled']} of {stats['requests']} request(s) throttled, "
+                  f"{stats['waited']:.1f}s waiting on rate limits, "
+                  f"concurrency limit {stats['limit']} (lowest {stats['lowest']})")
+
+
+def main(argv=None):
+    """Parse the command line and run the command."""
+    global args
+    args = parser.parse_args(argv)
+
+    # progress goes to stdout as plain lines, like the rest of the output
+    # only webinator's own logger gets the chosen level, boto3's debug output would drown it out
+    logging.basicConfig(stream=sys.stdout, format='%(message)s')
+    logging.getLogger('webinator').setLevel(args.Log_Level)
+
+    if args.Command == "list_buckets":
+        list_buckets()
+    elif args.Command == "list_bucket_objects":
+        list_bucket_objects(args.Bucket_Name)
+    elif args.Command == "setup_bucket":
+        setup_bucket(args.Bucket_Name)
+    elif args.Command == "sync_s3":
+        sync(args.Website_Root, args.Bucket_Name)
+    elif args.Command == "setup_domain":
+        setup_domain(args.Site_DNS)
+    elif args.Command == "find_cert":
+        find_cert(args.Domain)
+    elif args.Command == "setup_cdn":
+        setup_cdn(args.Site_DNS, args.Domain)
+    elif args.Command == "deploy_many":
+        deploy_many(args.Sites)
+    elif args.Command == "abort_uploads":
+        abort_uploads(args.Bucket_Name)
+    elif args.Command == "watch":
+        watch(args.Website_Root, args.Bucket_Name)
+    else:
+        print("Please enter a valid command")
+
+    report_throttling()
+
 
 if __name__ == '__main__':
+    main()
     print("... Output obtained using the Webinator! ...")